@@ -0,0 +1,418 @@
+# src/analytics.py
+"""
+Колоночный снимок состояния участников в массивах NumPy для статистики администратора.
+
+Одна позиция массивов - один участник manual_upload (по возрастанию
+participant_id): этап, хэш email, регистрация в боте, старт квеста, маска
+пройденных этапов, время регистрации, статус ссылки, дата рассылки,
+дистанция и подтверждение пробежки. Счетчики, гистограммы и разбивки по
+этапам считаются векторными операциями по этим массивам, без SQL.
+
+Снимок обновляется инкрементально: новые участники дочитываются по
+participant_id, измененные - по журналу analytics_changes (его заполняют
+триггеры, см. migrations.py). Полная перезагрузка нужна только при первом
+чтении и когда удаленных участников становится много.
+
+Снимок собирается из двух частей: участники, ссылки и рассылка читаются
+из основного файла, регистрация, квест и пробежки - из пользовательских
+таблиц через db.fan_out (параллельно со всех шардов, если они включены,
+см. sharding.py). У каждого файла свой журнал analytics_changes, номер
+последней учтенной записи хранится отдельно.
+
+    stats = db.analytics.link_summary()          # /link_stats
+    stages = db.analytics.stage_breakdown()      # разбивка по этапам
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from database import STAGE_NUMBERS, stage_bit
+
+# Не чаще одного обновления за столько секунд (команды берут снимок как есть)
+ANALYTICS_REFRESH_SECONDS = 5
+# Доля удаленных участников, после которой снимок перестраивается целиком
+ANALYTICS_REBUILD_DELETED_SHARE = 0.2
+ANALYTICS_FETCH_SIZE = 50000
+# Границы гистограммы дистанций, км
+DISTANCE_BINS = (0, 3, 5, 10, 21.1, 42.2, np.inf)
+
+# Колонки снимка: имя -> тип массива
+COLUMNS = {
+    'participant_id': np.int64,
+    'stage_id': np.int16,
+    'email_hash': np.int64,
+    'registered': np.bool_,
+    'quest_started': np.bool_,
+    'stage_mask': np.uint8,
+    'registered_at': np.int64,   # epoch UTC, 0 - нет регистрации
+    'link_status': np.int8,      # -1 - ссылки нет, 0 - использована, 1 - активна
+    'mailing_at': np.int64,      # epoch UTC, 0 - письмо не отправлялось
+    'distance': np.float32,      # NaN - пробежки нет
+    'verified': np.bool_,
+    'present': np.bool_,         # False - участник удален из manual_upload
+}
+
+# Общая часть снимка (основной файл): участник, этап, email, ссылка и рассылка
+_PARTICIPANTS_SQL = '''
+    SELECT mu.participant_id, mu.stage_id, mu.email,
+           IFNULL(lg.status, -1),
+           IFNULL(CAST(strftime('%s', lg.mailing_date) AS INTEGER), 0)
+    FROM manual_upload mu
+    LEFT JOIN link_generation lg ON lg.participant_id = mu.participant_id
+'''
+_PARTICIPANT_FIELDS = (
+    ('participant_id', np.int64), ('stage_id', np.int16), ('email_hash', np.int64),
+    ('link_status', np.int8), ('mailing_at', np.int64)
+)
+
+# Пользовательская часть (шарды, если включены): регистрация, квест, пробежка
+_USERS_SQL = '''
+    SELECT m.participant_id, IFNULL(m.quest_started, 0), IFNULL(m.stage_mask, 0),
+           IFNULL(CAST(strftime('%s', m.registration_date) AS INTEGER), 0),
+           v.distance, IFNULL(v.answer_check, 0)
+    FROM main m
+    LEFT JOIN verification v ON v.user_id = m.user_id
+'''
+_USER_FIELDS = (
+    ('participant_id', np.int64), ('quest_started', np.bool_), ('stage_mask', np.uint8),
+    ('registered_at', np.int64), ('distance', np.float32), ('verified', np.bool_)
+)
+USER_COLUMNS = ('registered',) + tuple(name for name, _ in _USER_FIELDS[1:])
+
+# Ключ журнала изменений основного файла (шарды - по номеру, без шардирования - None)
+GLOBAL_CHANGES = 'global'
+
+
+def _email_hash(email) -> int:
+    # hash() стабилен в пределах процесса, снимок живет только в памяти
+    return hash((email or '').strip().lower())
+
+
+def _read_arrays(cursor, fields: tuple) -> dict:
+    """Строки запроса -> массивы колонок fields"""
+    parts = {name: [] for name, _ in fields}
+    while True:
+        rows = cursor.fetchmany(ANALYTICS_FETCH_SIZE)
+        if not rows:
+            break
+        for (name, dtype), values in zip(fields, zip(*rows)):
+            if name == 'email_hash':
+                values = [_email_hash(value) for value in values]
+            elif name == 'distance':
+                values = [np.nan if value is None else value for value in values]
+            parts[name].append(np.array(values, dtype=dtype))
+    return {
+        name: np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=dtype)
+        for name, dtype in fields
+    }
+
+
+def _concat(parts: list, fields: tuple) -> dict:
+    return {name: np.concatenate([part[name] for part in parts]) for name, _ in fields}
+
+
+def _last_change(cursor) -> int:
+    cursor.execute("SELECT IFNULL(MAX(seq), 0) FROM analytics_changes")
+    return cursor.fetchone()[0]
+
+
+def _changed_since(cursor, since: int) -> list:
+    cursor.execute("SELECT participant_id FROM analytics_changes WHERE seq > ?", (since,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+class ParticipantAnalytics:
+    """Снимок участников в массивах NumPy и статистика по нему"""
+
+    def __init__(self, database, refresh_seconds: float = ANALYTICS_REFRESH_SECONDS):
+        self.db = database
+        self.refresh_seconds = refresh_seconds
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.stage_names = {}
+        self.loaded_at = None
+        self.last_refresh_seconds = None
+        # Последний учтенный номер журнала analytics_changes каждого файла
+        self._changes_seq = {}
+        self._deleted = 0
+        # Результаты статистики текущего снимка, сбрасываются при обновлении
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    # ---------- Загрузка ----------
+
+    @staticmethod
+    def _new_columns(participants: dict) -> dict:
+        """Колонки снимка для строк _PARTICIPANTS_SQL, пользовательские - по умолчанию"""
+        size = participants['participant_id'].size
+        columns = dict(participants)
+        for name in USER_COLUMNS:
+            columns[name] = np.zeros(size, dtype=COLUMNS[name])
+        columns['distance'][:] = np.nan
+        columns['present'] = np.ones(size, dtype=np.bool_)
+        return columns
+
+    def _apply_users(self, users: dict):
+        """Пользовательские колонки из строк _USERS_SQL по participant_id"""
+        ids = self.columns['participant_id']
+        if not ids.size or not users['participant_id'].size:
+            return
+        positions = np.minimum(np.searchsorted(ids, users['participant_id']), ids.size - 1)
+        # Пользователи без участника в manual_upload в снимок не попадают
+        matched = ids[positions] == users['participant_id']
+        positions = positions[matched]
+        self.columns['registered'][positions] = True
+        for name, _ in _USER_FIELDS[1:]:
+            self.columns[name][positions] = users[name][matched]
+
+    def _read_users(self, since: dict = None, participant_ids: list = (), after_id: int = 0) -> tuple:
+        """Чтение пользовательской части со всех шардов параллельно.
+
+        since=None - все пользователи; иначе только participant_ids, новые
+        участники (participant_id > after_id) и отмеченные в журнале шарда
+        после since[шард]. Возвращает (массивы, {шард: номер журнала},
+        participant_id из журналов шардов).
+        """
+        def read(conn, shard):
+            cursor = conn.cursor()
+            # Номер журнала и строки - из одного снимка WAL шарда
+            cursor.execute("BEGIN")
+            seq = _last_change(cursor)
+            if since is None:
+                cursor.execute(_USERS_SQL + " WHERE m.participant_id IS NOT NULL")
+                return seq, [], _read_arrays(cursor, _USER_FIELDS)
+            changed = _changed_since(cursor, since.get(shard, 0))
+            cursor.execute(
+                _USERS_SQL + " WHERE m.participant_id > ? OR m.participant_id IN (SELECT value FROM json_each(?))",
+                (after_id, json.dumps(list(participant_ids) + changed))
+            )
+            return seq, changed, _read_arrays(cursor, _USER_FIELDS)
+
+        results = self.db.fan_out(read)
+        seqs = {shard: seq for shard, (seq, _, _) in zip(self.db.shards(), results)}
+        changed = [participant_id for _, shard_changed, _ in results for participant_id in shard_changed]
+        return _concat([users for _, _, users in results], _USER_FIELDS), seqs, changed
+
+    def _load_stage_names(self, cursor):
+        cursor.execute("SELECT stage_id, stage_name FROM stages")
+        self.stage_names = dict(cursor.fetchall())
+
+    def _full_load(self):
+        users, seqs, _ = self._read_users()
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            self._load_stage_names(cursor)
+            seqs[GLOBAL_CHANGES] = _last_change(cursor)
+            cursor.execute(_PARTICIPANTS_SQL + " ORDER BY mu.participant_id")
+            self.columns = self._new_columns(_read_arrays(cursor, _PARTICIPANT_FIELDS))
+        self._apply_users(users)
+        self._changes_seq = seqs
+        self._deleted = 0
+        self._derived = {}
+
+    def _apply_increment(self) -> bool:
+        """Дочитка новых и измененных участников, False - нужна полная перезагрузка"""
+        ids = self.columns['participant_id']
+        last_id = int(ids[-1]) if ids.size else 0
+
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            self._load_stage_names(cursor)
+            global_seq = _last_change(cursor)
+            global_changed = _changed_since(cursor, self._changes_seq.get(GLOBAL_CHANGES, 0))
+            cursor.execute(_PARTICIPANTS_SQL + " WHERE mu.participant_id > ? ORDER BY mu.participant_id", (last_id,))
+            appended = _read_arrays(cursor, _PARTICIPANT_FIELDS)
+
+        # Пользовательская часть новых и измененных участников (и журналы шардов)
+        users, seqs, users_changed = self._read_users(self._changes_seq, global_changed, last_id)
+        changed_ids = np.unique(np.array(global_changed + users_changed, dtype=np.int64))
+        changed_ids = changed_ids[changed_ids <= last_id]
+
+        changed = None
+        if changed_ids.size:
+            positions = np.minimum(np.searchsorted(ids, changed_ids), ids.size - 1)
+            if not np.array_equal(ids[positions], changed_ids):
+                # participant_id, которого не было в снимке (перенумерация) - читаем заново
+                return False
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    _PARTICIPANTS_SQL + " WHERE mu.participant_id IN (SELECT value FROM json_each(?))",
+                    (json.dumps(changed_ids.tolist()),)
+                )
+                changed = _read_arrays(cursor, _PARTICIPANT_FIELDS)
+
+        if appended['participant_id'].size:
+            new_columns = self._new_columns(appended)
+            self.columns = {
+                name: np.concatenate((self.columns[name], new_columns[name])) for name in COLUMNS
+            }
+            ids = self.columns['participant_id']
+
+        if changed is not None:
+            # Отмеченные, но не найденные участники удалены из manual_upload
+            found = np.isin(changed_ids, changed['participant_id'])
+            removed = positions[~found & self.columns['present'][positions]]
+            self.columns['present'][removed] = False
+            self._deleted += removed.size
+
+            rows = np.searchsorted(ids, changed['participant_id'])
+            for name, _ in _PARTICIPANT_FIELDS:
+                self.columns[name][rows] = changed[name]
+            # Пользователь мог отвязаться от участника - сбрасываем и читаем заново
+            defaults = self._new_columns({'participant_id': np.empty(1, dtype=np.int64)})
+            for name in USER_COLUMNS:
+                self.columns[name][positions] = defaults[name][0]
+
+        self._apply_users(users)
+        if appended['participant_id'].size or changed is not None or users['participant_id'].size:
+            self._derived = {}
+
+        seqs[GLOBAL_CHANGES] = global_seq
+        self._changes_seq = seqs
+        return self._deleted <= ids.size * ANALYTICS_REBUILD_DELETED_SHARE
+
+    def refresh(self, full: bool = False) -> bool:
+        """Обновление снимка из базы (инкрементально, если снимок уже загружен)"""
+        with self._lock:
+            started = time.monotonic()
+            try:
+                if full or self.loaded_at is None or not self._apply_increment():
+                    self._full_load()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка обновления снимка аналитики: {e}")
+                # Снимок мог обновиться частично - следующее чтение загрузит его заново
+                self.loaded_at = None
+                return False
+
+            self.loaded_at = time.time()
+            self.last_refresh_seconds = time.monotonic() - started
+            return True
+
+    def ensure_fresh(self):
+        """Обновление, если снимок старше refresh_seconds"""
+        if self.loaded_at is None or time.time() - self.loaded_at >= self.refresh_seconds:
+            self.refresh()
+
+    # ---------- Статистика ----------
+
+    def _present(self, name: str) -> np.ndarray:
+        column = self.columns[name]
+        return column[self.columns['present']] if self._deleted else column
+
+    def _cached(self, key, compute):
+        """Результат compute() для текущего снимка: считается один раз на обновление"""
+        self.ensure_fresh()
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = compute()
+            return self._derived[key]
+
+    def total(self) -> int:
+        """Число участников"""
+        return self._cached('total', lambda: int(np.count_nonzero(self.columns['present'])))
+
+    def unique_emails(self) -> int:
+        """Число различных email"""
+        def compute() -> int:
+            hashes = np.sort(self._present('email_hash'))
+            return int(np.count_nonzero(hashes[1:] != hashes[:-1])) + 1 if hashes.size else 0
+        return self._cached('unique_emails', compute)
+
+    def link_summary(self) -> dict:
+        """Ссылки и регистрации: то же, что агрегат /link_stats"""
+        def compute() -> dict:
+            link_status = self._present('link_status')
+            return {
+                'total_users': int(link_status.size),
+                'users_with_links': int(np.count_nonzero(link_status >= 0)),
+                'active_links': int(np.count_nonzero(link_status == 1)),
+                'used_links': int(np.count_nonzero(link_status == 0)),
+                'registered_users': int(np.count_nonzero(self._present('registered'))),
+                'pending_mailing': int(np.count_nonzero((link_status == 1) & (self._present('mailing_at') == 0)))
+            }
+        return dict(self._cached('link_summary', compute))
+
+    def stage_breakdown(self) -> list:
+        """Разбивка по этапам manual_upload: участники, регистрации, старт квеста,
+        завершение этапов квеста, подтвержденные пробежки"""
+        def compute() -> list:
+            stage_id = self._present('stage_id')
+            if stage_id.size == 0:
+                return []
+            size = max(int(stage_id.max()), max(self.stage_names, default=0)) + 1
+            stage_mask = self._present('stage_mask')
+
+            def count(selected=None) -> np.ndarray:
+                return np.bincount(stage_id if selected is None else stage_id[selected], minlength=size)
+
+            participants = count()
+            registered = count(self._present('registered'))
+            quest_started = count(self._present('quest_started'))
+            verified = count(self._present('verified'))
+            completed = {
+                stage_number: count((stage_mask & stage_bit(stage_number)) != 0)
+                for stage_number in STAGE_NUMBERS
+            }
+
+            return [
+                {
+                    'stage_id': stage,
+                    'stage_name': self.stage_names.get(stage, f"Этап {stage}"),
+                    'participants': int(participants[stage]),
+                    'registered': int(registered[stage]),
+                    'quest_started': int(quest_started[stage]),
+                    'verified': int(verified[stage]),
+                    'completed': {number: int(values[stage]) for number, values in completed.items()}
+                }
+                for stage in range(size)
+                if participants[stage] or stage in self.stage_names
+            ]
+        return self._cached('stage_breakdown', compute)
+
+    def registrations_by_day(self, days: int = 7) -> list:
+        """Регистрации в боте по дням (UTC) за последние days дней: [(дата, число)], новые первыми"""
+        today = datetime.now(timezone.utc).date()
+
+        def compute() -> list:
+            registered_at = self._present('registered_at')
+            registered_at = registered_at[registered_at > 0]
+            first_day = datetime(today.year, today.month, today.day, tzinfo=timezone.utc) - timedelta(days=days - 1)
+            offsets = (registered_at - int(first_day.timestamp())) // 86400
+            counts = np.bincount(offsets[(offsets >= 0) & (offsets < days)], minlength=days)
+            return [
+                ((first_day + timedelta(days=day)).date().isoformat(), int(counts[day]))
+                for day in range(days - 1, -1, -1)
+                if counts[day]
+            ]
+        return self._cached(('registrations_by_day', today, days), compute)
+
+    def distance_histogram(self, bins: tuple = DISTANCE_BINS) -> list:
+        """Распределение дистанций загруженных пробежек: [(от, до, всего, подтверждено)]"""
+        def compute() -> list:
+            distance = self._present('distance')
+            loaded = ~np.isnan(distance)
+            total, _ = np.histogram(distance[loaded], bins=bins)
+            verified, _ = np.histogram(distance[loaded & self._present('verified')], bins=bins)
+            return [
+                (bins[index], bins[index + 1], int(total[index]), int(verified[index]))
+                for index in range(len(bins) - 1)
+            ]
+        return self._cached(('distance_histogram', tuple(bins)), compute)
+
+    def stats(self) -> dict:
+        """Состояние снимка"""
+        with self._lock:
+            return {
+                'rows': int(self.columns['participant_id'].size),
+                'deleted': self._deleted,
+                'bytes': sum(column.nbytes for column in self.columns.values()),
+                'loaded_at': self.loaded_at,
+                'last_refresh_seconds': self.last_refresh_seconds
+            }
@@ -0,0 +1,6 @@
+"""
+Бенчмарки горячих запросов SQLite на синтетической базе.
+
+Генерация базы:   python -m benchmarks.dataset --participants 100000 --db bench.db
+Запуск замеров:   python -m benchmarks.run_benchmarks --participants 100000
+"""
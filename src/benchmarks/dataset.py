@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Генератор синтетической базы runners.db для бенчмарков.
+
+Схема создается теми же миграциями, что и у бота, данные заполняются
+пакетами в одной транзакции. Пропорции близки к боевым: около трети
+участников перешли по ссылке и зарегистрированы в main, у части есть
+скриншоты, пробежки, промокоды и участие в розыгрыше.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+from database import STAGE_NUMBERS, stage_bit
+
+BATCH_SIZE = 10000
+
+# Смещение telegram_id синтетических пользователей
+TELEGRAM_ID_BASE = 100_000_000
+
+# Доли от числа участников
+REGISTERED_SHARE = 0.35
+PROMO_CODES_SHARE = 0.5
+PROMO_USED_SHARE = 0.2
+RAFFLE_SHARE = 0.2
+
+STAGES = [
+    (1, 'ГЛАВА 1. «Предательство в Центральном штабе»'),
+    (2, 'ГЛАВА 2. «Провал операции»'),
+    (3, 'ГЛАВА 3. «Обратный отсчет»'),
+    (4, 'ГЛАВА 4. «Последний рейс»'),
+    (5, 'Пакет на 4 этапа «Тайна пропавшей коллекции. Полное погружение»')
+]
+
+LAST_NAMES = ['Иванов', 'Петров', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов', 'Новиков', 'Морозов']
+FIRST_NAMES = ['Александр', 'Мария', 'Дмитрий', 'Анна', 'Сергей', 'Елена', 'Андрей', 'Ольга', 'Михаил', 'Наталья']
+MIDDLE_NAMES = ['Александрович', 'Сергеевна', 'Дмитриевич', 'Андреевна', None]
+
+
+def telegram_id_for(participant_id: int) -> int:
+    """telegram_id зарегистрированного синтетического участника"""
+    return TELEGRAM_ID_BASE + participant_id
+
+
+def link_for(participant_id: int) -> str:
+    """Персональная ссылка синтетического участника"""
+    return f"bench{participant_id:010d}"
+
+
+def _batched(rows):
+    """Разбиение генератора строк на пакеты для executemany"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(cursor, sql: str, rows) -> int:
+    count = 0
+    for batch in _batched(rows):
+        cursor.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def generate_dataset(db_path: str, participants: int, seed: int = 42) -> dict:
+    """Создание базы с заданным числом участников, возвращает число строк по таблицам"""
+    if os.path.exists(db_path):
+        raise FileExistsError(f"База уже существует: {db_path}")
+
+    rnd = random.Random(seed)
+    now = int(time.time())
+    registered = set(rnd.sample(range(1, participants + 1), int(participants * REGISTERED_SHARE)))
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    migrations.migrate(conn)
+
+    cursor = conn.cursor()
+    counts = {}
+    conn.execute("BEGIN")
+
+    counts['stages'] = _insert(cursor, "INSERT INTO stages (stage_id, stage_name) VALUES (?, ?)", STAGES)
+
+    counts['manual_upload'] = _insert(cursor, '''
+        INSERT INTO manual_upload (participant_id, last_name, first_name, middle_name, email, phone, stage_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        (pid, rnd.choice(LAST_NAMES), rnd.choice(FIRST_NAMES), rnd.choice(MIDDLE_NAMES),
+         f"runner{pid}@example.com", 79000000000 + pid, rnd.randint(1, 5))
+        for pid in range(1, participants + 1)
+    ))
+
+    def link_rows():
+        for pid in range(1, participants + 1):
+            if pid in registered:
+                yield (pid, link_for(pid), 0, now - 86400, 0)
+            else:
+                # Часть ссылок уже получила письмо и ждет повторной отправки
+                due = rnd.choice([0, now - rnd.randint(1, 72000), now + rnd.randint(1, 72000)])
+                mailing = due - 72000 if due else None
+                yield (pid, link_for(pid), 1, mailing, due)
+
+    counts['link_generation'] = _insert(cursor, '''
+        INSERT INTO link_generation (participant_id, universal_link, status, mailing_date, next_mail_due_at)
+        VALUES (?, ?, ?, datetime(?, 'unixepoch'), ?)
+    ''', link_rows())
+
+    masks = {}
+    for pid in registered:
+        done = rnd.randint(0, 4)
+        masks[pid] = sum(stage_bit(stage) for stage in STAGE_NUMBERS[:done])
+
+    counts['main'] = _insert(cursor, '''
+        INSERT INTO main (participant_id, telegram_id, telegram_username, role, quest_started, current_stage, stage_mask)
+        VALUES (?, ?, ?, 'user', 1, ?, ?)
+    ''', (
+        (pid, telegram_id_for(pid), f"runner{pid}", min(bin(masks[pid]).count('1') + 1, 4), masks[pid])
+        for pid in sorted(registered)
+    ))
+
+    counts['stage_progress'] = _insert(cursor, '''
+        INSERT INTO stage_progress (telegram_id, stage_number, completed_at)
+        VALUES (?, ?, datetime(?, 'unixepoch'))
+    ''', (
+        (telegram_id_for(pid), stage, now - rnd.randint(0, 30 * 86400))
+        for pid in sorted(registered) for stage in STAGE_NUMBERS if masks[pid] & stage_bit(stage)
+    ))
+
+    # user_id совпадает с порядком вставки в main
+    user_ids = {pid: user_id for user_id, pid in enumerate(sorted(registered), start=1)}
+
+    counts['user_data'] = _insert(cursor, '''
+        INSERT INTO user_data (user_id, quest_started, image_url, answer_text)
+        VALUES (?, 1, ?, ?)
+    ''', (
+        (user_ids[pid], f"images/{pid}_{n}.jpg", rnd.choice([None, 'ответ']))
+        for pid in sorted(registered) for n in range(rnd.randint(0, 3))
+    ))
+
+    counts['verification'] = _insert(cursor, '''
+        INSERT INTO verification (user_id, distance, run_date, answer_check)
+        VALUES (?, ?, ?, ?)
+    ''', (
+        (user_ids[pid], rnd.randint(1, 42), f"2025-11-{rnd.randint(1, 30):02d}", rnd.randint(0, 1))
+        for pid in sorted(registered) if rnd.random() < 0.5
+    ))
+
+    promo_total = int(participants * PROMO_CODES_SHARE)
+    registered_list = sorted(registered)
+
+    def promo_rows():
+        for n in range(1, promo_total + 1):
+            if registered_list and rnd.random() < PROMO_USED_SHARE:
+                pid = rnd.choice(registered_list)
+                yield (f"PROMO{n:08d}", 'used', telegram_id_for(pid), f"runner{pid}")
+            else:
+                yield (f"PROMO{n:08d}", 'active', None, None)
+
+    counts['promo_codes'] = _insert(cursor, '''
+        INSERT INTO promo_codes (promo_code, status, sent_to_telegram_id, sent_to_username)
+        VALUES (?, ?, ?, ?)
+    ''', promo_rows())
+
+    counts['raffle_participants'] = _insert(cursor, '''
+        INSERT INTO raffle_participants (telegram_id, telegram_username, raffle_id)
+        VALUES (?, ?, NULL)
+    ''', (
+        (telegram_id_for(pid), f"runner{pid}")
+        for pid in registered_list if rnd.random() < RAFFLE_SHARE
+    ))
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетической базы для бенчмарков")
+    parser.add_argument('--participants', type=int, default=10000, help="число участников (10k-1M)")
+    parser.add_argument('--db', default='bench_runners.db', help="путь к создаваемой базе")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = generate_dataset(args.db, args.participants, args.seed)
+    print(f"✅ База {args.db} создана за {time.perf_counter() - started:.1f} с")
+    for table, count in counts.items():
+        print(f"  {table}: {count}")
+
+
+if __name__ == "__main__":
+    main()
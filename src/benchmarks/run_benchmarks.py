@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Замеры горячих запросов бота на синтетической базе.
+
+Сценарии повторяют то, что делают обработчики: переход по персональной
+ссылке, выборка получателей рассылки, проверка пройденных этапов,
+выдача промокода, отчеты /get_link_stats и /data_stats. Для каждого
+сценария считаются p50/p99 задержки и пропускная способность, результат
+пишется в JSON, чтобы сравнивать прогоны между изменениями схемы.
+
+    python -m benchmarks.run_benchmarks --participants 100000 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.dataset import generate_dataset, link_for, TELEGRAM_ID_BASE
+from database import Database, ReadCache
+
+# Новые пользователи, которые переходят по ссылкам во время замера
+NEW_TELEGRAM_ID_BASE = TELEGRAM_ID_BASE * 10
+
+# Запросы отчетов скопированы из обработчиков (handlers импортируют aiogram)
+LINK_STATS_SQL = '''
+    SELECT
+        COUNT(*) as total_users,
+        SUM(CASE WHEN lg.participant_id IS NOT NULL THEN 1 ELSE 0 END) as users_with_links,
+        SUM(CASE WHEN lg.status = 1 THEN 1 ELSE 0 END) as active_links,
+        SUM(CASE WHEN lg.status = 0 THEN 1 ELSE 0 END) as used_links,
+        SUM(CASE WHEN m.participant_id IS NOT NULL THEN 1 ELSE 0 END) as registered_users,
+        SUM(CASE WHEN lg.mailing_date IS NULL AND lg.status = 1 THEN 1 ELSE 0 END) as pending_mailing
+    FROM manual_upload mu
+    LEFT JOIN link_generation lg ON mu.participant_id = lg.participant_id
+    LEFT JOIN main m ON mu.participant_id = m.participant_id
+'''
+
+DATA_STATS_SQL = [
+    "SELECT COUNT(*) FROM manual_upload",
+    "SELECT COUNT(DISTINCT email) FROM manual_upload",
+    '''
+    SELECT s.stage_name, COUNT(m.participant_id)
+    FROM manual_upload m
+    JOIN stages s ON m.stage_id = s.stage_id
+    GROUP BY s.stage_name
+    ORDER BY s.stage_id
+    '''
+]
+
+# Статистика по дням регистрации из /data_stats вынесена отдельно:
+# ошибка в ней не должна скрывать замеры остальных запросов отчета
+DATA_STATS_BY_DAY_SQL = '''
+    SELECT DATE(registration_date), COUNT(*)
+    FROM manual_upload
+    WHERE registration_date IS NOT NULL
+    GROUP BY DATE(registration_date)
+    ORDER BY DATE(registration_date) DESC
+    LIMIT 7
+'''
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def run_scenario(name: str, operation, iterations: int) -> dict:
+    """Выполнение operation(i) iterations раз; operation возвращает число обработанных строк"""
+    timings = []
+    rows = 0
+    errors = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        op_started = time.perf_counter()
+        try:
+            rows += operation(i) or 0
+        except Exception as e:
+            errors.append(str(e))
+            if len(errors) >= 3:
+                break
+            continue
+        timings.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    result = {
+        'iterations': len(timings),
+        'p50_ms': round(_percentile(timings, 50) * 1000, 3),
+        'p99_ms': round(_percentile(timings, 99) * 1000, 3),
+        'mean_ms': round(statistics.mean(timings) * 1000, 3) if timings else 0.0,
+        'ops_per_sec': round(len(timings) / elapsed, 1) if elapsed and timings else 0.0,
+        'rows': rows,
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else 0.0
+    }
+    if errors:
+        result['errors'] = sorted(set(errors))
+
+    status = "❌" if errors and not timings else "✅"
+    print(f"{status} {name}: p50={result['p50_ms']} мс, p99={result['p99_ms']} мс, "
+          f"{result['ops_per_sec']} оп/с, {result['rows_per_sec']} строк/с")
+    return result
+
+
+def _active_participants(bench_db: Database, limit: int, rnd: random.Random) -> list:
+    """participant_id с неиспользованными ссылками"""
+    with bench_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT participant_id FROM link_generation WHERE status = 1")
+        ids = [row[0] for row in cursor.fetchall()]
+    return rnd.sample(ids, min(limit, len(ids)))
+
+
+def _registered_telegram_ids(bench_db: Database, limit: int, rnd: random.Random) -> list:
+    with bench_db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT telegram_id FROM main WHERE telegram_id IS NOT NULL")
+        ids = [row[0] for row in cursor.fetchall()]
+    return rnd.sample(ids, min(limit, len(ids)))
+
+
+def run_benchmarks(bench_db: Database, iterations: int, seed: int = 42) -> dict:
+    """Прогон всех сценариев на открытой базе"""
+    rnd = random.Random(seed)
+    results = {}
+
+    # Переход по ссылке: handle_link_click -> register_by_link
+    participants = _active_participants(bench_db, iterations, rnd)
+
+    def register(i):
+        result = bench_db.register_by_link(
+            link_for(participants[i]), NEW_TELEGRAM_ID_BASE + participants[i], f"bench_{participants[i]}"
+        )
+        if result['status'] != 'registered':
+            raise RuntimeError(f"register_by_link: {result['status']}")
+        return 1
+
+    results['register_by_link'] = run_scenario('register_by_link', register, len(participants))
+
+    # Проверка пройденных этапов из global_handler
+    telegram_ids = _registered_telegram_ids(bench_db, iterations, rnd)
+    results['get_completed_stages'] = run_scenario(
+        'get_completed_stages',
+        lambda i: len(bench_db.get_completed_stages(telegram_ids[i])),
+        len(telegram_ids)
+    )
+
+    results['get_user_by_telegram_id'] = run_scenario(
+        'get_user_by_telegram_id',
+        lambda i: 1 if bench_db.get_user_by_telegram_id(telegram_ids[i]) else 0,
+        len(telegram_ids)
+    )
+
+    # Выдача промокодов из PromoCodeManager.get_and_assign_promo_code
+    def claim(i):
+        telegram_id = telegram_ids[i % len(telegram_ids)]
+        return 1 if bench_db.claim_promo_code(telegram_id, f"runner{telegram_id}") else 0
+
+    results['claim_promo_code'] = run_scenario('claim_promo_code', claim, iterations)
+
+    results['join_raffle'] = run_scenario(
+        'join_raffle',
+        lambda i: 1 if bench_db.join_raffle(telegram_ids[i], f"runner{telegram_ids[i]}") else 0,
+        len(telegram_ids)
+    )
+
+    # Выборка получателей рассылки выполняется целиком, поэтому итераций меньше
+    from mail_service import utils as mail_utils
+    original_db = mail_utils.db
+    mail_utils.db = bench_db
+    try:
+        def recipients(i):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return len(mail_utils.get_recipients_from_db())
+
+        results['get_recipients_from_db'] = run_scenario(
+            'get_recipients_from_db', recipients, max(1, iterations // 200)
+        )
+    finally:
+        mail_utils.db = original_db
+
+    def report(queries):
+        def operation(i):
+            rows = 0
+            with bench_db.get_connection() as conn:
+                cursor = conn.cursor()
+                for sql in queries:
+                    cursor.execute(sql)
+                    rows += len(cursor.fetchall())
+            return rows
+        return operation
+
+    results['link_stats'] = run_scenario('link_stats', report([LINK_STATS_SQL]), max(1, iterations // 100))
+    results['data_stats'] = run_scenario('data_stats', report(DATA_STATS_SQL), max(1, iterations // 100))
+    results['data_stats_by_day'] = run_scenario(
+        'data_stats_by_day', report([DATA_STATS_BY_DAY_SQL]), max(1, iterations // 100)
+    )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих запросов SQLite")
+    parser.add_argument('--participants', type=int, default=10000, help="число участников (10k-1M)")
+    parser.add_argument('--db', help="путь к базе; по умолчанию bench_<participants>.db")
+    parser.add_argument('--iterations', type=int, default=1000, help="итераций на точечный сценарий")
+    parser.add_argument('--output', default='benchmark_results.json', help="файл с результатами JSON")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--cache', action='store_true', help="не отключать кэш чтений")
+    args = parser.parse_args()
+
+    db_path = args.db or f"bench_{args.participants}.db"
+    generation_seconds = None
+    if not os.path.exists(db_path):
+        print(f"🔄 Генерация базы {db_path} на {args.participants} участников...")
+        started = time.perf_counter()
+        generate_dataset(db_path, args.participants, args.seed)
+        generation_seconds = round(time.perf_counter() - started, 2)
+
+    bench_db = Database(db_path)
+    if not args.cache:
+        # Замеряем обращения к SQLite, а не попадания в кэш
+        bench_db.cache = ReadCache(max_entries=0)
+
+    try:
+        results = run_benchmarks(bench_db, args.iterations, args.seed)
+    finally:
+        bench_db.close()
+
+    report = {
+        'metadata': {
+            'participants': args.participants,
+            'db_path': db_path,
+            'db_size_bytes': os.path.getsize(db_path),
+            'generation_seconds': generation_seconds,
+            'iterations': args.iterations,
+            'read_cache': args.cache,
+            'sqlite_version': sqlite3.sqlite_version,
+            'python_version': platform.python_version(),
+            'timestamp': datetime.now().isoformat(timespec='seconds')
+        },
+        'results': results
+    }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 Результаты сохранены в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
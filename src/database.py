@@ -1,215 +1,810 @@
 import sqlite3
 import logging
+import queue
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+import copy
+import contextlib
+import contextvars
+import csv
+import json
+import re
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
 
-class Database:
-    def __init__(self, db_path: str = 'runners.db'):
+import migrations
+import sharding
+from query_stats import TimedConnection, current_caller, query_stats
+
+# Настройки соединений пула (применяются один раз при создании соединения)
+POOL_SIZE = 5
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024  # 256 МБ
+CACHE_SIZE_KB = 16 * 1024  # 16 МБ страничного кэша на соединение
+
+# Групповой коммит: операции записи, пришедшие в течение окна, идут одной транзакцией
+WRITE_BATCH_WINDOW = 0.003  # секунды
+WRITE_BATCH_MAX = 100
+# Сколько вызывающий ждет COMMIT своей записи, прежде чем считать ее неудачной
+WRITE_TIMEOUT = 30  # секунды
+
+# Кэш горячих чтений по telegram_id
+READ_CACHE_MAX_ENTRIES = 4096
+READ_CACHE_TTL = 30  # секунды
+
+# Параметров в одном IN (...) для массовых операций (лимит SQLite - 32766)
+BULK_PARAMS_CHUNK = 500
+
+# Потоковые выгрузки CSV: строк за fetchmany и объем в памяти до сброса во временный файл
+EXPORT_FETCH_SIZE = 1000
+EXPORT_SPOOL_MAX_SIZE = 1024 * 1024
+
+# Этапы квеста, прогресс по которым хранится битовой маской main.stage_mask
+STAGE_NUMBERS = (1, 2, 3, 4)
+
+
+def stage_bit(stage_number: int) -> int:
+    """Бит этапа в маске прогресса"""
+    return 1 << (stage_number - 1)
+
+
+def stages_from_mask(mask: int) -> list:
+    """Список номеров завершенных этапов по маске"""
+    return [stage_number for stage_number in STAGE_NUMBERS if mask & stage_bit(stage_number)]
+
+
+# Поиск участников (/find): не больше результатов и минимальная длина цифр телефона
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_PHONE_MIN_DIGITS = 5
+# Больше совпадений не ранжируем по bm25 (ранжирование читает их все):
+# берем первые по rowid, и администратор уточняет запрос
+SEARCH_RANK_MAX_MATCHES = 2000
+_SEARCH_TOKEN = re.compile(r'\w+')
+
+# {order}: rank - лучшие совпадения по bm25, rowid - первые найденные.
+# Данные пользователя (main, verification) дочитываются из шардов отдельно
+_SEARCH_SQL = '''
+    SELECT mu.participant_id, mu.last_name, mu.first_name, mu.middle_name,
+           mu.email, mu.phone, mu.stage_id,
+           lg.universal_link, lg.status AS link_status, lg.mailing_date, lg.link_click_date
+    FROM (
+        SELECT rowid AS participant_id, rank
+        FROM participant_search
+        WHERE participant_search MATCH ?
+        ORDER BY {order}
+        LIMIT ?
+    ) AS found
+    JOIN manual_upload mu ON mu.participant_id = found.participant_id
+    LEFT JOIN link_generation lg ON lg.participant_id = mu.participant_id
+    ORDER BY found.rank
+'''
+SEARCH_RANKED_SQL = _SEARCH_SQL.format(order='rank')
+SEARCH_FIRST_SQL = _SEARCH_SQL.format(order='rowid')
+SEARCH_USER_FIELDS = (
+    'user_id', 'telegram_id', 'telegram_username', 'current_stage', 'stage_mask',
+    'distance', 'run_date', 'answer_check'
+)
+
+
+def build_search_query(text: str) -> str:
+    """Запрос FTS5 MATCH из ввода администратора (None - искать нечего).
+
+    Слова ищутся по префиксу во всех колонках и объединяются через AND.
+    Цифры и знаки телефона ищутся только по телефону (номер с 7/8 в начале -
+    по последним 10 цифрам), email - по части до @ в колонке email,
+    @username - в колонке username.
+    """
+    text = text.strip().replace('ё', 'е').replace('Ё', 'Е')
+    if re.fullmatch(r'[\d\s()+\-]+', text):
+        digits = re.sub(r'\D', '', text)
+        if len(digits) >= SEARCH_PHONE_MIN_DIGITS:
+            if len(digits) == 11 and digits[0] in '78':
+                digits = digits[1:]
+            return f'phone : "{digits}"*'
+
+    column = None
+    if text.startswith('@'):
+        column = 'username'
+    elif '@' in text:
+        # Домен почты есть почти у всех, по нему не ищем
+        column = 'email'
+        text = text.split('@', 1)[0]
+
+    tokens = _SEARCH_TOKEN.findall(text)
+    if not tokens:
+        return None
+    query = ' AND '.join(f'"{token}"*' for token in tokens)
+    return f'{column} : ({query})' if column else query
+
+def _write_csv(cursor, out, header: list) -> int:
+    """Запись результата запроса в CSV порциями fetchmany, возвращает число строк"""
+    writer = csv.writer(out, delimiter=';', lineterminator='\n')
+    writer.writerow(header)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return count
+        writer.writerows(rows)
+        count += len(rows)
+
+
+def _spool_csv(write) -> tuple:
+    """CSV во временном файле: (файл с позицией в начале, число строк) или (None, 0)"""
+    out = tempfile.SpooledTemporaryFile(
+        max_size=EXPORT_SPOOL_MAX_SIZE, mode='w+', encoding='utf-8', newline=''
+    )
+    count = write(out)
+    if count < 0:
+        out.close()
+        return None, 0
+    out.seek(0)
+    return out, count
+
+
+class PooledConnection:
+    """Обертка над соединением из пула.
+
+    Ведет себя как sqlite3.Connection: `with db.get_connection() as conn`
+    коммитит или откатывает транзакцию, а затем возвращает соединение в пул
+    (вместо того чтобы оставлять его открытым). close() также возвращает
+    соединение в пул.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', conn: sqlite3.Connection):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        conn = object.__getattribute__(self, '_conn')
+        if conn is None:
+            raise sqlite3.ProgrammingError("Соединение уже возвращено в пул")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        # row_factory, isolation_level и т.п. пробрасываем в реальное соединение
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self._conn is not None:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+        finally:
+            self.close()
+        return False
+
+    def close(self):
+        """Возвращает соединение в пул"""
+        conn = object.__getattribute__(self, '_conn')
+        if conn is not None:
+            object.__setattr__(self, '_conn', None)
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite в режиме WAL.
+
+    Держит фиксированное число соединений, PRAGMA настраиваются один раз при
+    открытии. Если все соединения заняты (например, обработчик держит
+    соединение через await), выдается временное соединение сверх пула, чтобы
+    не блокировать event loop; оно закрывается при возврате.
+
+    setup(conn) вызывается для каждого нового соединения после PRAGMA
+    (подключение шардов или основного файла, см. sharding.py).
+    """
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE, setup=None):
         self.db_path = db_path
-        self.init_db()
+        self.size = size
+        self.setup = setup
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._overflow = set()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие и настройка нового соединения"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            factory=TimedConnection
+        )
+        # Действует только для новой базы; существующие переводит maintenance.py
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Получение соединения из пула"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Пул соединений закрыт")
 
-    def init_db(self):
-        """Инициализация базы данных и создание таблиц"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Таблица 4: Этапы (создаем первой из-за внешних ключей)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS stages (
-                        stage_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        stage_name TEXT NOT NULL UNIQUE
-                    )
-                ''')
-                
-                # Таблица 1: Ручная загрузка
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS manual_upload (
-                        participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        last_name TEXT NOT NULL,
-                        first_name TEXT NOT NULL,
-                        middle_name TEXT,
-                        email TEXT NOT NULL,
-                        phone INTEGER NOT NULL,
-                        stage_id INTEGER NOT NULL,
-                        FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
-                    )
-                ''')
-                
-                # Таблица 2: Формирование ссылки
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS link_generation (
-                        participant_id INTEGER PRIMARY KEY,
-                        universal_link TEXT NOT NULL UNIQUE,
-                        status INTEGER DEFAULT 0 CHECK(status IN (0, 1)),
-                        creation_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        mailing_date DATETIME,
-                        link_click_date DATETIME,
-                        FOREIGN KEY (participant_id) REFERENCES manual_upload(participant_id)
-                    )
-                ''')
-                
-                # Таблица 3: Основная 
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS main (
-                        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        participant_id INTEGER UNIQUE,
-                        telegram_id INTEGER UNIQUE,
-                        telegram_username TEXT,
-                        role TEXT NOT NULL CHECK(role IN ('admin', 'moderator', 'user')),
-                        quest_started INTEGER DEFAULT 0 CHECK(quest_started IN (0, 1)),
-                        quest_started_at DATETIME,
-                        current_stage INTEGER DEFAULT 1,
-                        stage_1_completed INTEGER DEFAULT 0 CHECK(stage_1_completed IN (0, 1)),
-                        stage_2_completed INTEGER DEFAULT 0 CHECK(stage_2_completed IN (0, 1)),
-                        stage_3_completed INTEGER DEFAULT 0 CHECK(stage_3_completed IN (0, 1)),
-                        stage_4_completed INTEGER DEFAULT 0 CHECK(stage_4_completed IN (0, 1)),
-                        registration_date DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # Таблица 5: Суть этапа
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS stage_content (
-                        stage_id INTEGER NOT NULL,
-                        message_id INTEGER NOT NULL,
-                        order_number INTEGER NOT NULL,
-                        message_text TEXT,
-                        has_image INTEGER DEFAULT 0 CHECK(has_image IN (0, 1)),
-                        image_url TEXT,
-                        has_video INTEGER DEFAULT 0 CHECK(has_video IN (0, 1)),
-                        video_url TEXT,
-                        has_feedback INTEGER DEFAULT 0 CHECK(has_feedback IN (0, 1)),
-                        puzzle_check TEXT,
-                        PRIMARY KEY (stage_id, message_id),
-                        FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
-                    )
-                ''')
-                
-                # Таблица 6: Данные пользователя (обновленная структура)
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS user_data (
-                        data_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        quest_started INTEGER DEFAULT 0 CHECK(quest_started IN (0, 1)),
-                        image_url TEXT,
-                        answer_text TEXT,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES main(user_id)
-                    )
-                ''')
-                
-                # Таблица 7: Проверка
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS verification (
-                        user_id INTEGER PRIMARY KEY,
-                        distance INTEGER NOT NULL,
-                        run_date DATE NOT NULL,
-                        answer_check INTEGER DEFAULT 0 CHECK(answer_check IN (0, 1)),
-                        FOREIGN KEY (user_id) REFERENCES main(user_id)
-                    )
-                ''')
-                
-                # Таблица 8: Участники розыгрыша
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS raffle_participants (
-                        raffle_participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        telegram_id INTEGER NOT NULL,
-                        telegram_username TEXT,
-                        participation_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        raffle_id INTEGER,
-                        FOREIGN KEY (telegram_id) REFERENCES main(telegram_id),
-                        UNIQUE(telegram_id, raffle_id)
-                    )
-                ''')
-                
-                # ✅ ТАБЛИЦА 9: Адреса пользователей
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS user_addresses (
-                        address_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        telegram_id INTEGER NOT NULL,
-                        telegram_username TEXT,
-                        stage INTEGER NOT NULL DEFAULT 1,
-                        address TEXT NOT NULL,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (telegram_id) REFERENCES main(telegram_id),
-                        UNIQUE(telegram_id, stage)
-                    )
-                ''')
-                
-                # ✅ ТАБЛИЦА 10: Промокоды
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS promo_codes (
-                        promo_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        promo_code TEXT NOT NULL UNIQUE,
-                        status TEXT NOT NULL DEFAULT 'active' CHECK(status IN ('active', 'used', 'expired')),
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        sent_at DATETIME,
-                        sent_to_telegram_id INTEGER,
-                        sent_to_username TEXT,
-                        FOREIGN KEY (sent_to_telegram_id) REFERENCES main(telegram_id)
-                    )
-                ''')
-                
-                # Создание индексов
-                self._create_indexes(cursor)
-                
-                conn.commit()
-                logging.info("База данных успешно инициализирована")
-                
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            pooled = self._created < self.size
+            if pooled:
+                self._created += 1
+
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            if pooled:
+                with self._lock:
+                    self._created -= 1
+            raise
+
+        if not pooled:
+            with self._lock:
+                self._overflow.add(id(conn))
+            logging.warning(f"Пул соединений исчерпан ({self.size}), открыто временное соединение")
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Возврат соединения в пул"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
         except sqlite3.Error as e:
-            logging.error(f"Ошибка инициализации базы данных: {e}")
+            logging.error(f"Ошибка сброса соединения при возврате в пул: {e}")
+            self._discard(conn)
+            return
+
+        with self._lock:
+            is_overflow = id(conn) in self._overflow
+        if is_overflow or self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn: sqlite3.Connection):
+        """Закрытие соединения, которое не возвращается в пул"""
+        with self._lock:
+            if id(conn) in self._overflow:
+                self._overflow.discard(id(conn))
+            else:
+                self._created -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def connection(self) -> PooledConnection:
+        """Соединение-обертка для использования в `with`"""
+        return PooledConnection(self, self.acquire())
+
+    def reset(self):
+        """Закрытие простаивающих соединений (новые откроются с текущим setup)"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def close_all(self):
+        """Закрытие всех простаивающих соединений"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+        logging.info("Пул соединений с базой данных закрыт")
+
+    def stats(self) -> dict:
+        """Состояние пула"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'idle': self._idle.qsize(),
+                'overflow': len(self._overflow)
+            }
+
+
+class ReadCache:
+    """LRU-кэш с TTL для горячих чтений по telegram_id.
+
+    Ключ — кортеж, первый элемент которого telegram_id; это позволяет
+    сбросить все записи пользователя одним вызовом invalidate(). Значение,
+    загруженное во время конкурентного сброса, не кэшируется (проверка по
+    счетчику поколений), чтобы не вернуть устаревшие данные после записи.
+    """
+
+    def __init__(self, max_entries: int = READ_CACHE_MAX_ENTRIES, ttl: float = READ_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key: tuple, loader):
+        """Значение из кэша или результат loader() с сохранением в кэш"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.copy(entry[1])
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(key)
+                self._by_user.setdefault(key[0], set()).add(key)
+                while len(self._entries) > self.max_entries:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return copy.copy(value)
+
+    def _remove(self, key: tuple):
+        self._entries.pop(key, None)
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+    def invalidate(self, telegram_id: int):
+        """Сброс всех записей пользователя"""
+        with self._lock:
+            self._generation += 1
+            for key in self._by_user.pop(telegram_id, ()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Полный сброс кэша (массовые изменения)"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0
+            }
+
+
+_STOP = object()
+
+
+def wait_write(future: Future, timeout: float = WRITE_TIMEOUT):
+    """Ожидание результата записи.
+
+    Операция, которую писатель не начал за timeout секунд, снимается с
+    очереди и считается неудачной (sqlite3.OperationalError), как и ошибка
+    самой записи, - обработчики ловят sqlite3.Error. Операция, которую
+    писатель уже начал, отменить нельзя: ее пачка может быть закоммичена,
+    поэтому ожидание продолжается до настоящего результата - вызывающий
+    никогда не получает ошибку для записи, которая на самом деле выполнена.
+    """
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise sqlite3.OperationalError(f"Запись не начата за {timeout} с и отменена")
+    logging.warning(f"Запись выполняется дольше {timeout} с, ожидаем ее результат")
+    return future.result()
+
+
+class DatabaseWriter:
+    """Единственный писатель в базу (актор с групповым коммитом).
+
+    Владеет единственным соединением для записи и выполняет операции из
+    очереди в отдельном потоке. Операции, пришедшие в течение batch_window
+    секунд, выполняются в одной транзакции (каждая в своем SAVEPOINT, чтобы
+    ошибка одной не откатывала остальные). Результат каждой операции
+    возвращается через Future после COMMIT.
+
+    Операция — функция, принимающая cursor; она не должна вызывать commit()
+    и другие методы записи Database.
+
+    begin — команда начала транзакции. BEGIN IMMEDIATE блокирует запись во
+    все подключенные файлы сразу, поэтому писатели соединений с ATTACH
+    (шардирование) начинают транзакцию обычным BEGIN.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_window: float = WRITE_BATCH_WINDOW,
+                 max_batch: int = WRITE_BATCH_MAX, begin: str = 'BEGIN IMMEDIATE', name: str = 'db-writer'):
+        self._pool = pool
+        self.begin = begin
+        self.name = name
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        # Ошибка открытия соединения: писатель не работает, записи отклоняются сразу
+        self.failed = None
+        self.batches = 0
+        self.operations = 0
+        self.failed_batches = 0
+
+    def _ensure_started(self):
+        """Ленивый запуск потока писателя"""
+        with self._lock:
+            if self.failed is not None:
+                return
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    @property
+    def started(self) -> bool:
+        """Поток писателя уже запускался"""
+        return self._thread is not None
+
+    def submit(self, func) -> Future:
+        """Постановка операции записи в очередь"""
+        future = Future()
+        if self._stopped:
+            future.set_exception(sqlite3.ProgrammingError("Писатель базы данных остановлен"))
+            return future
+        if threading.current_thread() is self._thread:
+            future.set_exception(RuntimeError("Вложенная запись из потока писателя"))
+            return future
+        # Контекст вызывающего (current_caller) нужен журналу медленных запросов
+        item = (functools.partial(contextvars.copy_context().run, func), future)
+        self._ensure_started()
+        with self._lock:
+            # Проверка и постановка под блокировкой: упавший поток не оставит операцию в очереди
+            if self.failed is not None:
+                future.set_exception(sqlite3.OperationalError(f"Писатель базы данных не работает: {self.failed}"))
+                return future
+            self._queue.put(item)
+        return future
+
+    def _fail_queued(self, error: Exception):
+        """Отклонение всех операций, оставшихся в очереди"""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP and not item[1].done():
+                item[1].set_exception(error)
+
+    def _run(self):
+        """Основной цикл писателя"""
+        try:
+            conn = self._pool._connect()
+        except Exception as e:
+            logging.error(f"Ошибка открытия соединения писателя {self.name}: {e}")
+            with self._lock:
+                self.failed = e
+            self._fail_queued(e)
+            return
+        conn.isolation_level = None  # транзакциями управляем вручную
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+
+                batch = [item]
+                stop = False
+                deadline = time.monotonic() + self.batch_window
+                while len(batch) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+
+                try:
+                    self._execute_batch(conn, batch)
+                except Exception as e:
+                    # Ошибка пачки не должна останавливать писателя
+                    logging.error(f"Ошибка пачки записи {self.name}: {e}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                if stop:
+                    break
+        finally:
+            conn.close()
+
+    def _execute_batch(self, conn: sqlite3.Connection, batch: list):
+        """Выполнение пачки операций в одной транзакции.
+
+        Любая ошибка SAVEPOINT, COMMIT или ROLLBACK откатывает пачку и
+        завершает ошибкой все еще не завершенные Future пачки.
+        """
+        batch = [(func, future) for func, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            outcomes = self._run_operations(conn, batch)
+            if not conn.in_transaction:
+                raise sqlite3.OperationalError("Транзакция записи была прервана")
+            conn.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"Ошибка пачки из {len(batch)} операций записи: {e}")
+            self.failed_batches += 1
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error as rollback_error:
+                logging.error(f"Ошибка отката пачки записи: {rollback_error}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.operations += len(outcomes)
+        for future, value, failed in outcomes:
+            if failed:
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+    def _run_operations(self, conn: sqlite3.Connection, batch: list) -> list:
+        """Операции пачки, каждая в своем SAVEPOINT; возвращает [(future, результат, ошибка ли)]"""
+        conn.execute(self.begin)
+        cursor = conn.cursor()
+        outcomes = []
+        for func, future in batch:
+            cursor.execute("SAVEPOINT write_op")
+            try:
+                result = func(cursor)
+            except Exception as e:
+                if conn.in_transaction:
+                    cursor.execute("ROLLBACK TO write_op")
+                    cursor.execute("RELEASE write_op")
+                outcomes.append((future, e, True))
+                if not conn.in_transaction:
+                    # SQLite откатил всю транзакцию - предыдущие операции потеряны
+                    break
+            else:
+                cursor.execute("RELEASE write_op")
+                outcomes.append((future, result, False))
+        return outcomes
+
+    def stop(self):
+        """Остановка писателя после выполнения уже поставленных операций"""
+        self._stopped = True
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def stats(self) -> dict:
+        """Статистика группового коммита"""
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'failed_batches': self.failed_batches,
+            'queued': self._queue.qsize()
+        }
+
+
+class Database:
+    def __init__(self, db_path: str = 'runners.db', pool_size: int = POOL_SIZE):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.writer = DatabaseWriter(self.pool)
+        self.cache = ReadCache()
+        # Время выполнения запросов и журнал медленных запросов (общие для процесса)
+        self.query_stats = query_stats
+        # Реплика для отчетов (snapshots.DatabaseSnapshotter), подключается при запуске бота
+        self.snapshots = None
+        # Плановое обслуживание (maintenance.DatabaseMaintenance), подключается при запуске бота
+        self.maintenance = None
+        # Архив user_data и verification (retention.DataRetention), подключается при запуске бота
+        self.retention = None
+        # Колоночный снимок участников для статистики (analytics.ParticipantAnalytics)
+        self.analytics = None
+        # Шарды пользовательских таблиц (sharding.py), включаются configure_shards()
+        self.shard_paths = []
+        self.shard_pools = []
+        self.shard_writers = []
+        # Реплики и обслуживание шардов, подключаются при запуске бота
+        self.shard_snapshots = []
+        self.shard_maintenance = []
+        self._fan_out_executor = None
+        self.migrate()
+
+    # ---------- Шардирование ----------
+
+    def configure_shards(self, count: int) -> dict:
+        """Включение шардирования пользовательских таблиц по telegram_id.
+
+        Вызывается при запуске до первой записи. Файлы шардов создаются
+        рядом с основной базой, их схема догоняет основную, пользователи из
+        основного файла переносятся в шарды. Возвращает {таблица: перенесено}.
+        """
+        if count <= 1:
+            return {}
+        if count > sharding.MAX_SHARDS:
+            raise ValueError(f"Шардов не больше {sharding.MAX_SHARDS}, запрошено {count}")
+        if self.shard_paths or self.writer.started:
+            raise RuntimeError("Шардирование включается один раз до первой записи")
+
+        paths = [sharding.shard_path(self.db_path, index) for index in range(count)]
+        if os.path.exists(sharding.shard_path(self.db_path, count)):
+            raise RuntimeError(f"Найден шард {count}: число шардов нельзя уменьшать")
+        for index, path in enumerate(paths):
+            conn = sqlite3.connect(path, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                sharding.attach_shared(conn, self.db_path)
+                sharding.sync_shard_schema(conn, index)
+                # Пользователи уже распределены по другому числу шардов
+                row = conn.execute("SELECT telegram_id FROM main.main WHERE telegram_id IS NOT NULL LIMIT 1").fetchone()
+                if row and sharding.shard_for_telegram_id(row[0], count) != index:
+                    raise RuntimeError(f"Шард {path} заполнен при другом числе шардов")
+            finally:
+                conn.close()
+        moved = sharding.distribute_rows(self.db_path, paths)
+
+        self.shard_paths = paths
+        for index, path in enumerate(paths):
+            pool = ConnectionPool(
+                path, self.pool.size, setup=functools.partial(sharding.attach_shared, global_path=self.db_path)
+            )
+            self.shard_pools.append(pool)
+            self.shard_writers.append(DatabaseWriter(pool, begin='BEGIN', name=f'db-writer-shard{index}'))
+
+        # Соединения основной базы видят пользователей всех шардов через представления
+        self.pool.setup = functools.partial(sharding.attach_shards, paths=paths)
+        self.pool.reset()
+        self.writer.begin = 'BEGIN'
+        self._fan_out_executor = ThreadPoolExecutor(max_workers=count, thread_name_prefix='db-shard')
+        self.cache.clear()
+        logging.info(f"Шардирование включено: {count} шардов {paths}")
+        return moved
+
+    @property
+    def shard_count(self) -> int:
+        """Число шардов (0 - шардирование выключено)"""
+        return len(self.shard_paths)
+
+    def shards(self) -> list:
+        """Номера шардов для fan_out ([None] без шардирования)"""
+        return list(range(self.shard_count)) or [None]
+
+    def shard_of(self, telegram_id: int):
+        """Шард пользователя или None без шардирования"""
+        if not self.shard_paths:
+            return None
+        return sharding.shard_for_telegram_id(telegram_id, self.shard_count)
+
+    def shard_of_user(self, user_id: int):
+        """Шард по user_id или None без шардирования"""
+        if not self.shard_paths:
+            return None
+        return sharding.shard_for_user_id(user_id)
+
+    def writer_for(self, shard: int = None) -> DatabaseWriter:
+        """Писатель шарда (None - основной базы)"""
+        return self.writer if shard is None else self.shard_writers[shard]
+
+    def write(self, func, invalidate: int = None, shard: int = None):
+        """Выполнение операции записи через единственного писателя.
+
+        func(cursor) выполняется в общей транзакции с другими записями,
+        метод блокируется до COMMIT и возвращает результат func.
+        invalidate — telegram_id, чьи записи в кэше чтений сбрасываются
+        после COMMIT. shard — номер шарда (shard_of), None - основная база.
+        """
+        try:
+            return wait_write(self.writer_for(shard).submit(func))
+        finally:
+            if invalidate is not None:
+                self.cache.invalidate(invalidate)
+
+    def write_shards(self, func) -> list:
+        """Запись func(cursor) во все шарды параллельно, результаты по шардам.
+
+        Без шардирования - одна запись в основную базу.
+        """
+        if not self.shard_paths:
+            return [self.write(func)]
+        futures = [writer.submit(func) for writer in self.shard_writers]
+        return [wait_write(future) for future in futures]
 
-    def _create_indexes(self, cursor):
-        """Создание индексов для оптимизации"""
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_manual_upload_email ON manual_upload(email)",
-            "CREATE INDEX IF NOT EXISTS idx_manual_upload_stage ON manual_upload(stage_id)",
-            "CREATE INDEX IF NOT EXISTS idx_link_generation_status ON link_generation(status)",
-            "CREATE INDEX IF NOT EXISTS idx_main_telegram_id ON main(telegram_id)",
-            "CREATE INDEX IF NOT EXISTS idx_main_role ON main(role)",
-            "CREATE INDEX IF NOT EXISTS idx_main_current_stage ON main(current_stage)", 
-            "CREATE INDEX IF NOT EXISTS idx_main_stage_1_completed ON main(stage_1_completed)",
-            "CREATE INDEX IF NOT EXISTS idx_main_stage_2_completed ON main(stage_2_completed)",
-            "CREATE INDEX IF NOT EXISTS idx_main_stage_3_completed ON main(stage_3_completed)",
-            "CREATE INDEX IF NOT EXISTS idx_main_stage_4_completed ON main(stage_4_completed)",
-            "CREATE INDEX IF NOT EXISTS idx_stage_content_stage ON stage_content(stage_id)",
-            "CREATE INDEX IF NOT EXISTS idx_stage_content_order ON stage_content(order_number)",
-            "CREATE INDEX IF NOT EXISTS idx_user_data_user ON user_data(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_user_data_quest ON user_data(quest_started)",
-            "CREATE INDEX IF NOT EXISTS idx_verification_date ON verification(run_date)",
-            "CREATE INDEX IF NOT EXISTS idx_raffle_participants_telegram ON raffle_participants(telegram_id)",
-            "CREATE INDEX IF NOT EXISTS idx_raffle_participants_date ON raffle_participants(participation_date)",
-            "CREATE INDEX IF NOT EXISTS idx_raffle_participants_raffle ON raffle_participants(raffle_id)",
-            # ✅ ИНДЕКСЫ ДЛЯ ТАБЛИЦЫ АДРЕСОВ
-            "CREATE INDEX IF NOT EXISTS idx_user_addresses_telegram ON user_addresses(telegram_id)",
-            "CREATE INDEX IF NOT EXISTS idx_user_addresses_stage ON user_addresses(stage)",
-            # ✅ ИНДЕКСЫ ДЛЯ ТАБЛИЦЫ ПРОМОКОДОВ
-            "CREATE INDEX IF NOT EXISTS idx_promo_codes_code ON promo_codes(promo_code)",
-            "CREATE INDEX IF NOT EXISTS idx_promo_codes_status ON promo_codes(status)",
-            "CREATE INDEX IF NOT EXISTS idx_promo_codes_sent_to ON promo_codes(sent_to_telegram_id)"
+    def fan_out(self, read) -> list:
+        """Чтение read(conn, shard) со всех шардов параллельно, результаты по шардам.
+
+        Без шардирования - один вызов read(conn, None) на соединении основной базы.
+        """
+        if not self.shard_paths:
+            with self.get_connection() as conn:
+                return [read(conn, None)]
+
+        def run(shard):
+            with self.get_connection(shard) as conn:
+                return read(conn, shard)
+
+        futures = [
+            self._fan_out_executor.submit(contextvars.copy_context().run, run, shard)
+            for shard in range(self.shard_count)
         ]
-        
-        for index_sql in indexes:
-            cursor.execute(index_sql)
+        return [future.result() for future in futures]
+
+    def migrate(self) -> int:
+        """Проверка версии схемы и применение недостающих миграций"""
+        try:
+            with self.get_connection() as conn:
+                return migrations.migrate(conn)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка инициализации базы данных: {e}")
+            return 0
 
     # ✅ МЕТОДЫ ДЛЯ РАБОТЫ С ПРОМОКОДАМИ
 
     def add_promo_code(self, promo_code: str) -> bool:
         """Добавление нового промокода"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 cursor.execute('''
                     INSERT INTO promo_codes (promo_code, status)
                     VALUES (?, 'active')
                 ''', (promo_code.strip().upper(),))
                 
-                conn.commit()
                 logging.info(f"Промокод добавлен: {promo_code}")
                 return True
-                
+
+            return self.write(_write)
+
         except sqlite3.IntegrityError:
             logging.warning(f"Промокод уже существует: {promo_code}")
             return False
@@ -219,13 +814,11 @@ class Database:
 
     def add_promo_codes_batch(self, promo_codes: list) -> tuple:
         """Добавление нескольких промокодов"""
-        added = 0
-        skipped = 0
-        
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
+                added = 0
+                skipped = 0
+
                 for promo_code in promo_codes:
                     code = promo_code.strip()
                     if not code:
@@ -241,10 +834,11 @@ class Database:
                         skipped += 1
                         logging.debug(f"Промокод уже существует: {code}")
                 
-                conn.commit()
                 logging.info(f"Добавлено промокодов: {added}, пропущено (дубликаты): {skipped}")
                 return added, skipped
-                
+
+            return self.write(_write)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка пакетного добавления промокодов: {e}")
             return 0, 0
@@ -252,7 +846,7 @@ class Database:
     def get_available_promo_code(self) -> str:
         """Получение доступного промокода"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 # ✅ ИСПРАВЛЕНИЕ: Правильная проверка NULL в SQLite
@@ -272,12 +866,49 @@ class Database:
             return None
 
 
+    def claim_promo_code(self, telegram_id: int, username: str = None) -> str:
+        """Атомарная выдача свободного промокода пользователю.
+
+        Выбор и отметка кода выполняются одним UPDATE ... RETURNING, поэтому
+        два одновременных запроса не получат один и тот же код.
+        """
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    UPDATE promo_codes
+                    SET status = 'used',
+                        sent_at = CURRENT_TIMESTAMP,
+                        sent_to_telegram_id = ?,
+                        sent_to_username = ?
+                    WHERE promo_id = (
+                        -- Без статистики планировщик выбирает индекс по status,
+                        -- частичный индекс дает первый свободный код за один шаг
+                        SELECT promo_id FROM promo_codes INDEXED BY idx_promo_codes_available
+                        WHERE status = 'active'
+                        AND sent_to_telegram_id IS NULL
+                        ORDER BY promo_id
+                        LIMIT 1
+                    )
+                    RETURNING promo_code
+                ''', (telegram_id, username))
+
+                result = cursor.fetchone()
+                if result:
+                    logging.info(f"Промокод {result[0]} выдан пользователю {telegram_id}")
+                    return result[0]
+                logging.warning("Нет доступных промокодов")
+                return None
+
+            return self.write(_write)
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка выдачи промокода пользователю {telegram_id}: {e}")
+            return None
+
     def mark_promo_code_as_used(self, promo_code: str, telegram_id: int = None, username: str = None) -> bool:
         """Отметка промокода как использованного"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 # ✅ ИСПРАВЛЕНИЕ: Убираем .upper() - ищем как есть
                 cursor.execute('''
                     UPDATE promo_codes 
@@ -290,7 +921,6 @@ class Database:
                     AND sent_to_telegram_id IS NULL
                 ''', (telegram_id, username, promo_code.strip()))  # ✅ Убрали .upper()
                 
-                conn.commit()
                 if cursor.rowcount > 0:
                     logging.info(f"Промокод {promo_code} отмечен как использованный (пользователь: {telegram_id})")
                     return True
@@ -308,7 +938,9 @@ class Database:
                     else:
                         logging.warning(f"Промокод '{promo_code}' не найден в базе")
                     return False
-                    
+
+            return self.write(_write)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка отметки промокода как использованного: {e}")
             return False
@@ -318,7 +950,7 @@ class Database:
     def get_promo_code_info(self, promo_code: str) -> dict:
         """Получение информации о промокоде"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -348,7 +980,7 @@ class Database:
     def get_promo_codes_stats(self) -> dict:
         """Получение статистики по промокодам"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -375,7 +1007,7 @@ class Database:
     def get_all_promo_codes(self, status: str = None) -> list:
         """Получение всех промокодов"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
                 if status:
@@ -415,23 +1047,22 @@ class Database:
     def delete_promo_code(self, promo_code: str) -> bool:
         """Удаление промокода"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 # ✅ ИСПРАВЛЕНИЕ: Используем UPPER() для сравнения без учета регистра
                 cursor.execute('''
                     DELETE FROM promo_codes 
                     WHERE UPPER(promo_code) = UPPER(?)
                 ''', (promo_code.strip(),))
                 
-                conn.commit()
                 if cursor.rowcount > 0:
                     logging.info(f"Промокод {promo_code} удален")
                     return True
                 else:
                     logging.warning(f"Промокод {promo_code} не найден")
                     return False
-                    
+
+            return self.write(_write)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка удаления промокода: {e}")
             return False
@@ -440,21 +1071,21 @@ class Database:
     def delete_all_promo_codes(self) -> bool:
         """Удаление всех промокодов"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            def _write(cursor):
                 cursor.execute('DELETE FROM promo_codes')
-                conn.commit()
                 logging.info("Все промокоды удалены")
                 return True
-                
+
+            return self.write(_write)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка удаления всех промокодов: {e}")
             return False
 
-    def export_promo_codes_to_csv(self, status: str = None) -> str:
-        """Экспорт промокодов в CSV"""
+    def write_promo_codes_csv(self, out, status: str = None) -> int:
+        """Потоковая запись промокодов в CSV (текстовый поток), возвращает число строк или -1"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_report_connection() as conn:
                 cursor = conn.cursor()
                 
                 if status:
@@ -473,166 +1104,280 @@ class Database:
                         ORDER BY created_at DESC
                     ''')
                 
-                results = cursor.fetchall()
-                
-                if not results:
-                    return "Нет данных для экспорта"
-                
-                # Заголовки CSV
-                csv_data = "promo_code;status;created_at;sent_at;sent_to_telegram_id;sent_to_username\n"
-                
-                for result in results:
-                    promo_code, status, created_at, sent_at, sent_to_telegram_id, sent_to_username = result
-                    csv_data += f"{promo_code};{status};{created_at or ''};{sent_at or ''};{sent_to_telegram_id or ''};{sent_to_username or ''}\n"
-                
-                return csv_data
+                header = ['promo_code', 'status', 'created_at', 'sent_at', 'sent_to_telegram_id', 'sent_to_username']
+                return _write_csv(cursor, out, header)
                 
         except sqlite3.Error as e:
             logging.error(f"Ошибка экспорта промокодов в CSV: {e}")
-            return f"Ошибка экспорта: {e}"
+            return -1
+
+    def export_promo_codes_to_csv(self, status: str = None) -> tuple:
+        """Экспорт промокодов в CSV: (временный файл с позицией в начале, число строк).
+
+        Файл держится в памяти до EXPORT_SPOOL_MAX_SIZE, дальше пишется на
+        диск. При ошибке возвращает (None, 0).
+        """
+        return _spool_csv(lambda out: self.write_promo_codes_csv(out, status))
 
     # ✅ МЕТОДЫ ДЛЯ РАБОТЫ С ЗАВЕРШЕНИЕМ ЭТАПОВ
+    # Прогресс хранится битовой маской main.stage_mask (бит N-1 - этап N),
+    # время завершения каждого этапа - в таблице stage_progress.
 
     def mark_stage_completed(self, telegram_id: int, stage_number: int) -> bool:
         """Отмечает этап как завершенный"""
         try:
-            if stage_number not in [1, 2, 3, 4]:
+            if stage_number not in STAGE_NUMBERS:
                 logging.error(f"Некорректный номер этапа: {stage_number}")
                 return False
                 
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                column_name = f"stage_{stage_number}_completed"
-                cursor.execute(f'''
+            def _write(cursor):
+                cursor.execute('''
                     UPDATE main 
-                    SET {column_name} = 1 
+                    SET stage_mask = stage_mask | ? 
                     WHERE telegram_id = ?
-                ''', (telegram_id,))
+                ''', (stage_bit(stage_number), telegram_id))
                 
-                conn.commit()
                 if cursor.rowcount > 0:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO stage_progress (telegram_id, stage_number)
+                        VALUES (?, ?)
+                    ''', (telegram_id, stage_number))
                     logging.info(f"Этап {stage_number} отмечен как завершенный для пользователя {telegram_id}")
                     return True
                 else:
                     logging.warning(f"Пользователь {telegram_id} не найден")
                     return False
-                
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка отметки завершения этапа {stage_number} для пользователя {telegram_id}: {e}")
             return False
 
-    def is_stage_completed(self, telegram_id: int, stage_number: int) -> bool:
-        """Проверяет, завершен ли этап"""
+    def get_stage_mask(self, telegram_id: int) -> int:
+        """Битовая маска завершенных этапов пользователя (0 - ни одного)"""
         try:
-            if stage_number not in [1, 2, 3, 4]:
-                logging.error(f"Некорректный номер этапа: {stage_number}")
-                return False
-                
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                column_name = f"stage_{stage_number}_completed"
-                cursor.execute(f'''
-                    SELECT {column_name} FROM main 
-                    WHERE telegram_id = ?
-                ''', (telegram_id,))
-                
-                result = cursor.fetchone()
-                if result:
-                    return result[0] == 1
-                return False
-                
+            def _load():
+                with self.get_connection(self.shard_of(telegram_id)) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT stage_mask FROM main WHERE telegram_id = ?', (telegram_id,))
+                    result = cursor.fetchone()
+                    return result[0] if result else 0
+
+            return self.cache.get_or_load((telegram_id, 'stage_mask'), _load)
+
         except sqlite3.Error as e:
-            logging.error(f"Ошибка проверки завершения этапа {stage_number} для пользователя {telegram_id}: {e}")
+            logging.error(f"Ошибка получения прогресса этапов для пользователя {telegram_id}: {e}")
+            return 0
+
+    def is_stage_completed(self, telegram_id: int, stage_number: int) -> bool:
+        """Проверяет, завершен ли этап"""
+        if stage_number not in STAGE_NUMBERS:
+            logging.error(f"Некорректный номер этапа: {stage_number}")
             return False
+        return bool(self.get_stage_mask(telegram_id) & stage_bit(stage_number))
 
     def get_completed_stages(self, telegram_id: int) -> list:
         """Получает список завершенных этапов"""
+        return stages_from_mask(self.get_stage_mask(telegram_id))
+
+    def get_stage_progress(self, telegram_id: int) -> dict:
+        """Время завершения этапов пользователя: {номер этапа: completed_at}"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
                 cursor = conn.cursor()
-                
                 cursor.execute('''
-                    SELECT stage_1_completed, stage_2_completed, stage_3_completed, stage_4_completed
-                    FROM main 
+                    SELECT stage_number, completed_at FROM stage_progress
                     WHERE telegram_id = ?
+                    ORDER BY stage_number
                 ''', (telegram_id,))
-                
-                result = cursor.fetchone()
-                if result:
-                    completed_stages = []
-                    for i, completed in enumerate(result, start=1):
-                        if completed == 1:
-                            completed_stages.append(i)
-                    return completed_stages
-                return []
-                
+                return {stage_number: completed_at for stage_number, completed_at in cursor.fetchall()}
+
         except sqlite3.Error as e:
-            logging.error(f"Ошибка получения завершенных этапов для пользователя {telegram_id}: {e}")
-            return []
+            logging.error(f"Ошибка получения времени завершения этапов для пользователя {telegram_id}: {e}")
+            return {}
 
-    def reset_stage_completion(self, telegram_id: int, stage_number: int = None) -> bool:
-        """Сбрасывает отметку о завершении этапа"""
+    def get_stage_completion_counts(self) -> dict:
+        """Количество пользователей, завершивших каждый этап: {номер этапа: количество}"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            def _load(conn, shard):
                 cursor = conn.cursor()
-                
-                if stage_number:
-                    if stage_number not in [1, 2, 3, 4]:
-                        logging.error(f"Некорректный номер этапа: {stage_number}")
-                        return False
-                    
-                    column_name = f"stage_{stage_number}_completed"
-                    cursor.execute(f'''
-                        UPDATE main 
-                        SET {column_name} = 0 
-                        WHERE telegram_id = ?
-                    ''', (telegram_id,))
-                else:
-                    # Сбрасываем все этапы
-                    cursor.execute('''
-                        UPDATE main 
-                        SET stage_1_completed = 0,
-                            stage_2_completed = 0,
-                            stage_3_completed = 0,
-                            stage_4_completed = 0
-                        WHERE telegram_id = ?
-                    ''', (telegram_id,))
-                
-                conn.commit()
-                if cursor.rowcount > 0:
+                cursor.execute('''
+                    SELECT stage_number, COUNT(*) FROM stage_progress
+                    GROUP BY stage_number
+                ''')
+                return cursor.fetchall()
+
+            counts = {stage_number: 0 for stage_number in STAGE_NUMBERS}
+            for rows in self.fan_out(_load):
+                for stage_number, count in rows:
+                    counts[stage_number] = counts.get(stage_number, 0) + count
+            return counts
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения статистики завершения этапов: {e}")
+            return {}
+
+    def reset_stage_completion(self, telegram_id: int, stage_number: int = None) -> bool:
+        """Сбрасывает отметку о завершении этапа"""
+        updated = self.reset_stage_completion_bulk([telegram_id], stage_number)
+        if updated > 0:
+            if stage_number:
+                logging.info(f"Завершение этапа {stage_number} сброшено для пользователя {telegram_id}")
+            else:
+                logging.info(f"Все завершения этапов сброшены для пользователя {telegram_id}")
+            return True
+        if updated == 0:
+            logging.warning(f"Пользователь {telegram_id} не найден")
+        return False
+
+    def reset_stage_completion_bulk(self, telegram_ids: list = None, stage_number: int = None) -> int:
+        """Сброс завершения этапа (или всех этапов) одной транзакцией (в каждом шарде).
+
+        telegram_ids=None - для всех пользователей. Возвращает число
+        обновленных пользователей или -1 при ошибке.
+        """
+        try:
+            if stage_number and stage_number not in STAGE_NUMBERS:
+                logging.error(f"Некорректный номер этапа: {stage_number}")
+                return -1
+
+            def _write(cursor, telegram_ids):
+                if telegram_ids is None:
+                    # Для всех пользователей переписываем только строки с отмеченными этапами
                     if stage_number:
-                        logging.info(f"Завершение этапа {stage_number} сброшено для пользователя {telegram_id}")
+                        bit = stage_bit(stage_number)
+                        cursor.execute('UPDATE main SET stage_mask = stage_mask & ~? WHERE stage_mask & ?', (bit, bit))
+                        updated = cursor.rowcount
+                        cursor.execute('DELETE FROM stage_progress WHERE stage_number = ?', (stage_number,))
                     else:
-                        logging.info(f"Все завершения этапов сброшены для пользователя {telegram_id}")
-                    return True
-                else:
-                    logging.warning(f"Пользователь {telegram_id} не найден")
-                    return False
-                
+                        cursor.execute('UPDATE main SET stage_mask = 0 WHERE stage_mask != 0')
+                        updated = cursor.rowcount
+                        cursor.execute('DELETE FROM stage_progress')
+                    return updated
+
+                updated = 0
+                ids = list(telegram_ids)
+                for i in range(0, len(ids), BULK_PARAMS_CHUNK):
+                    chunk = ids[i:i + BULK_PARAMS_CHUNK]
+                    placeholders = ','.join('?' * len(chunk))
+                    if stage_number:
+                        cursor.execute(
+                            f"UPDATE main SET stage_mask = stage_mask & ~? WHERE telegram_id IN ({placeholders})",
+                            [stage_bit(stage_number)] + chunk
+                        )
+                        updated += cursor.rowcount
+                        cursor.execute(
+                            f"DELETE FROM stage_progress WHERE stage_number = ? AND telegram_id IN ({placeholders})",
+                            [stage_number] + chunk
+                        )
+                    else:
+                        cursor.execute(f"UPDATE main SET stage_mask = 0 WHERE telegram_id IN ({placeholders})", chunk)
+                        updated += cursor.rowcount
+                        cursor.execute(f"DELETE FROM stage_progress WHERE telegram_id IN ({placeholders})", chunk)
+                return updated
+
+            if telegram_ids is None:
+                return sum(self.write_shards(functools.partial(_write, telegram_ids=None)))
+            # Пользователи разных шардов сбрасываются параллельно, каждый шард - одной транзакцией
+            by_shard = {}
+            for telegram_id in telegram_ids:
+                by_shard.setdefault(self.shard_of(telegram_id), []).append(telegram_id)
+            futures = [
+                self.writer_for(shard).submit(functools.partial(_write, telegram_ids=ids))
+                for shard, ids in by_shard.items()
+            ]
+            return sum(wait_write(future) for future in futures)
+
         except sqlite3.Error as e:
-            logging.error(f"Ошибка сброса завершения этапа для пользователя {telegram_id}: {e}")
-            return False
+            logging.error(f"Ошибка массового сброса завершения этапов: {e}")
+            return -1
+
+        finally:
+            if telegram_ids is None:
+                self.cache.clear()
+            else:
+                for telegram_id in telegram_ids:
+                    self.cache.invalidate(telegram_id)
+
+    # МЕТОДЫ ДЛЯ РАБОТЫ С ЭТАПАМИ
+
+    def delete_stage_cascade(self, stage_id: int):
+        """Удаление этапа вместе с участниками, их ссылками и привязкой в main.
+
+        Все изменения выполняются набором запросов в одной транзакции.
+        Пользователи в main не удаляются, у них обнуляется participant_id.
+        В режиме шардирования пользователи отвязываются в шардах до
+        удаления этапа (отдельные транзакции в каждом файле).
+        Возвращает None, если этап не найден, иначе словарь со счетчиками.
+        """
+        def _unlink_main(cursor):
+            cursor.execute('''
+                UPDATE main SET participant_id = NULL
+                WHERE participant_id IN (SELECT participant_id FROM manual_upload WHERE stage_id = ?)
+            ''', (stage_id,))
+            return cursor.rowcount
+
+        def _write(cursor):
+            cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
+            stage = cursor.fetchone()
+            if not stage:
+                return None
+
+            cursor.execute('''
+                DELETE FROM link_generation
+                WHERE participant_id IN (SELECT participant_id FROM manual_upload WHERE stage_id = ?)
+            ''', (stage_id,))
+            deleted_links = cursor.rowcount
+
+            updated_main = None if self.shard_paths else _unlink_main(cursor)
+
+            cursor.execute('DELETE FROM manual_upload WHERE stage_id = ?', (stage_id,))
+            deleted_users = cursor.rowcount
+
+            cursor.execute('DELETE FROM stages WHERE stage_id = ?', (stage_id,))
+
+            return {
+                'stage_name': stage[0],
+                'deleted_users': deleted_users,
+                'deleted_links': deleted_links,
+                'updated_main': updated_main
+            }
+
+        try:
+            if not self.shard_paths:
+                return self.write(_write)
+            updated_main = sum(self.write_shards(_unlink_main))
+            result = self.write(_write)
+            if result is not None:
+                result['updated_main'] = updated_main
+            return result
+        finally:
+            # participant_id в main могли измениться у многих пользователей
+            self.cache.clear()
 
     # ✅ МЕТОДЫ ДЛЯ РАБОТЫ С АДРЕСАМИ ПОЛЬЗОВАТЕЛЕЙ
 
     def save_user_address(self, telegram_id: int, telegram_username: str, address: str, stage: int = 1) -> bool:
         """Сохранение или обновление адреса пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
+                # UPSERT сохраняет address_id и created_at существующей записи
                 cursor.execute('''
-                    INSERT OR REPLACE INTO user_addresses 
+                    INSERT INTO user_addresses 
                     (telegram_id, telegram_username, stage, address, updated_at)
                     VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(telegram_id, stage) DO UPDATE SET
+                        address = excluded.address,
+                        telegram_username = COALESCE(excluded.telegram_username, telegram_username),
+                        updated_at = CURRENT_TIMESTAMP
                 ''', (telegram_id, telegram_username, stage, address))
                 
-                conn.commit()
                 logging.info(f"Адрес сохранен для пользователя {telegram_id} (этап {stage})")
                 return True
-                
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка сохранения адреса пользователя {telegram_id}: {e}")
             return False
@@ -640,37 +1385,40 @@ class Database:
     def get_user_address(self, telegram_id: int, stage: int = None):
         """Получение адреса пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                if stage:
-                    cursor.execute('''
-                        SELECT address_id, telegram_id, telegram_username, stage, address, created_at, updated_at
-                        FROM user_addresses 
-                        WHERE telegram_id = ? AND stage = ?
-                    ''', (telegram_id, stage))
-                else:
-                    cursor.execute('''
-                        SELECT address_id, telegram_id, telegram_username, stage, address, created_at, updated_at
-                        FROM user_addresses 
-                        WHERE telegram_id = ?
-                        ORDER BY stage DESC
-                        LIMIT 1
-                    ''', (telegram_id,))
-                
-                result = cursor.fetchone()
-                if result:
-                    return {
-                        'address_id': result[0],
-                        'telegram_id': result[1],
-                        'telegram_username': result[2],
-                        'stage': result[3],
-                        'address': result[4],
-                        'created_at': result[5],
-                        'updated_at': result[6]
-                    }
-                return None
-                
+            def _load():
+                with self.get_connection(self.shard_of(telegram_id)) as conn:
+                    cursor = conn.cursor()
+
+                    if stage:
+                        cursor.execute('''
+                            SELECT address_id, telegram_id, telegram_username, stage, address, created_at, updated_at
+                            FROM user_addresses 
+                            WHERE telegram_id = ? AND stage = ?
+                        ''', (telegram_id, stage))
+                    else:
+                        cursor.execute('''
+                            SELECT address_id, telegram_id, telegram_username, stage, address, created_at, updated_at
+                            FROM user_addresses 
+                            WHERE telegram_id = ?
+                            ORDER BY stage DESC
+                            LIMIT 1
+                        ''', (telegram_id,))
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'address_id': result[0],
+                            'telegram_id': result[1],
+                            'telegram_username': result[2],
+                            'stage': result[3],
+                            'address': result[4],
+                            'created_at': result[5],
+                            'updated_at': result[6]
+                        }
+                    return None
+
+            return self.cache.get_or_load((telegram_id, 'address', stage), _load)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка получения адреса пользователя {telegram_id}: {e}")
             return None
@@ -678,23 +1426,22 @@ class Database:
     def update_user_address(self, telegram_id: int, address: str, stage: int = 1) -> bool:
         """Обновление адреса пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 cursor.execute('''
                     UPDATE user_addresses 
                     SET address = ?, updated_at = CURRENT_TIMESTAMP
                     WHERE telegram_id = ? AND stage = ?
                 ''', (address, telegram_id, stage))
                 
-                conn.commit()
                 if cursor.rowcount > 0:
                     logging.info(f"Адрес обновлен для пользователя {telegram_id} (этап {stage})")
                     return True
                 else:
                     logging.warning(f"Адрес не найден для обновления: пользователь {telegram_id}, этап {stage}")
                     return False
-                
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка обновления адреса пользователя {telegram_id}: {e}")
             return False
@@ -702,9 +1449,7 @@ class Database:
     def delete_user_address(self, telegram_id: int, stage: int = None) -> bool:
         """Удаление адреса пользователя"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 if stage:
                     cursor.execute('''
                         DELETE FROM user_addresses 
@@ -716,18 +1461,19 @@ class Database:
                         WHERE telegram_id = ?
                     ''', (telegram_id,))
                 
-                conn.commit()
                 logging.info(f"Адрес(а) удален(ы) для пользователя {telegram_id}")
                 return True
-                
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка удаления адреса пользователя {telegram_id}: {e}")
             return False
 
-    def export_addresses_to_csv(self, stage: int = None):
-        """Экспорт адресов в CSV-формат (возвращает строку)"""
+    def write_addresses_csv(self, out, stage: int = None) -> int:
+        """Потоковая запись адресов в CSV (текстовый поток), возвращает число строк или -1"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_report_connection() as conn:
                 cursor = conn.cursor()
                 
                 if stage:
@@ -744,66 +1490,89 @@ class Database:
                         ORDER BY stage, created_at DESC
                     ''')
                 
-                results = cursor.fetchall()
-                
-                if not results:
-                    return "Нет данных для экспорта"
-                
-                # Заголовки CSV
-                csv_data = "telegram_id;telegram_username;stage;address;created_at\n"
-                
-                for result in results:
-                    telegram_id, telegram_username, stage, address, created_at = result
-                    csv_data += f"{telegram_id};{telegram_username or ''};{stage};{address};{created_at}\n"
-                
-                return csv_data
+                header = ['telegram_id', 'telegram_username', 'stage', 'address', 'created_at']
+                return _write_csv(cursor, out, header)
                 
         except sqlite3.Error as e:
             logging.error(f"Ошибка экспорта адресов в CSV: {e}")
-            return f"Ошибка экспорта: {e}"
+            return -1
+
+    def export_addresses_to_csv(self, stage: int = None) -> tuple:
+        """Экспорт адресов в CSV: (временный файл с позицией в начале, число строк)"""
+        return _spool_csv(lambda out: self.write_addresses_csv(out, stage))
 
     # МЕТОДЫ ДЛЯ РАБОТЫ С РОЗЫГРЫШЕМ
 
     def add_raffle_participant(self, telegram_id: int, telegram_username: str = None, raffle_id: int = None) -> bool:
         """Добавление участника в розыгрыш"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 cursor.execute('''
-                    INSERT OR REPLACE INTO raffle_participants 
+                    INSERT INTO raffle_participants 
                     (telegram_id, telegram_username, raffle_id) 
                     VALUES (?, ?, ?)
+                    ON CONFLICT(telegram_id, IFNULL(raffle_id, 0)) DO UPDATE SET
+                        telegram_username = COALESCE(excluded.telegram_username, telegram_username)
                 ''', (telegram_id, telegram_username, raffle_id))
                 
-                conn.commit()
                 logging.info(f"Участник {telegram_id} добавлен в розыгрыш {raffle_id}")
                 return True
-                
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка добавления участника розыгрыша: {e}")
             return False
 
+    def join_raffle(self, telegram_id: int, telegram_username: str = None, raffle_id: int = None):
+        """Регистрация в розыгрыше одним запросом.
+
+        Возвращает True, если пользователь добавлен сейчас, False, если он
+        уже участвует, и None при ошибке.
+        """
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    INSERT INTO raffle_participants 
+                    (telegram_id, telegram_username, raffle_id) 
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(telegram_id, IFNULL(raffle_id, 0)) DO NOTHING
+                ''', (telegram_id, telegram_username, raffle_id))
+
+                if cursor.rowcount > 0:
+                    logging.info(f"Участник {telegram_id} добавлен в розыгрыш {raffle_id}")
+                    return True
+                return False
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка регистрации в розыгрыше: {e}")
+            return None
+
     def is_user_participating_in_raffle(self, telegram_id: int, raffle_id: int = None) -> bool:
         """Проверка, участвует ли пользователь в розыгрыше"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                
-                if raffle_id:
-                    cursor.execute('''
-                        SELECT COUNT(*) FROM raffle_participants 
-                        WHERE telegram_id = ? AND raffle_id = ?
-                    ''', (telegram_id, raffle_id))
-                else:
-                    cursor.execute('''
-                        SELECT COUNT(*) FROM raffle_participants 
-                        WHERE telegram_id = ?
-                    ''', (telegram_id,))
-                
-                count = cursor.fetchone()[0]
-                return count > 0
-                
+            def _load():
+                with self.get_connection(self.shard_of(telegram_id)) as conn:
+                    cursor = conn.cursor()
+
+                    if raffle_id:
+                        cursor.execute('''
+                            SELECT COUNT(*) FROM raffle_participants 
+                            WHERE telegram_id = ? AND raffle_id = ?
+                        ''', (telegram_id, raffle_id))
+                    else:
+                        cursor.execute('''
+                            SELECT COUNT(*) FROM raffle_participants 
+                            WHERE telegram_id = ?
+                        ''', (telegram_id,))
+
+                    count = cursor.fetchone()[0]
+                    return count > 0
+
+            return self.cache.get_or_load((telegram_id, 'raffle', raffle_id), _load)
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка проверки участия в розыгрыше: {e}")
             return False
@@ -811,7 +1580,7 @@ class Database:
     def get_raffle_participants(self, raffle_id: int = None) -> list:
         """Получение списка участников розыгрыша"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.get_report_connection() as conn:
                 cursor = conn.cursor()
                 
                 if raffle_id:
@@ -838,7 +1607,7 @@ class Database:
     def get_raffle_participants_count(self, raffle_id: int = None) -> int:
         """Получение количества участников розыгрыша"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            def _load(conn, shard):
                 cursor = conn.cursor()
                 
                 if raffle_id:
@@ -851,8 +1620,9 @@ class Database:
                         SELECT COUNT(*) FROM raffle_participants
                     ''')
                 
-                count = cursor.fetchone()[0]
-                return count
+                return cursor.fetchone()[0]
+
+            return sum(self.fan_out(_load))
                 
         except sqlite3.Error as e:
             logging.error(f"Ошибка получения количества участников: {e}")
@@ -861,13 +1631,15 @@ class Database:
     def delete_all_raffle_participants(self) -> bool:
         """Удаление всех участников розыгрыша"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            def _write(cursor):
                 cursor.execute('DELETE FROM raffle_participants')
-                conn.commit()
-                logging.info("Все участники розыгрыша удалены")
                 return True
-                
+
+            result = all(self.write_shards(_write))
+            logging.info("Все участники розыгрыша удалены")
+            self.cache.clear()
+            return result
+
         except sqlite3.Error as e:
             logging.error(f"Ошибка удаления всех участников розыгрыша: {e}")
             return False
@@ -875,44 +1647,552 @@ class Database:
     def get_user_by_telegram_id(self, telegram_id: int):
         """Получение пользователя по telegram_id"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            def _load():
+                with self.get_connection(self.shard_of(telegram_id)) as conn:
+                    cursor = conn.cursor()
+
+                    cursor.execute('''
+                        SELECT user_id, participant_id, telegram_id, telegram_username, 
+                                role, quest_started, quest_started_at, current_stage,
+                                stage_mask, registration_date
+                        FROM main 
+                        WHERE telegram_id = ?
+                    ''', (telegram_id,))
+
+                    result = cursor.fetchone()
+                    if result:
+                        return {
+                            'user_id': result[0],
+                            'participant_id': result[1],
+                            'telegram_id': result[2],
+                            'telegram_username': result[3],
+                            'role': result[4],
+                            'quest_started': result[5],
+                            'quest_started_at': result[6],
+                            'current_stage': result[7],
+                            'stage_mask': result[8],
+                            'stage_1_completed': int(bool(result[8] & stage_bit(1))),
+                            'stage_2_completed': int(bool(result[8] & stage_bit(2))),
+                            'stage_3_completed': int(bool(result[8] & stage_bit(3))),
+                            'stage_4_completed': int(bool(result[8] & stage_bit(4))),
+                            'registration_date': result[9]
+                        }
+                    return None
+
+            return self.cache.get_or_load((telegram_id, 'user'), _load)
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения пользователя по telegram_id {telegram_id}: {e}")
+            return None
+    
+    # ПОИСК УЧАСТНИКОВ
+    # Полнотекстовый индекс participant_search (FTS5) поддерживается триггерами, см. migrations.py
+
+    def search_participants(self, text: str, limit: int = SEARCH_RESULTS_LIMIT) -> dict:
+        """Поиск участников по ФИО, email, телефону и telegram username.
+
+        Возвращает {'results': [...], 'matches': N, 'ranked': bool}: до limit
+        участников со статусом ссылки, прогрессом этапов и проверкой пробежки.
+        matches ограничено SEARCH_RANK_MAX_MATCHES + 1; при большем числе
+        совпадений результаты не ранжируются (ranked = False).
+        """
+        found = {'results': [], 'matches': 0, 'ranked': True}
+        query = build_search_query(text)
+        if query is None:
+            return found
+        try:
+            with self.get_connection() as conn:
+                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
-                
                 cursor.execute('''
-                    SELECT user_id, participant_id, telegram_id, telegram_username, 
-                            role, quest_started, quest_started_at, current_stage,
-                            stage_1_completed, stage_2_completed, stage_3_completed, stage_4_completed,
-                            registration_date
-                    FROM main 
+                    SELECT COUNT(*) FROM (
+                        SELECT 1 FROM participant_search WHERE participant_search MATCH ? LIMIT ?
+                    )
+                ''', (query, SEARCH_RANK_MAX_MATCHES + 1))
+                found['matches'] = cursor.fetchone()[0]
+                if found['matches'] == 0:
+                    return found
+                found['ranked'] = found['matches'] <= SEARCH_RANK_MAX_MATCHES
+
+                cursor.execute(SEARCH_RANKED_SQL if found['ranked'] else SEARCH_FIRST_SQL, (query, limit))
+                results = [dict(row) for row in cursor.fetchall()]
+
+            def _load_users(conn, shard):
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT m.participant_id, m.user_id, m.telegram_id, m.telegram_username,
+                           m.current_stage, m.stage_mask, v.distance, v.run_date, v.answer_check
+                    FROM main m
+                    LEFT JOIN verification v ON v.user_id = m.user_id
+                    WHERE m.participant_id IN (SELECT value FROM json_each(?))
+                ''', (json.dumps([result['participant_id'] for result in results]),))
+                return cursor.fetchall()
+
+            # Пользователь участника может быть в любом шарде
+            users = {
+                row[0]: row[1:] for rows in self.fan_out(_load_users) for row in rows
+            }
+            for result in results:
+                result.update(zip(SEARCH_USER_FIELDS, users.get(result['participant_id'], ())))
+                for field in SEARCH_USER_FIELDS:
+                    result.setdefault(field, None)
+                result['completed_stages'] = stages_from_mask(result['stage_mask'] or 0)
+                found['results'].append(result)
+            return found
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка поиска участников по запросу '{text}': {e}")
+            return found
+
+    # ✅ МЕТОДЫ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЯМИ
+
+    def get_user_id(self, telegram_id: int):
+        """Получение user_id по telegram_id"""
+        try:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT user_id FROM main WHERE telegram_id = ?', (telegram_id,))
+                result = cursor.fetchone()
+                return result[0] if result else None
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения user_id для telegram_id {telegram_id}: {e}")
+            return None
+
+    def get_user_role(self, telegram_id: int):
+        """Получение роли пользователя"""
+        try:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT role FROM main WHERE telegram_id = ?', (telegram_id,))
+                result = cursor.fetchone()
+                return result[0] if result else None
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения роли пользователя {telegram_id}: {e}")
+            return None
+
+    def get_user_stage_id(self, telegram_id: int):
+        """Получение stage_id пользователя из manual_upload через main"""
+        try:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT mu.stage_id 
+                    FROM main m
+                    JOIN manual_upload mu ON m.participant_id = mu.participant_id
+                    WHERE m.telegram_id = ?
+                ''', (telegram_id,))
+                result = cursor.fetchone()
+                return result[0] if result else None
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения stage_id пользователя {telegram_id}: {e}")
+            return None
+
+    def get_participant_name(self, telegram_id: int):
+        """Получение имени и отчества участника (first_name, middle_name)"""
+        try:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT mu.first_name, mu.middle_name 
+                    FROM main m
+                    JOIN manual_upload mu ON m.participant_id = mu.participant_id
+                    WHERE m.telegram_id = ?
+                ''', (telegram_id,))
+                return cursor.fetchone()
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения имени пользователя {telegram_id}: {e}")
+            return None
+
+    def get_user_current_stage(self, telegram_id: int) -> int:
+        """Получение текущего этапа пользователя (по умолчанию 1)"""
+        try:
+            with self.get_connection(self.shard_of(telegram_id)) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT current_stage FROM main WHERE telegram_id = ?', (telegram_id,))
+                result = cursor.fetchone()
+                if result and result[0] is not None:
+                    return int(result[0])
+                return 1
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения current_stage для {telegram_id}: {e}")
+            return 1
+
+    def update_user_current_stage(self, telegram_id: int, new_stage: int) -> bool:
+        """Обновление текущего этапа пользователя"""
+        try:
+            def _write(cursor):
+                cursor.execute(
+                    'UPDATE main SET current_stage = ? WHERE telegram_id = ?',
+                    (new_stage, telegram_id)
+                )
+                logging.info(f"Обновлен этап пользователя {telegram_id} на {new_stage}")
+                return True
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка обновления этапа для {telegram_id}: {e}")
+            return False
+
+    def record_quest_start(self, telegram_id: int) -> bool:
+        """Запись о начале квеста"""
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    UPDATE main 
+                    SET quest_started = 1, quest_started_at = CURRENT_TIMESTAMP
                     WHERE telegram_id = ?
                 ''', (telegram_id,))
-                
+                logging.info(f"Записано начало квеста для пользователя {telegram_id}")
+                return True
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при записи начала квеста в БД: {e}")
+            return False
+
+    def register_user(self, telegram_id: int, telegram_username: str = None) -> bool:
+        """Регистрация пользователя с ролью 'user' (существующие не изменяются)"""
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    INSERT INTO main (telegram_id, telegram_username, role)
+                    VALUES (?, ?, 'user')
+                    ON CONFLICT(telegram_id) DO NOTHING
+                    RETURNING user_id
+                ''', (telegram_id, telegram_username))
+
                 result = cursor.fetchone()
                 if result:
-                    return {
-                        'user_id': result[0],
-                        'participant_id': result[1],
-                        'telegram_id': result[2],
-                        'telegram_username': result[3],
-                        'role': result[4],
-                        'quest_started': result[5],
-                        'quest_started_at': result[6],
-                        'current_stage': result[7],
-                        'stage_1_completed': result[8],
-                        'stage_2_completed': result[9],
-                        'stage_3_completed': result[10],
-                        'stage_4_completed': result[11],
-                        'registration_date': result[12]
-                    }
-                return None
-                
+                    logging.info(f"Зарегистрирован новый пользователь: user_id={result[0]}, telegram_id={telegram_id}, username={telegram_username}, role=user")
+                else:
+                    logging.info(f"Пользователь {telegram_id} уже зарегистрирован")
+                return True
+
+            return self.write(_write, invalidate=telegram_id, shard=self.shard_of(telegram_id))
+
         except sqlite3.Error as e:
-            logging.error(f"Ошибка получения пользователя по telegram_id {telegram_id}: {e}")
-            return None
-    
-    def get_connection(self):
-        """Получение соединения с базой данных"""
-        return sqlite3.connect(self.db_path)
+            logging.error(f"Ошибка при регистрации пользователя {telegram_id}: {e}")
+            return False
+
+    def get_moderator_ids(self) -> list:
+        """Получение списка telegram_id модераторов"""
+        try:
+            def _load(conn, shard):
+                cursor = conn.cursor()
+                cursor.execute("SELECT telegram_id FROM main WHERE role = 'moderator'")
+                return [row[0] for row in cursor.fetchall()]
+
+            return [telegram_id for ids in self.fan_out(_load) for telegram_id in ids]
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения модераторов: {e}")
+            return []
+
+    def save_verification(self, user_id: int, distance: float, run_date: str, answer_check: int) -> bool:
+        """Сохранение данных пробежки в таблицу verification"""
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    INSERT OR REPLACE INTO verification 
+                    (user_id, distance, run_date, answer_check)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, distance, run_date, answer_check))
+                logging.info(f"Данные пробежки сохранены для user_id {user_id}: {distance} км, {run_date}, check={answer_check}")
+                return True
+
+            return self.write(_write, shard=self.shard_of_user(user_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка сохранения данных пробежки в БД: {e}")
+            return False
+
+    def add_user_image(self, telegram_id: int, image_path: str) -> bool:
+        """Сохранение скриншота пользователя в user_data одним запросом"""
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    INSERT INTO user_data (user_id, image_url, answer_text)
+                    SELECT user_id, ?, NULL FROM main WHERE telegram_id = ?
+                ''', (image_path, telegram_id))
+
+                if cursor.rowcount > 0:
+                    logging.info(f"Успешно сохранены данные для telegram_id: {telegram_id}")
+                    return True
+                logging.warning(f"Не найден user_id для telegram_id: {telegram_id}")
+                return False
+
+            return self.write(_write, shard=self.shard_of(telegram_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при сохранении данных пользователя {telegram_id}: {e}")
+            return False
+
+    def update_last_user_answer(self, telegram_id: int, answer: str) -> bool:
+        """Запись ответа в последнюю запись user_data пользователя одним запросом"""
+        try:
+            def _write(cursor):
+                cursor.execute('''
+                    UPDATE user_data
+                    SET answer_text = ?
+                    WHERE data_id = (
+                        SELECT MAX(data_id) FROM user_data
+                        WHERE user_id = (SELECT user_id FROM main WHERE telegram_id = ?)
+                    )
+                ''', (answer, telegram_id))
+
+                if cursor.rowcount > 0:
+                    logging.info(f"Успешно обновлен ответ для telegram_id: {telegram_id}")
+                    return True
+                logging.warning(f"Не найдено записей user_data для telegram_id: {telegram_id}")
+                return False
+
+            return self.write(_write, shard=self.shard_of(telegram_id))
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при обновлении ответа пользователя {telegram_id}: {e}")
+            return False
+
+    def register_by_link(self, universal_link: str, telegram_id: int, telegram_username: str = None) -> dict:
+        """Регистрация участника по персональной ссылке.
+
+        Ссылка гасится одним UPDATE ... RETURNING (только если она активна и
+        участник еще не привязан), пользователь привязывается одним UPSERT;
+        оба запроса выполняются в одной транзакции писателя. Результат:
+        {'status': 'registered' | 'not_found' | 'used' | 'taken', ...}.
+        Роль admin/moderator при привязке сохраняется.
+
+        В режиме шардирования ссылка гасится в основной базе, а пользователь
+        привязывается отдельной транзакцией в своем шарде; если привязка не
+        удалась, ссылка снова становится активной.
+        """
+        def _bind(cursor, participant_id):
+            cursor.execute('''
+                INSERT INTO main (participant_id, telegram_id, telegram_username, role)
+                VALUES (?, ?, ?, 'user')
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    participant_id = excluded.participant_id,
+                    telegram_username = excluded.telegram_username,
+                    role = CASE WHEN role IN ('admin', 'moderator') THEN role ELSE 'user' END
+                RETURNING user_id, role
+            ''', (participant_id, telegram_id, telegram_username))
+            user_id, role = cursor.fetchone()
+            return {'user_id': user_id, 'role': role}
+
+        def _write(cursor, bind=True):
+            cursor.execute('''
+                UPDATE link_generation
+                SET status = 0, link_click_date = CURRENT_TIMESTAMP
+                WHERE universal_link = ?
+                AND status = 1
+                AND EXISTS (SELECT 1 FROM manual_upload mu WHERE mu.participant_id = link_generation.participant_id)
+                AND NOT EXISTS (SELECT 1 FROM main m WHERE m.participant_id = link_generation.participant_id)
+                RETURNING participant_id,
+                    (SELECT last_name FROM manual_upload mu WHERE mu.participant_id = link_generation.participant_id),
+                    (SELECT first_name FROM manual_upload mu WHERE mu.participant_id = link_generation.participant_id)
+            ''', (universal_link,))
+            link_data = cursor.fetchone()
+
+            if not link_data:
+                # Ссылку не удалось погасить - выясняем причину (редкий путь)
+                cursor.execute('''
+                    SELECT lg.status,
+                        EXISTS (SELECT 1 FROM main m WHERE m.participant_id = lg.participant_id)
+                    FROM link_generation lg
+                    JOIN manual_upload mu ON lg.participant_id = mu.participant_id
+                    WHERE lg.universal_link = ?
+                ''', (universal_link,))
+                row = cursor.fetchone()
+                if not row:
+                    return {'status': 'not_found'}
+                if row[0] == 0:
+                    return {'status': 'used'}
+                return {'status': 'taken'}
+
+            participant_id, last_name, first_name = link_data
+            result = {
+                'status': 'registered',
+                'participant_id': participant_id,
+                'last_name': last_name,
+                'first_name': first_name
+            }
+            if bind:
+                result.update(_bind(cursor, participant_id))
+            return result
+
+        def _release_link(cursor):
+            cursor.execute('''
+                UPDATE link_generation
+                SET status = 1, link_click_date = NULL
+                WHERE universal_link = ?
+            ''', (universal_link,))
+
+        shard = self.shard_of(telegram_id)
+        if shard is None:
+            return self.write(_write, invalidate=telegram_id)
+
+        result = self.write(functools.partial(_write, bind=False))
+        if result['status'] != 'registered':
+            return result
+        try:
+            result.update(self.write(
+                functools.partial(_bind, participant_id=result['participant_id']),
+                invalidate=telegram_id, shard=shard
+            ))
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка привязки пользователя {telegram_id} по ссылке, ссылка возвращена: {e}")
+            self.write(_release_link)
+            raise
+        return result
+
+    def reset_mailing_dates(self) -> int:
+        """Сброс дат рассылки у всех активных ссылок одним UPDATE, возвращает число ссылок"""
+        def _write(cursor):
+            cursor.execute('''
+                UPDATE link_generation
+                SET mailing_date = NULL, next_mail_due_at = 0
+                WHERE status = 1
+            ''')
+            return cursor.rowcount
+
+        return self.write(_write)
+
+    def get_addresses_report(self) -> list:
+        """Адреса пользователей вместе с данными участников"""
+        try:
+            with self.get_report_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT 
+                        mu.last_name,
+                        mu.first_name,
+                        mu.middle_name,
+                        mu.phone,
+                        mu.email,
+                        ua.stage,
+                        ua.address,
+                        m.telegram_username
+                    FROM user_addresses ua
+                    LEFT JOIN main m ON ua.telegram_id = m.telegram_id
+                    LEFT JOIN manual_upload mu ON mu.participant_id = m.participant_id
+                    ORDER BY mu.last_name, mu.first_name
+                ''')
+                return cursor.fetchall()
+
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка выгрузки адресов: {e}")
+            return []
+
+    def get_connection(self, shard: int = None) -> PooledConnection:
+        """Получение соединения из пула основной базы или шарда (shard_of)"""
+        if shard is None:
+            return self.pool.connection()
+        return self.shard_pools[shard].connection()
+
+    def get_report_connection(self, max_staleness: float = None):
+        """Соединение для отчетов и выгрузок.
+
+        Реплика, если она подключена и не старше допустимого, иначе
+        соединение из пула основной базы. Используется в with.
+        """
+        if self.snapshots is not None and len(self.shard_snapshots) == self.shard_count:
+            conn = self.snapshots.connect_replica(max_staleness)
+            if conn is not None and self.shard_snapshots:
+                # Реплики шардов подключаются так же, как шарды к основной базе
+                uris = [snapshots.replica_uri(max_staleness) for snapshots in self.shard_snapshots]
+                try:
+                    if None in uris:
+                        raise sqlite3.OperationalError("реплика шарда устарела")
+                    sharding.attach_shards(conn, uris)
+                except sqlite3.Error as e:
+                    logging.warning(f"Реплики шардов недоступны: {e}")
+                    conn.close()
+                    conn = None
+            if conn is not None:
+                return contextlib.closing(conn)
+            logging.warning("Реплика для отчетов устарела или недоступна, читаем основную базу")
+        return self.get_connection()
+
+    def close(self):
+        """Остановка писателя и закрытие пула соединений"""
+        logging.info(f"Статистика кэша чтений: {self.cache.stats()}")
+        for item in self.query_stats.top(5):
+            logging.info(
+                f"Запрос: {item['calls']} вызовов, {item['total_ms']:.0f} мс всего, "
+                f"max {item['max_ms']:.1f} мс: {item['sql'][:200]}"
+            )
+        self.writer.stop()
+        for writer in self.shard_writers:
+            writer.stop()
+        if self._fan_out_executor is not None:
+            self._fan_out_executor.shutdown(wait=True)
+        for pool in self.shard_pools:
+            pool.close_all()
+        self.pool.close_all()
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+
+    Каждый метод Database доступен как корутина: вызов выполняется в
+    выделенном пуле потоков БД, поэтому обработчики aiogram не блокируют
+    event loop на запросах и ожидании блокировок SQLite.
+
+        user = await adb.get_user_by_telegram_id(telegram_id)
+        result = await adb.run(some_sync_function, arg)
+    """
+
+    def __init__(self, database: Database, max_workers: int = POOL_SIZE):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+
+    @staticmethod
+    def _caller_context(frame) -> contextvars.Context:
+        """Копия контекста с кодом вызывающего обработчика для журнала медленных запросов"""
+        context = contextvars.copy_context()
+        context.run(current_caller.set, frame.f_code if frame is not None else None)
+        return context
+
+    def _submit(self, frame, func, args, kwargs):
+        context = self._caller_context(frame)
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, functools.partial(context.run, func, *args, **kwargs))
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение произвольной синхронной функции в потоке БД"""
+        return await self._submit(sys._getframe(1), func, args, kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._submit(sys._getframe(1), attr, args, kwargs)
+
+        return method
+
+    async def write(self, func, invalidate: int = None, shard: int = None):
+        """Асинхронная операция записи через единственного писателя (шарда)"""
+        context = self._caller_context(sys._getframe(1))
+        try:
+            return await asyncio.wrap_future(context.run(self._db.writer_for(shard).submit, func))
+        finally:
+            if invalidate is not None:
+                self._db.cache.invalidate(invalidate)
+
+    def shutdown(self):
+        """Остановка пула потоков БД"""
+        self._executor.shutdown(wait=True)
+
 
 # Создаем глобальный экземпляр базы данных
 db = Database()
+adb = AsyncDatabase(db)
@@ -0,0 +1,139 @@
+# src/fsm_context.py
+"""
+Объединение чтений и записей FSM в пределах одного обновления Telegram.
+
+Обработчик фото этапа 1 за одно сообщение несколько раз читает данные
+(get_data) и дописывает их (update_data: user_id, recognition_attempts,
+last_image_path), и каждый вызов - отдельное обращение к хранилищу.
+CoalescedFSMMiddleware подменяет state обработчика на CoalescedFSMContext:
+данные загружаются из хранилища один раз при первом обращении, все
+изменения идут в копию в памяти (обработчик сразу видит свои записи),
+а после обработки обновления состояние и данные записываются одной
+операцией хранилища (set_record, если хранилище его поддерживает).
+
+Состояние берется из raw_state, которое FSMContextMiddleware aiogram уже
+прочитал под блокировкой события, поэтому отдельного чтения состояния нет.
+Неизменившиеся состояние и данные не записываются.
+
+    dp = Dispatcher(storage=storage, events_isolation=SimpleEventIsolation())
+    dp.update.outer_middleware(CoalescedFSMMiddleware())
+
+Изменения видны другим обновлениям этого пользователя только после
+записи, поэтому обновления одного пользователя должны обрабатываться по
+очереди (events_isolation).
+"""
+import copy
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.types import TelegramObject
+
+from fsm_storage import state_name
+
+
+class CoalescedFSMContext(FSMContext):
+    """FSMContext с данными в памяти до конца обработки обновления"""
+
+    def __init__(self, storage: BaseStorage, key: StorageKey, raw_state: Optional[str] = None):
+        super().__init__(storage=storage, key=key)
+        self._loaded_state = raw_state
+        self._state = raw_state
+        # Данные загружаются при первом обращении
+        self._loaded_data: Optional[Dict[str, Any]] = None
+        self._data: Optional[Dict[str, Any]] = None
+
+    async def _view(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._loaded_data = await self.storage.get_data(key=self.key)
+            self._data = copy.deepcopy(self._loaded_data)
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state_name(state)
+
+    async def get_state(self) -> Optional[str]:
+        return self._state
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        if self._data is None:
+            # Данные заменяются целиком - старые читать не нужно
+            self._loaded_data = None
+        self._data = copy.deepcopy(dict(data))
+
+    async def get_data(self) -> Dict[str, Any]:
+        return copy.deepcopy(await self._view())
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return copy.deepcopy((await self._view()).get(key, default))
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        view = await self._view()
+        view.update(copy.deepcopy(kwargs))
+        return copy.deepcopy(view)
+
+    @property
+    def state_changed(self) -> bool:
+        return self._state != self._loaded_state
+
+    @property
+    def data_changed(self) -> bool:
+        return self._data is not None and self._data != self._loaded_data
+
+    async def flush(self) -> int:
+        """Запись изменений в хранилище; возвращает число операций хранилища"""
+        state_changed, data_changed = self.state_changed, self.data_changed
+        if state_changed and data_changed and hasattr(self.storage, 'set_record'):
+            await self.storage.set_record(key=self.key, state=self._state, data=self._data)
+            operations = 1
+        else:
+            operations = 0
+            if state_changed:
+                await self.storage.set_state(key=self.key, state=self._state)
+                operations += 1
+            if data_changed:
+                await self.storage.set_data(key=self.key, data=self._data)
+                operations += 1
+        # Записанное становится исходным: повторный flush ничего не пишет
+        self._loaded_state = self._state
+        if self._data is not None:
+            self._loaded_data = copy.deepcopy(self._data)
+        return operations
+
+
+class CoalescedFSMMiddleware(BaseMiddleware):
+    """Подмена state обработчика на CoalescedFSMContext и запись изменений после обработки"""
+
+    def __init__(self):
+        self.updates = 0
+        self.writes = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        state = data.get('state')
+        if state is None or isinstance(state, CoalescedFSMContext):
+            return await handler(event, data)
+
+        context = CoalescedFSMContext(state.storage, state.key, data.get('raw_state'))
+        data['state'] = context
+        self.updates += 1
+        try:
+            return await handler(event, data)
+        finally:
+            # Изменения до ошибки в обработчике тоже сохраняются, как и без объединения
+            try:
+                self.writes += await context.flush()
+            except Exception as e:
+                logging.error(f"Ошибка записи состояния FSM {state.key.user_id}: {e}")
+
+    def stats(self) -> dict:
+        """Число обработанных обновлений и операций записи в хранилище"""
+        return {'updates': self.updates, 'writes': self.writes}
@@ -0,0 +1,294 @@
+# src/fsm_expiry.py
+"""
+Истечение брошенных состояний FSM (fsm_storage.SQLiteStorage).
+
+Пользователь, бросивший квест на середине этапа, навсегда оставляет в
+fsm_storage состояние и данные: путь к скриншоту, счетчики попыток.
+FSMExpiry удаляет ключ, который не менялся дольше срока его состояния:
+
+    state_ttls = parse_state_ttls('waiting_for_image=7,waiting_for_moderator_decision=0')
+
+Имя состояния можно указать полностью (Stage1States:waiting_for_image) или
+без группы - тогда срок действует для всех этапов. 0 - состояние не
+истекает (ожидание решения модератора). Для остальных состояний и данных
+без состояния действует default_ttl.
+
+Сроки хранятся в колесе таймеров (TimerWheel): каждая запись ключа в
+хранилище переставляет его в ячейку нового срока за O(1), а тик
+просматривает только свою ячейку - полного прохода по ключам нет.
+В колесе не больше max_tracked ключей: сверх лимита снимается с учета
+дольше всех не менявшийся ключ. Такие ключи и ключи, записанные до
+перезапуска бота, удаляет проход sweep по индексу (state, updated_at)
+(миграция 12) - при запуске и раз в sweep_interval_hours.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+FSM_EXPIRY_TICK = 60  # секунды
+FSM_EXPIRY_SLOTS = 1440  # ячеек колеса: сутки по минуте
+FSM_MAX_TRACKED = 100000
+FSM_SWEEP_INTERVAL_HOURS = 24
+SECONDS_PER_DAY = 86400
+
+
+def parse_state_ttls(value: str) -> Dict[str, Optional[int]]:
+    """'waiting_for_image=7,waiting_for_moderator_decision=0' -> {состояние: секунды или None}"""
+    ttls = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, days = item.split('=', 1)
+        ttls[name.strip()] = int(float(days) * SECONDS_PER_DAY) or None
+    return ttls
+
+
+class TimerWheel:
+    """Хэшированное колесо таймеров: постановка и отмена за O(1), тик - одна ячейка"""
+
+    def __init__(self, tick: float = FSM_EXPIRY_TICK, slots: int = FSM_EXPIRY_SLOTS, now: float = None):
+        self.tick = tick
+        self.slots = slots
+        self._buckets = [set() for _ in range(slots)]
+        # ключ -> (срок, ячейка); порядок - от давно не продлевавшихся к недавним
+        self._entries = OrderedDict()
+        # Номер последнего обработанного тика
+        self._current = int((now if now is not None else time.time()) // tick) - 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def schedule(self, key, deadline: float):
+        """Постановка или перестановка ключа на срок deadline (epoch)"""
+        self.cancel(key)
+        # Прошедший срок - в ближайший тик
+        tick_number = max(int(deadline // self.tick), self._current + 1)
+        slot = tick_number % self.slots
+        self._buckets[slot].add(key)
+        self._entries[key] = (deadline, slot)
+
+    def cancel(self, key) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._buckets[entry[1]].discard(key)
+        return True
+
+    def pop_oldest(self):
+        """Снятие ключа, дольше всех не продлевавшегося"""
+        key, (_, slot) = self._entries.popitem(last=False)
+        self._buckets[slot].discard(key)
+        return key
+
+    def advance(self, now: float) -> list:
+        """Снятие ключей со сроком до now.
+
+        Обрабатываются завершившиеся тики; в ячейке остаются ключи следующих
+        оборотов колеса. После долгой паузы каждая ячейка просматривается
+        один раз.
+        """
+        target = int(now // self.tick)
+        expired = []
+        for tick_number in range(max(self._current + 1, target - self.slots), target):
+            bucket = self._buckets[tick_number % self.slots]
+            due = [key for key in bucket if self._entries[key][0] <= now]
+            for key in due:
+                self.cancel(key)
+            expired.extend(due)
+        self._current = max(self._current, target - 1)
+        return expired
+
+
+class FSMExpiry:
+    """Удаление состояний FSM, не менявшихся дольше срока своего состояния"""
+
+    def __init__(self, storage, state_ttls: Dict[str, Optional[int]] = None, default_ttl: int = None,
+                 max_tracked: int = FSM_MAX_TRACKED, tick: float = FSM_EXPIRY_TICK,
+                 slots: int = FSM_EXPIRY_SLOTS, sweep_interval_hours: float = FSM_SWEEP_INTERVAL_HOURS):
+        # storage - fsm_storage.SQLiteStorage: сообщает о записях ключей (touch) и удаляет истекшие
+        self.storage = storage
+        self.state_ttls = state_ttls or {}
+        self.default_ttl = default_ttl or None
+        self.max_tracked = max_tracked
+        self.sweep_interval = sweep_interval_hours * 3600
+        self.wheel = TimerWheel(tick, slots)
+        self.expired = 0
+        self.swept = 0
+        self.untracked = 0
+        self.last_sweep_at = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+        storage.expiry = self
+
+    def ttl_for(self, state: Optional[str]) -> Optional[int]:
+        """Срок простоя состояния в секундах (None - не истекает)"""
+        if state is not None:
+            if state in self.state_ttls:
+                return self.state_ttls[state]
+            name = state.rsplit(':', 1)[-1]
+            if name in self.state_ttls:
+                return self.state_ttls[name]
+        return self.default_ttl
+
+    # ---------- Колесо ----------
+
+    def _track(self, key: str, deadline: float):
+        self.wheel.schedule(key, deadline)
+        while len(self.wheel) > self.max_tracked:
+            # Снятый с учета ключ удалит sweep
+            self.wheel.pop_oldest()
+            self.untracked += 1
+
+    def touch(self, key: str, state: Optional[str], has_data: bool, now: float = None):
+        """Запись ключа в хранилище: новый срок по его состоянию"""
+        ttl = self.ttl_for(state) if state is not None or has_data else None
+        if ttl is None:
+            # Ключ удален или его состояние не истекает
+            self.wheel.cancel(key)
+            return
+        self._track(key, (now if now is not None else time.time()) + ttl)
+
+    async def run_once(self, now: float = None) -> int:
+        """Удаление истекших ключей колеса (и sweep, если пора); возвращает число удаленных"""
+        now = now if now is not None else time.time()
+        expired = self.wheel.advance(now)
+        batch = None
+        for key in expired:
+            batch = self.storage.expire(key)
+        if batch is not None:
+            # Пачка записи общая с обработчиками - отмена планировщика ее не отменяет
+            await asyncio.shield(batch)
+            self.expired += len(expired)
+            logging.info(f"Истекло состояний FSM: {len(expired)}")
+
+        if self.last_sweep_at is None or now - self.last_sweep_at >= self.sweep_interval:
+            await self.sweep(now)
+        return len(expired)
+
+    # ---------- Проход по индексу ----------
+
+    def _count_states(self) -> Dict[Optional[str], int]:
+        with self.storage.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, COUNT(*) FROM fsm_storage GROUP BY state")
+            return dict(cursor.fetchall())
+
+    def _recent_keys(self, state: Optional[str], limit: int) -> list:
+        with self.storage.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT storage_key, updated_at FROM fsm_storage
+                WHERE state IS ?
+                ORDER BY updated_at DESC
+                LIMIT ?
+            ''', (state, limit))
+            return cursor.fetchall()
+
+    async def live_states(self) -> Dict[Optional[str], int]:
+        """Число записанных ключей по состояниям (None - данные без состояния)"""
+        return await self.storage.adb.run(self._count_states)
+
+    async def sweep(self, now: float = None) -> int:
+        """Удаление строк старше срока их состояния по индексу (state, updated_at)"""
+        now = now if now is not None else time.time()
+        self.last_sweep_at = now
+        cutoffs = []
+        for state in await self.live_states():
+            ttl = self.ttl_for(state)
+            if ttl is not None:
+                cutoffs.append((state, int(now - ttl)))
+        if not cutoffs:
+            return 0
+
+        def _write(cursor):
+            deleted = []
+            for state, cutoff in cutoffs:
+                cursor.execute(
+                    "DELETE FROM fsm_storage WHERE state IS ? AND updated_at < ? RETURNING storage_key",
+                    (state, cutoff)
+                )
+                deleted.extend(row[0] for row in cursor.fetchall())
+            return deleted
+
+        deleted = await self.storage.adb.write(_write)
+        for key in deleted:
+            self.wheel.cancel(key)
+        self.storage.forget(deleted)
+        self.swept += len(deleted)
+        if deleted:
+            logging.info(f"Удалено устаревших состояний FSM из базы: {len(deleted)}")
+        return len(deleted)
+
+    async def load(self) -> int:
+        """Постановка в колесо недавно менявшихся ключей после запуска бота"""
+        loaded = 0
+        for state in await self.live_states():
+            ttl = self.ttl_for(state)
+            room = self.max_tracked - len(self.wheel)
+            if ttl is None or room <= 0:
+                continue
+            rows = await self.storage.adb.run(self._recent_keys, state, room)
+            # От старых к новым: порядок колеса - от давно не менявшихся
+            for key, updated_at in reversed(rows):
+                if key not in self.wheel:
+                    self._track(key, updated_at + ttl)
+                    loaded += 1
+        return loaded
+
+    # ---------- Планировщик ----------
+
+    async def start_scheduler(self):
+        """Sweep и загрузка колеса при запуске, затем тик колеса"""
+        try:
+            await self.sweep()
+            loaded = await self.load()
+            logging.info(f"⏳ Истечение состояний FSM: в колесе {loaded} ключей, тик {self.wheel.tick:g} с")
+        except Exception as e:
+            logging.error(f"❌ Ошибка загрузки сроков состояний FSM: {e}")
+
+        while not self._stop_event.is_set():
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.wheel.tick)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                break
+            if self._stop_event.is_set():
+                break
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"❌ Ошибка истечения состояний FSM: {e}")
+
+    def start(self) -> bool:
+        """Запуск планировщика в фоне"""
+        if self.is_running():
+            return True
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self.start_scheduler())
+        return True
+
+    def stop_scheduler(self):
+        """Остановка планировщика"""
+        self._stop_event.set()
+        if self._task and not self._task.done():
+            self._task.cancel()
+        logging.info("🛑 Планировщик истечения состояний FSM остановлен")
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def stats(self) -> dict:
+        """Размер колеса и счетчики удалений"""
+        return {
+            'tracked': len(self.wheel),
+            'max_tracked': self.max_tracked,
+            'expired': self.expired,
+            'swept': self.swept,
+            'untracked': self.untracked
+        }
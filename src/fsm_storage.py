@@ -0,0 +1,433 @@
+# src/fsm_storage.py
+"""
+Хранилища FSM aiogram: SQLite с LRU-кэшем в памяти и Redis для нескольких экземпляров бота.
+
+MemoryStorage теряет состояния всех пользователей при перезапуске бота и
+растет без ограничений. SQLiteStorage хранит состояние и данные в таблице
+fsm_storage (миграция 11), а последние max_entries ключей держит в памяти:
+чтения активных пользователей не обращаются к базе.
+
+Запись сквозная: кэш обновляется сразу, а изменения всех ключей за
+flush_interval секунд записываются одной операцией писателя базы
+(executemany, несколько изменений одного ключа - одна строка). set_state и
+set_data возвращаются после COMMIT своей пачки. Пачка, которую писатель
+не записал, остается в очереди и повторяется с растущей задержкой, даже
+если у ее пользователей больше нет новых изменений.
+
+    storage = SQLiteStorage(db, adb)
+    dp = Dispatcher(storage=storage)
+
+RedisFSMStorage хранит ключ FSM одним хэшем Redis (поле s - состояние,
+d - данные в том же компактном JSON), поэтому несколько процессов бота
+видят одно и то же состояние пользователя. Запись состояния или данных и
+продление TTL уходят одним конвейером MULTI/EXEC, состояние и данные
+читаются одним HMGET, update_data атомарен между процессами (WATCH).
+
+    storage = RedisFSMStorage.from_url('redis://localhost:6379/0', ttl=timedelta(days=14))
+    dp = Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Dict, Mapping, Optional, Tuple, Union
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+FSM_CACHE_MAX_ENTRIES = 10000
+FSM_FLUSH_INTERVAL = 0.005  # секунды
+# Повтор незаписанной пачки: задержка удваивается после каждой ошибки
+FSM_RETRY_DELAY = 1.0  # секунды
+FSM_RETRY_MAX_DELAY = 60.0  # секунды
+
+
+def dump_data(data: Mapping) -> Optional[str]:
+    """Данные FSM в компактный JSON (None - данных нет)"""
+    if not data:
+        return None
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def load_data(text: Optional[Union[str, bytes]]) -> Dict[str, Any]:
+    return json.loads(text) if text else {}
+
+
+def state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class _Record:
+    """Состояние и данные одного ключа в кэше"""
+    __slots__ = ('state', 'data')
+
+    def __init__(self, state: Optional[str] = None, data: Dict[str, Any] = None):
+        self.state = state
+        self.data = data or {}
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний FSM в таблице fsm_storage"""
+
+    def __init__(self, database, async_database, key_builder: KeyBuilder = None,
+                 max_entries: int = FSM_CACHE_MAX_ENTRIES, flush_interval: float = FSM_FLUSH_INTERVAL):
+        # Чтения выполняются в потоках БД (adb.run), записи - через писателя (adb.write)
+        self.db = database
+        self.adb = async_database
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()
+        # Изменения, ожидающие записи: ключ -> _Record
+        self._pending = {}
+        self._batch: Optional[asyncio.Future] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # Повтор после ошибки записи, если новых изменений (и пачки) нет
+        self._retry_task: Optional[asyncio.Task] = None
+        self._retry_delay = 0.0
+        # fsm_expiry.FSMExpiry: срок жизни ключа продлевается при каждой записи
+        self.expiry = None
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    # ---------- Кэш ----------
+
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        # Вытесняются только записанные ключи: ожидающие лежат в _pending
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _load_row(self, key: str):
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data FROM fsm_storage WHERE storage_key = ?", (key,))
+            return cursor.fetchone()
+
+    async def _record(self, storage_key: StorageKey) -> _Record:
+        """Запись ключа из кэша, очереди записи или базы"""
+        key = self.key_builder.build(storage_key)
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return record
+        # Вытесненный из кэша ключ, который еще не записан
+        record = self._pending.get(key)
+        if record is None:
+            self.misses += 1
+            try:
+                row = await self.adb.run(self._load_row, key)
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка чтения состояния FSM {key}: {e}")
+                row = None
+            # Пока шло чтение, ключ мог быть изменен - изменение важнее строки из базы
+            record = self._cache.get(key) or self._pending.get(key)
+            if record is None:
+                record = _Record(row[0], load_data(row[1])) if row else _Record()
+        self._remember(key, record)
+        return record
+
+    # ---------- Запись ----------
+
+    def _schedule(self, storage_key: StorageKey, record: _Record) -> asyncio.Future:
+        """Постановка ключа в ближайшую пачку записи"""
+        return self._schedule_key(self.key_builder.build(storage_key), record)
+
+    def _schedule_key(self, key: str, record: _Record) -> asyncio.Future:
+        self._pending[key] = record
+        if self.expiry is not None:
+            self.expiry.touch(key, record.state, bool(record.data))
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_future()
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return self._batch
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    def _schedule_retry(self):
+        """Повтор записи очереди через растущую задержку"""
+        self._retry_delay = min(max(self._retry_delay * 2, FSM_RETRY_DELAY), FSM_RETRY_MAX_DELAY)
+        if self._retry_task is None or self._retry_task.done():
+            self._retry_task = asyncio.create_task(self._retry_later(self._retry_delay))
+
+    async def _retry_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._retry_task = None
+        # Пачка уже запланирована - она запишет и повторяемые ключи
+        if self._batch is None and self._pending:
+            await self.flush()
+
+    async def flush(self):
+        """Запись накопленных изменений одной операцией писателя"""
+        pending, batch = self._pending, self._batch
+        self._pending, self._batch, self._flush_task = {}, None, None
+        if not pending:
+            if batch is not None and not batch.done():
+                batch.set_result(None)
+            return
+
+        try:
+            await self._write_pending(pending)
+        finally:
+            # Пачку ждут обработчики (asyncio.shield) - она завершается при любом исходе
+            if batch is not None and not batch.done():
+                batch.set_result(None)
+
+    async def _write_pending(self, pending: Dict[str, _Record]):
+        now = int(time.time())
+        upserts = []
+        deletes = []
+        for key, record in pending.items():
+            try:
+                data = dump_data(record.data)
+            except (TypeError, ValueError) as e:
+                # Ключ с несериализуемыми данными пропускается, остальные записываются
+                logging.error(f"Данные состояния FSM {key} не сериализуются в JSON, ключ не записан: {e}")
+                continue
+            if record.state is None and data is None:
+                deletes.append((key,))
+            else:
+                upserts.append((key, record.state, data, now))
+        if not upserts and not deletes:
+            return
+
+        def _write(cursor):
+            if upserts:
+                cursor.executemany('''
+                    INSERT INTO fsm_storage (storage_key, state, data, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(storage_key) DO UPDATE SET
+                        state = excluded.state,
+                        data = excluded.data,
+                        updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                cursor.executemany("DELETE FROM fsm_storage WHERE storage_key = ?", deletes)
+
+        try:
+            await self.adb.write(_write)
+            self.flushes += 1
+            self.rows_written += len(upserts) + len(deletes)
+            self._retry_delay = 0.0
+        except Exception as e:
+            # sqlite3.Error, а также ошибки самого писателя (остановлен, не ответил вовремя)
+            logging.error(f"Ошибка записи {len(upserts) + len(deletes)} состояний FSM: {e}")
+            # Незаписанные изменения возвращаются в очередь и записываются следующей
+            # пачкой или повтором (обработчик продолжает работать с состоянием из памяти)
+            for key, _, _, _ in upserts:
+                self._pending.setdefault(key, pending[key])
+            for key, in deletes:
+                self._pending.setdefault(key, pending[key])
+            self._schedule_retry()
+
+    def expire(self, key: str) -> asyncio.Future:
+        """Удаление истекшего ключа из кэша и базы (fsm_expiry.FSMExpiry)"""
+        self._cache.pop(key, None)
+        return self._schedule_key(key, _Record())
+
+    def forget(self, keys):
+        """Ключи удалены из базы в обход хранилища - убираем их из кэша.
+
+        Ключ с незаписанным изменением остается: пользователь активен, и
+        запись вернет его строку.
+        """
+        for key in keys:
+            if key not in self._pending:
+                self._cache.pop(key, None)
+
+    # ---------- BaseStorage ----------
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state_name(state)
+        # Пачка общая для многих обработчиков: отмена одного не отменяет запись
+        await asyncio.shield(self._schedule(key, record))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = dict(data)
+        await asyncio.shield(self._schedule(key, record))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    def _replace(self, storage_key: StorageKey, state: StateType, data: Mapping[str, Any]) -> asyncio.Future:
+        """Замена состояния и данных ключа без чтения старой записи"""
+        key = self.key_builder.build(storage_key)
+        record = _Record(state_name(state), dict(data))
+        self._remember(key, record)
+        return self._schedule_key(key, record)
+
+    async def get_record(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Состояние и данные одним обращением к кэшу"""
+        record = await self._record(key)
+        return record.state, record.data.copy()
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        """Состояние и данные в одной пачке записи"""
+        await asyncio.shield(self._replace(key, state, data))
+
+    async def set_records(self, records) -> None:
+        """Состояния и данные нескольких ключей в одной пачке записи.
+
+        records - пары (StorageKey, состояние, данные).
+        """
+        batch = None
+        for key, state, data in records:
+            batch = self._replace(key, state, data)
+        if batch is not None:
+            await asyncio.shield(batch)
+
+    async def close(self) -> None:
+        """Запись оставшихся изменений при остановке бота"""
+        for task in (self._flush_task, self._retry_task):
+            if task is not None and not task.done():
+                task.cancel()
+        await self.flush()
+        # Писатель останавливается после close - повтор не планируется
+        if self._retry_task is not None:
+            self._retry_task.cancel()
+            self._retry_task = None
+
+    def stats(self) -> dict:
+        """Размер кэша и счетчики записи"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'max_entries': self.max_entries,
+            'pending': len(self._pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written
+        }
+
+
+# Поля хэша ключа FSM в Redis
+REDIS_STATE_FIELD = 's'
+REDIS_DATA_FIELD = 'd'
+
+
+def _text(value) -> Optional[str]:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class RedisFSMStorage(BaseStorage):
+    """Хранилище состояний FSM в Redis, общее для нескольких процессов бота"""
+
+    def __init__(self, redis, key_builder: KeyBuilder = None, ttl: Union[int, timedelta, None] = None):
+        # redis - клиент redis.asyncio.Redis (или совместимый, например fakeredis)
+        self.redis = redis
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        # Ключ без изменений дольше ttl удаляется самим Redis (None - бессрочно)
+        self.ttl = int(ttl.total_seconds()) if isinstance(ttl, timedelta) else ttl
+        self.round_trips = 0
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> 'RedisFSMStorage':
+        """Хранилище по адресу redis://host:port/db"""
+        from redis.asyncio import Redis
+        return cls(Redis.from_url(url), **kwargs)
+
+    def create_isolation(self):
+        """Блокировка обработки событий одного пользователя между процессами"""
+        from aiogram.fsm.storage.redis import RedisEventIsolation
+        return RedisEventIsolation(redis=self.redis, key_builder=self.key_builder)
+
+    def _queue_fields(self, pipe, name: str, fields: Mapping[str, Optional[str]]):
+        """Команды записи полей и продления TTL (пустое значение удаляет поле)"""
+        values = {field: value for field, value in fields.items() if value is not None}
+        removed = [field for field, value in fields.items() if value is None]
+        if removed:
+            # Хэш без полей Redis удаляет сам
+            pipe.hdel(name, *removed)
+        if values:
+            pipe.hset(name, mapping=values)
+            if self.ttl:
+                pipe.expire(name, self.ttl)
+
+    async def _write_fields(self, key: StorageKey, fields: Mapping[str, Optional[str]]):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_fields(pipe, self.key_builder.build(key), fields)
+            await self._execute(pipe)
+
+    async def _execute(self, pipe) -> list:
+        self.round_trips += 1
+        return await pipe.execute()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write_fields(key, {REDIS_STATE_FIELD: state_name(state)})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        self.round_trips += 1
+        return _text(await self.redis.hget(self.key_builder.build(key), REDIS_STATE_FIELD))
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write_fields(key, {REDIS_DATA_FIELD: dump_data(data)})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        self.round_trips += 1
+        return load_data(await self.redis.hget(self.key_builder.build(key), REDIS_DATA_FIELD))
+
+    async def get_record(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Состояние и данные одним запросом"""
+        self.round_trips += 1
+        state, data = await self.redis.hmget(self.key_builder.build(key), REDIS_STATE_FIELD, REDIS_DATA_FIELD)
+        return _text(state), load_data(data)
+
+    async def set_record(self, key: StorageKey, state: StateType, data: Mapping[str, Any]) -> None:
+        """Состояние и данные одним конвейером MULTI/EXEC"""
+        await self.set_records([(key, state, data)])
+
+    async def set_records(self, records) -> None:
+        """Состояния и данные нескольких ключей одним конвейером MULTI/EXEC.
+
+        records - пары (StorageKey, состояние, данные).
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for key, state, data in records:
+                self._queue_fields(pipe, self.key_builder.build(key), {
+                    REDIS_STATE_FIELD: state_name(state),
+                    REDIS_DATA_FIELD: dump_data(data)
+                })
+            await self._execute(pipe)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        """Слияние данных без потери изменений других процессов (WATCH/MULTI)"""
+        from redis.exceptions import WatchError
+
+        name = self.key_builder.build(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(name)
+                    self.round_trips += 1
+                    current = load_data(await pipe.hget(name, REDIS_DATA_FIELD))
+                    current.update(data)
+                    pipe.multi()
+                    self._queue_fields(pipe, name, {REDIS_DATA_FIELD: dump_data(current)})
+                    await self._execute(pipe)
+                    return current.copy()
+                except WatchError:
+                    # Ключ изменил другой процесс - читаем заново
+                    continue
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+    def stats(self) -> dict:
+        """Число обращений к Redis"""
+        return {'round_trips': self.round_trips, 'ttl': self.ttl}
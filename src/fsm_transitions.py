@@ -0,0 +1,80 @@
+# src/fsm_transitions.py
+"""
+Смена состояния FSM другого пользователя: решения модераторов по скриншотам.
+
+Модератор, одобривший или отклонивший скриншот, переводит участника в
+следующее состояние квеста. transition_user записывает состояние и данные
+участника одной операцией хранилища (set_record): участник не видит
+промежуточного состояния, когда новое состояние уже есть, а данных еще
+нет. transition_users переводит сразу нескольких участников одной
+операцией (set_records: одна пачка записи SQLiteStorage или один
+MULTI/EXEC в Redis).
+
+    await transition_user(state.storage, bot, telegram_id, Stage1States.waiting_for_riddle_answer, data)
+    await transition_users(state.storage, bot, [(telegram_id, None, {}) for telegram_id in rejected])
+
+Ключ участника - личный чат с ботом (chat_id = user_id = telegram_id).
+Хранилища без set_record/set_records (MemoryStorage) получают отдельные
+set_state и set_data.
+"""
+import logging
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from fsm_storage import state_name
+
+# (telegram_id, состояние, данные)
+Transition = Tuple[int, StateType, Optional[Mapping[str, Any]]]
+
+
+def user_key(bot_id: int, telegram_id: int) -> StorageKey:
+    """Ключ FSM пользователя в личном чате с ботом"""
+    return StorageKey(bot_id=bot_id, chat_id=telegram_id, user_id=telegram_id)
+
+
+async def transition_users(storage: BaseStorage, bot, transitions: Iterable[Transition]) -> bool:
+    """Перевод пользователей в новые состояния с новыми данными одной операцией хранилища"""
+    records = [
+        (user_key(bot.id, telegram_id), state_name(state), dict(data or {}))
+        for telegram_id, state, data in transitions
+    ]
+    if not records:
+        return True
+    try:
+        if hasattr(storage, 'set_records'):
+            await storage.set_records(records)
+        else:
+            for key, state, data in records:
+                await storage.set_state(key=key, state=state)
+                await storage.set_data(key=key, data=data)
+        return True
+    except Exception as e:
+        logging.error(f"❌ Ошибка смены состояния FSM {len(records)} пользователей: {e}")
+        return False
+
+
+async def transition_user(storage: BaseStorage, bot, telegram_id: int, state: StateType,
+                          data: Optional[Mapping[str, Any]] = None) -> bool:
+    """Перевод пользователя в состояние state с данными data (данные заменяются целиком)"""
+    success = await transition_users(storage, bot, [(telegram_id, state, data)])
+    if success:
+        logging.info(f"✅ Состояние пользователя {telegram_id}: {state_name(state)}")
+    return success
+
+
+async def clear_user(storage: BaseStorage, bot, telegram_id: int) -> bool:
+    """Сброс состояния и данных пользователя"""
+    return await transition_user(storage, bot, telegram_id, None)
+
+
+async def get_user_record(storage: BaseStorage, bot, telegram_id: int) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Текущие состояние и данные пользователя"""
+    key = user_key(bot.id, telegram_id)
+    try:
+        if hasattr(storage, 'get_record'):
+            return await storage.get_record(key)
+        return await storage.get_state(key=key), await storage.get_data(key=key)
+    except Exception as e:
+        logging.error(f"❌ Ошибка чтения состояния пользователя {telegram_id}: {e}")
+        return None, {}
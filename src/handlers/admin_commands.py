@@ -6,16 +6,17 @@ import logging
 # Добавляем путь к src для корректного импорта
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from aiogram.types import Message, FSInputFile
+from aiogram.types import Message, FSInputFile, BufferedInputFile
 from aiogram import Router, F
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
 import pandas as pd
 import tempfile
 from datetime import datetime
 from src.promo import promo_router
 
 try:
-    from database import db
+    from database import db, adb
     logging.info("✅ Database import successful in admin_commands.py")
 except ImportError as e:
     logging.error(f"❌ Database import failed in admin_commands.py: {e}")
@@ -23,26 +24,24 @@ except ImportError as e:
     class DatabaseStub:
         def get_connection(self):
             raise Exception("Database not available")
-        def get_raffle_participants(self):
+        async def run(self, func, *args, **kwargs):
+            raise Exception("Database not available")
+        async def get_user_role(self, telegram_id):
+            return None
+        async def get_raffle_participants(self):
             return []
-        def get_raffle_participants_count(self):
+        async def get_raffle_participants_count(self):
             return 0
-    db = DatabaseStub()
+    db = adb = DatabaseStub()
 
 # Создаем роутер для административных команд
 admin_router = Router()
 
-def is_admin(user_id: int) -> bool:
+async def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT role FROM main WHERE telegram_id = ?", 
-                (user_id,)
-            )
-            result = cursor.fetchone()
-            return result and result[0] in ['admin', 'moderator']
+        role = await adb.get_user_role(user_id)
+        return role in ['admin', 'moderator']
     except Exception as e:
         logging.error(f"Ошибка проверки прав администратора: {e}")
         return False
@@ -54,12 +53,12 @@ async def export_all_participants_to_excel(message: Message):
     
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
         # Получаем всех участников
-        participants = db.get_raffle_participants()
+        participants = await adb.get_raffle_participants()
         
         if not participants:
             await message.answer("📭 Нет зарегистрированных участников розыгрыша.")
@@ -121,12 +120,12 @@ async def show_all_participants(message: Message):
     """Показывает список всех участников розыгрыша"""
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
         # Получаем всех участников
-        participants = db.get_raffle_participants()
+        participants = await adb.get_raffle_participants()
         
         if not participants:
             await message.answer("📭 Нет зарегистрированных участников розыгрыша.")
@@ -174,12 +173,12 @@ async def delete_all_participants(message: Message):
     """Удаляет всех участников розыгрыша"""
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
         # Получаем количество участников перед удалением
-        participants_count = db.get_raffle_participants_count()
+        participants_count = await adb.get_raffle_participants_count()
         
         if participants_count == 0:
             await message.answer("📭 Нет участников для удаления.")
@@ -213,19 +212,18 @@ async def delete_all_participants(message: Message):
 async def confirm_delete_all_participants(message: Message):
     """Подтверждение удаления всех участников"""
     try:
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
         # Получаем количество участников перед удалением
-        participants_count = db.get_raffle_participants_count()
+        participants_count = await adb.get_raffle_participants_count()
         
         # Удаляем всех участников
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM raffle_participants")
-            deleted_count = cursor.rowcount
-            conn.commit()
+        if not await adb.delete_all_raffle_participants():
+            await message.answer("❌ Произошла ошибка при удалении участников.")
+            return
+        deleted_count = participants_count
         
         # Убираем клавиатуру подтверждения
         from aiogram.types import ReplyKeyboardRemove
@@ -267,64 +265,44 @@ async def address_command(message: Message):
     """Выгружает данные об адресах пользователей"""
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # SQL запрос для объединения данных из трех таблиц
-            query = """
-                SELECT 
-                    mu.last_name,
-                    mu.first_name,
-                    mu.middle_name,
-                    mu.phone,
-                    mu.email,
-                    ua.stage,
-                    ua.address,
-                    m.telegram_username
-                FROM user_addresses ua
-                LEFT JOIN main m ON ua.telegram_id = m.telegram_id
-                LEFT JOIN manual_upload mu ON mu.participant_id = m.participant_id
-                ORDER BY mu.last_name, mu.first_name
-            """
-            
-            cursor.execute(query)
-            results = cursor.fetchall()
-            
-            if not results:
-                await message.answer("📭 В базе данных нет записей об адресах пользователей.")
-                return
-            
-            # Формируем Excel файл
-            df = pd.DataFrame(results, columns=[
-                "Фамилия", "Имя", "Отчество", "Телефон", "Email", "Этап", "Адрес", "Telegram username"
-            ])
-            
-            # Создаем временный файл
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.xlsx', delete=False) as temp_file:
-                temp_filename = temp_file.name
-            
-            # Сохраняем в Excel
-            df.to_excel(temp_filename, index=False, engine='openpyxl')
-            
-            # Отправляем файл
-            file_for_send = FSInputFile(temp_filename)
-            await message.answer_document(
-                file_for_send,
-                caption=f"📋 *Данные об адресах пользователей*\n\n"
-                         f"📊 Всего записей: {len(results)}\n"
-                         f"📅 Дата выгрузки: {datetime.now().strftime('%d.%m.%Y %H:%M')}",
-                parse_mode="Markdown"
-            )
-            
-            # Удаляем временный файл
-            os.unlink(temp_filename)
-            
-            logging.info(f"Админ {message.from_user.id} выгрузил данные об адресах ({len(results)} записей)")
-            
+        # Данные из трех таблиц (user_addresses, main, manual_upload)
+        results = await adb.get_addresses_report()
+        
+        if not results:
+            await message.answer("📭 В базе данных нет записей об адресах пользователей.")
+            return
+        
+        # Формируем Excel файл
+        df = pd.DataFrame(results, columns=[
+            "Фамилия", "Имя", "Отчество", "Телефон", "Email", "Этап", "Адрес", "Telegram username"
+        ])
+        
+        # Создаем временный файл
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.xlsx', delete=False) as temp_file:
+            temp_filename = temp_file.name
+        
+        # Сохраняем в Excel
+        df.to_excel(temp_filename, index=False, engine='openpyxl')
+        
+        # Отправляем файл
+        file_for_send = FSInputFile(temp_filename)
+        await message.answer_document(
+            file_for_send,
+            caption=f"📋 *Данные об адресах пользователей*\n\n"
+                     f"📊 Всего записей: {len(results)}\n"
+                     f"📅 Дата выгрузки: {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+            parse_mode="Markdown"
+        )
+        
+        # Удаляем временный файл
+        os.unlink(temp_filename)
+        
+        logging.info(f"Админ {message.from_user.id} выгрузил данные об адресах ({len(results)} записей)")
+        
     except Exception as e:
         logging.error(f"Ошибка при выгрузке адресов: {e}")
         await message.answer("❌ Произошла ошибка при выгрузке данных об адресах.")
@@ -334,7 +312,7 @@ async def add_manual_data_command(message: Message):
     """Добавляет данные из Excel файла в таблицу manual_upload"""
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
@@ -485,7 +463,7 @@ def process_manual_upload(file_path):
 async def handle_manual_excel_upload(message: Message):
     """Обрабатывает загруженный Excel файл для добавления данных в manual_upload"""
     try:
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
@@ -506,7 +484,7 @@ async def handle_manual_excel_upload(message: Message):
 
         try:
             # Обрабатываем файл
-            result = process_manual_upload(temp_filename)
+            result = await adb.run(process_manual_upload, temp_filename)
             
             # Формируем отчет
             report = f"""
@@ -542,12 +520,354 @@ async def handle_manual_excel_upload(message: Message):
         await message.answer("❌ Произошла ошибка при обработке файла.")
 # ___________________
 
+@admin_router.message(Command("db_stats"))
+async def db_stats_command(message: Message, state: FSMContext):
+    """Показывает состояние пула соединений, писателя и кэша чтений"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        pool = db.pool.stats()
+        writer = db.writer.stats()
+        cache = db.cache.stats()
+
+        report = (
+            "🗄️ Состояние базы данных\n\n"
+            f"🔌 Пул: {pool['created']}/{pool['size']} соединений, "
+            f"свободно {pool['idle']}, сверх пула {pool['overflow']}\n"
+            f"✍️ Писатель: {writer['operations']} операций в {writer['batches']} транзакциях, "
+            f"в очереди {writer['queued']}\n"
+            f"⚡ Кэш: {cache['size']}/{cache['max_entries']} записей, TTL {cache['ttl']} с\n"
+            f"   попадания {cache['hits']}, промахи {cache['misses']}, "
+            f"вытеснено {cache['evictions']}, hit rate {cache['hit_rate']:.1%}"
+        )
+
+        if db.shard_paths:
+            writers = [writer.stats() for writer in db.shard_writers]
+            report += (
+                f"\n🧩 Шарды: {db.shard_count}, операций "
+                f"{', '.join(str(item['operations']) for item in writers)}, "
+                f"в очереди {sum(item['queued'] for item in writers)}"
+            )
+
+        # Хранилище FSM (fsm_storage.SQLiteStorage или RedisFSMStorage)
+        if hasattr(state.storage, 'stats'):
+            fsm = state.storage.stats()
+            report += (
+                f"\n🧭 FSM ({type(state.storage).__name__}): "
+                + ', '.join(f"{name} {value}" for name, value in fsm.items())
+            )
+
+        # Истечение состояний FSM (fsm_expiry.FSMExpiry)
+        expiry = getattr(state.storage, 'expiry', None)
+        if expiry is not None:
+            live = await expiry.live_states()
+            expiry_stats = expiry.stats()
+            report += (
+                f"\n⏳ Живых состояний FSM: {sum(live.values())} ("
+                + ', '.join(
+                    f"{name.rsplit(':', 1)[-1] if name else 'без состояния'} {count}"
+                    for name, count in sorted(live.items(), key=lambda item: -item[1])[:5]
+                )
+                + f"), в колесе {expiry_stats['tracked']}/{expiry_stats['max_tracked']}, "
+                f"истекло {expiry_stats['expired'] + expiry_stats['swept']}"
+            )
+
+        if db.snapshots is not None:
+            snapshots = db.snapshots.stats()
+            age = snapshots['replica_age']
+            age_text = f"{age / 60:.1f} мин" if age is not None else "нет"
+            report += (
+                f"\n📸 Реплика: возраст {age_text} (допустимо {snapshots['max_staleness'] / 60:g} мин), "
+                f"резервных копий {snapshots['backups']}"
+            )
+
+        if db.maintenance is not None and db.maintenance.last_run:
+            last_run = db.maintenance.last_run
+            report += (
+                f"\n🧹 Обслуживание: {last_run['finished_at']}, {last_run['seconds']:.2f} с, "
+                f"освобождено страниц {last_run.get('reclaimed_pages', 0)}"
+            )
+
+        await message.answer(report)
+
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики БД: {e}")
+        await message.answer("❌ Произошла ошибка при получении статистики БД.")
+
+@admin_router.message(Command("slow_queries"))
+async def slow_queries_command(message: Message):
+    """Самые затратные запросы и последние медленные запросы к БД"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        args = message.text.split()[1:]
+        if args and args[0] == 'reset':
+            db.query_stats.reset()
+            logging.info(f"Админ {message.from_user.id} сбросил статистику запросов")
+            await message.answer("✅ Статистика запросов сброшена.")
+            return
+        limit = int(args[0]) if args and args[0].isdigit() else 10
+
+        stats = db.query_stats
+        since = datetime.fromtimestamp(stats.started_at).strftime('%d.%m.%Y %H:%M')
+        lines = [
+            f"🐢 Запросы к БД с {since}, порог медленного запроса {stats.slow_threshold * 1000:g} мс\n",
+            f"📊 Топ-{limit} по суммарному времени:"
+        ]
+        for number, item in enumerate(stats.top(limit), 1):
+            lines.append(
+                f"{number}. {item['total_ms']:.0f} мс всего, {item['calls']} вызовов, "
+                f"среднее {item['avg_ms']:.2f} мс, max {item['max_ms']:.1f} мс, "
+                f"строк {item['rows']}, медленных {item['slow']}\n"
+                f"   {item['sql'][:150]}"
+            )
+
+        slow = stats.slow_queries(5)
+        if slow:
+            lines.append("\n⏱️ Последние медленные запросы:")
+            for item in slow:
+                lines.append(
+                    f"• {item['at']} {item['ms']:.0f} мс, строк {item['rows']}, {item['caller']}\n"
+                    f"   {item['sql'][:150]}"
+                )
+
+        # Без parse_mode: в тексте SQL встречаются * и _
+        report = "\n".join(lines)
+        await message.answer(report[:4000])
+
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики запросов: {e}")
+        await message.answer("❌ Произошла ошибка при получении статистики запросов.")
+
+@admin_router.message(Command("query_metrics"))
+async def query_metrics_command(message: Message):
+    """Выгрузка статистики запросов в формате Prometheus"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        metrics = db.query_stats.export_prometheus()
+        filename = f"query_metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prom"
+        await message.answer_document(
+            BufferedInputFile(metrics.encode('utf-8'), filename=filename),
+            caption=f"📈 Метрики запросов к БД: {len(db.query_stats.snapshot())} запросов"
+        )
+
+    except Exception as e:
+        logging.error(f"Ошибка при выгрузке метрик запросов: {e}")
+        await message.answer("❌ Произошла ошибка при выгрузке метрик запросов.")
+
+@admin_router.message(Command("archive"))
+async def archive_command(message: Message):
+    """Размеры рабочих и архивных таблиц, /archive compact - перенос в архив"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        if db.retention is None:
+            await message.answer("❌ Архив не настроен.")
+            return
+
+        # Основная база и шарды (пользовательские таблицы в режиме шардирования)
+        retentions = [db.retention] + [maintenance.retention for maintenance in db.shard_maintenance]
+
+        args = message.text.split()[1:]
+        if args and args[0] == 'compact':
+            await message.answer("⏳ Переносим устаревшие записи в архив...")
+            results = [await adb.run(retention.compact) for retention in retentions]
+            if None in results:
+                await message.answer("⏳ Перенос в архив уже выполняется.")
+                return
+            errors = [result['error'] for result in results if 'error' in result]
+            if errors:
+                await message.answer(f"❌ Ошибка переноса в архив: {errors[0]}")
+                return
+            logging.info(f"Админ {message.from_user.id} запустил перенос в архив: {results}")
+            await message.answer(
+                f"✅ Перенесено за {sum(result['seconds'] for result in results):.1f} с:\n"
+                f"• user_data: {sum(result['user_data'] for result in results)}\n"
+                f"• verification: {sum(result['verification'] for result in results)}"
+            )
+
+        all_stats = [await adb.run(retention.stats) for retention in retentions]
+        errors = [item['error'] for item in all_stats if 'error' in item]
+        if errors:
+            await message.answer(f"❌ Ошибка получения статистики архива: {errors[0]}")
+            return
+        stats = all_stats[0]
+        for item in all_stats[1:]:
+            for key in ('user_data', 'user_data_archive', 'verification', 'verification_archive'):
+                stats[key] += item[key]
+            stats['archive_bytes'] = stats.get('archive_bytes', 0) + item.get('archive_bytes', 0)
+
+        event = stats['event_started_at']
+        report = (
+            "🗃️ Архив данных\n\n"
+            f"📅 Начало мероприятия: {event.strftime('%d.%m.%Y %H:%M') if event else 'не задано'}\n"
+            f"📁 Архив: {stats['archive_path'] or 'в основной базе'}"
+        )
+        if stats['archive_path']:
+            report += f" ({stats['archive_bytes'] / 1024 / 1024:.1f} МБ)"
+        report += (
+            f"\n\n• user_data: {stats['user_data']} в работе, {stats['user_data_archive']} в архиве\n"
+            f"• verification: {stats['verification']} в работе, {stats['verification_archive']} в архиве"
+        )
+        if stats['last_run']:
+            report += f"\n\n🕒 Последний перенос: {stats['last_run']['finished_at']}"
+        report += "\n\n/archive compact - перенести устаревшие записи сейчас"
+        await message.answer(report)
+
+    except Exception as e:
+        logging.error(f"Ошибка при работе с архивом: {e}")
+        await message.answer("❌ Произошла ошибка при работе с архивом.")
+
+@admin_router.message(Command("analytics"))
+async def analytics_command(message: Message):
+    """Разбивка участников по этапам и распределение дистанций по снимку analytics"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        if db.analytics is None:
+            await message.answer("❌ Аналитика не запущена.")
+            return
+
+        stages = await adb.run(db.analytics.stage_breakdown)
+        histogram = await adb.run(db.analytics.distance_histogram)
+        snapshot = db.analytics.stats()
+
+        lines = ["📈 Аналитика участников\n"]
+        for stage in stages:
+            completed = ", ".join(f"{number}: {count}" for number, count in stage['completed'].items())
+            lines.append(
+                f"📋 {stage['stage_name']}\n"
+                f"• участников: {stage['participants']}, в боте: {stage['registered']}\n"
+                f"• начали квест: {stage['quest_started']}, прошли этапы: {completed}\n"
+                f"• пробежек подтверждено: {stage['verified']}"
+            )
+
+        lines.append("\n🏃 Дистанции (всего / подтверждено):")
+        for low, high, total, verified in histogram:
+            label = f"от {low:g} км" if high == float('inf') else f"{low:g}–{high:g} км"
+            lines.append(f"• {label}: {total} / {verified}")
+
+        updated = datetime.fromtimestamp(snapshot['loaded_at']).strftime('%H:%M:%S') if snapshot['loaded_at'] else "—"
+        lines.append(
+            f"\n🕒 Снимок от {updated}: {snapshot['rows']} строк, "
+            f"{snapshot['bytes'] / 1024 / 1024:.1f} МБ"
+        )
+
+        # Без parse_mode: в названиях этапов встречаются символы разметки
+        report = "\n".join(lines)
+        for i in range(0, len(report), 4000):
+            await message.answer(report[i:i + 4000])
+
+        logging.info(f"Админ {message.from_user.id} запросил аналитику участников")
+
+    except Exception as e:
+        logging.error(f"Ошибка при получении аналитики: {e}")
+        await message.answer("❌ Произошла ошибка при получении аналитики.")
+
+@admin_router.message(Command("find"))
+async def find_participant_command(message: Message):
+    """Поиск участников по ФИО, email, телефону или telegram username"""
+    try:
+        # Проверяем права администратора
+        if not await is_admin(message.from_user.id):
+            await message.answer("❌ У вас нет прав для выполнения этой команды.")
+            return
+
+        parts = message.text.split(maxsplit=1)
+        if len(parts) < 2 or not parts[1].strip():
+            await message.answer(
+                "🔍 Использование: /find <запрос>\n\n"
+                "Примеры:\n"
+                "/find Иванов Петр\n"
+                "/find ivan@mail.ru\n"
+                "/find 9161234567\n"
+                "/find @username"
+            )
+            return
+
+        query = parts[1].strip()
+        found = await adb.search_participants(query)
+        results = found['results']
+        if not results:
+            await message.answer(f"🔍 По запросу «{query}» ничего не найдено.")
+            return
+
+        blocks = []
+        for item in results:
+            full_name = " ".join(
+                part for part in (item['last_name'], item['first_name'], item['middle_name']) if part
+            )
+            lines = [
+                f"👤 {full_name} (ID {item['participant_id']}, этап {item['stage_id']})",
+                f"📧 {item['email']}  📱 {item['phone']}"
+            ]
+
+            if item['telegram_id']:
+                username = f"@{item['telegram_username']}" if item['telegram_username'] else "без username"
+                lines.append(f"💬 {username}, telegram_id {item['telegram_id']}")
+            else:
+                lines.append("💬 Не зарегистрирован в боте")
+
+            if item['universal_link'] is None:
+                lines.append("🔗 Ссылка не создана")
+            else:
+                link_state = "активна" if item['link_status'] == 1 else "неактивна"
+                mailing = item['mailing_date'] or "не отправлено"
+                clicked = item['link_click_date'] or "нет"
+                lines.append(f"🔗 Ссылка {link_state}, письмо: {mailing}, переход: {clicked}")
+
+            if item['telegram_id']:
+                completed = ", ".join(str(stage) for stage in item['completed_stages']) or "нет"
+                lines.append(f"🏁 Пройдены этапы: {completed} (текущий {item['current_stage']})")
+
+            if item['run_date'] is not None:
+                check = "✅ подтверждена" if item['answer_check'] else "❌ не подтверждена"
+                lines.append(f"🏃 Пробежка {item['distance']} км, {item['run_date']}, {check}")
+            else:
+                lines.append("🏃 Пробежка не загружена")
+
+            blocks.append("\n".join(lines))
+
+        # Без parse_mode: в ФИО и email встречаются символы разметки
+        if found['ranked']:
+            header = f"🔍 Найдено по запросу «{query}»: {found['matches']}\n\n"
+        else:
+            header = (
+                f"🔍 По запросу «{query}» больше {found['matches'] - 1} совпадений, "
+                f"показаны первые {len(results)}. Уточните запрос.\n\n"
+            )
+        report = header + "\n\n".join(blocks)
+        for i in range(0, len(report), 4000):
+            await message.answer(report[i:i + 4000])
+
+        logging.info(f"Админ {message.from_user.id} искал участников: '{query}', совпадений {found['matches']}")
+
+    except Exception as e:
+        logging.error(f"Ошибка при поиске участников: {e}")
+        await message.answer("❌ Произошла ошибка при поиске участников.")
+
 @admin_router.message(Command("admin_help"))
 async def admin_help_command(message: Message):
     """Показывает все доступные административные команды"""
     try:
         # Проверяем права администратора
-        if not is_admin(message.from_user.id):
+        if not await is_admin(message.from_user.id):
             await message.answer("❌ У вас нет прав для выполнения этой команды.")
             return
 
@@ -555,6 +875,8 @@ async def admin_help_command(message: Message):
 🔧 *СПРАВКА ПО АДМИНИСТРАТИВНЫМ КОМАНДАМ*
 
 📊 *Управление участниками:*
+• `/find <запрос>` - Поиск участника по ФИО, email, телефону или username
+• `/analytics` - Разбивка участников по этапам и дистанциям
 • `/add` - Обновить пользователей из файла Excel
 • `/address` - Выгрузить данные об адресах пользователей
 • `/all` - Показать всех участников розыгрыша (-)
@@ -582,6 +904,10 @@ async def admin_help_command(message: Message):
 • `/my_promo` - Мои промокоды (для пользователей) (-)
 
 📋 *Общие:*
+• `/db_stats` - Состояние пула, писателя и кэша БД
+• `/slow_queries [N|reset]` - Самые затратные и медленные запросы к БД
+• `/query_metrics` - Метрики запросов к БД (Prometheus)
+• `/archive [compact]` - Размер архива скриншотов и проверок, перенос в архив
 • `/admin_help` - Эта справка
 
 ⚠️ *Примечания:*
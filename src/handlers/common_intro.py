@@ -6,7 +6,7 @@
 import asyncio
 
 
-def get_common_intro(stage_id: int) -> str:
+async def get_common_intro(stage_id: int) -> str:
     """
     Возвращает общее вступление для всех этапов
     
@@ -16,7 +16,7 @@ def get_common_intro(stage_id: int) -> str:
     Returns:
         str: Текст вступления с названием этапа
     """
-    stage_name = get_stage_name_from_db(stage_id)
+    stage_name = await get_stage_name_from_db(stage_id)
     return (
         "🔍 *Подозреваемый, известный как «БЕЗЛИКИЙ», действует нагло и оставляет ироничные улики.*\n\n"
         "Каждая пропавшая игрушка – это часть головоломки от общей детективной истории!\n"
@@ -105,7 +105,7 @@ def get_common_final_hint(hint: str) -> str:
     )
 
 
-def save_user_data_to_db(telegram_id: int, image_path: str) -> bool:
+async def save_user_data_to_db(telegram_id: int, image_path: str) -> bool:
     """
     Сохраняет данные пользователя в базу данных
     
@@ -117,41 +117,19 @@ def save_user_data_to_db(telegram_id: int, image_path: str) -> bool:
         bool: Успешно ли сохранение
     """
     try:
-        from database import db
+        from database import adb
         import logging
         
         logging.info(f"Сохранение данных для пользователя {telegram_id}, путь: {image_path}")
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем user_id
-            cursor.execute('SELECT user_id FROM main WHERE telegram_id = ?', (telegram_id,))
-            user_result = cursor.fetchone()
-            
-            if user_result:
-                user_id = user_result[0]
-                logging.info(f"Найден user_id: {user_id} для telegram_id: {telegram_id}")
-                
-                # Сохраняем в user_data (без stage_number)
-                cursor.execute('''
-                    INSERT INTO user_data (user_id, image_url, answer_text)
-                    VALUES (?, ?, NULL)
-                ''', (user_id, image_path))
-                
-                conn.commit()
-                logging.info(f"Успешно сохранены данные для user_id: {user_id}")
-                return True
-            else:
-                logging.warning(f"Не найден user_id для telegram_id: {telegram_id}")
-        return False
+        return await adb.add_user_image(telegram_id, image_path)
     except Exception as e:
         import logging
         logging.error(f"Ошибка при сохранении данных пользователя {telegram_id}: {e}")
         return False
 
 
-def update_user_answer_in_db(telegram_id: int, answer: str) -> bool:
+async def update_user_answer_in_db(telegram_id: int, answer: str) -> bool:
     """
     Обновляет ответ пользователя в базе данных
     
@@ -163,57 +141,19 @@ def update_user_answer_in_db(telegram_id: int, answer: str) -> bool:
         bool: Успешно ли обновление
     """
     try:
-        from database import db
+        from database import adb
         import logging
         
         logging.info(f"Обновление ответа для пользователя {telegram_id}, ответ: {answer}")
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем user_id
-            cursor.execute('SELECT user_id FROM main WHERE telegram_id = ?', (telegram_id,))
-            user_result = cursor.fetchone()
-            
-            if user_result:
-                user_id = user_result[0]
-                logging.info(f"Найден user_id: {user_id} для telegram_id: {telegram_id}")
-                
-                # Получаем последнюю запись для этого пользователя
-                cursor.execute('''
-                    SELECT data_id FROM user_data 
-                    WHERE user_id = ?
-                    ORDER BY data_id DESC LIMIT 1
-                ''', (user_id,))
-                
-                data_result = cursor.fetchone()
-                
-                if data_result:
-                    data_id = data_result[0]
-                    logging.info(f"Найдена запись data_id: {data_id} для обновления")
-                    
-                    # Обновляем ответ в user_data
-                    cursor.execute('''
-                        UPDATE user_data 
-                        SET answer_text = ?
-                        WHERE data_id = ?
-                    ''', (answer, data_id))
-                    
-                    conn.commit()
-                    logging.info(f"Успешно обновлен ответ для data_id: {data_id}")
-                    return True
-                else:
-                    logging.warning(f"Не найдено записей для user_id: {user_id}")
-            else:
-                logging.warning(f"Не найден user_id для telegram_id: {telegram_id}")
-        return False
+        return await adb.update_last_user_answer(telegram_id, answer)
     except Exception as e:
         import logging
         logging.error(f"Ошибка при обновлении ответа пользователя {telegram_id}: {e}")
         return False
 
 
-def get_stage_name_from_db(stage_id: int) -> str:
+async def get_stage_name_from_db(stage_id: int) -> str:
     """
     Получает название этапа из базы данных
     
@@ -224,14 +164,17 @@ def get_stage_name_from_db(stage_id: int) -> str:
         str: Название этапа из БД
     """
     try:
-        from database import db
+        from database import db, adb
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
-            result = cursor.fetchone()
-            if result:
-                return result[0]
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
+                return cursor.fetchone()
+        
+        result = await adb.run(_load)
+        if result:
+            return result[0]
         
         # Если не нашли в БД, возвращаем базовое название
         return f"Этап {stage_id}"
@@ -254,16 +197,19 @@ async def get_user_current_stage_from_db(telegram_id: int) -> int:
         int: Текущий этап пользователя
     """
     try:
-        from database import db
+        from database import db, adb
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT current_stage FROM main WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            result = cursor.fetchone()
-            return result[0] if result else 1
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT current_stage FROM main WHERE telegram_id = ?",
+                    (telegram_id,)
+                )
+                return cursor.fetchone()
+        
+        result = await adb.run(_load)
+        return result[0] if result else 1
     except Exception as e:
         import logging
         logging.error(f"Ошибка при получении current_stage для {telegram_id}: {e}")
@@ -282,20 +228,13 @@ async def update_user_stage_in_db(telegram_id: int, new_stage: int) -> bool:
         bool: Успешно ли обновление
     """
     try:
-        from database import db
+        from database import adb
         import logging
         
         logging.info(f"Обновление этапа для пользователя {telegram_id} на {new_stage}")
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE main SET current_stage = ? WHERE telegram_id = ?",
-                (new_stage, telegram_id)
-            )
-            conn.commit()
-            logging.info(f"Успешно обновлен этап для пользователя {telegram_id} на {new_stage}")
-            return True
+        # Запись через писателя шарда пользователя (кэш сбрасывается там же)
+        return await adb.update_user_current_stage(telegram_id, new_stage)
     except Exception as e:
         import logging
         logging.error(f"Ошибка при обновлении этапа пользователя {telegram_id}: {e}")
@@ -313,18 +252,21 @@ async def check_if_stage_5_user(telegram_id: int) -> bool:
         bool: True если пользователь stage_5
     """
     try:
-        from database import db
+        from database import db, adb
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT stage_id FROM manual_upload mu "
-                "JOIN main m ON mu.participant_id = m.participant_id "
-                "WHERE m.telegram_id = ?",
-                (telegram_id,)
-            )
-            result = cursor.fetchone()
-            return result and result[0] == 5  # stage_id = 5 означает 5-й этап
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT stage_id FROM manual_upload mu "
+                    "JOIN main m ON mu.participant_id = m.participant_id "
+                    "WHERE m.telegram_id = ?",
+                    (telegram_id,)
+                )
+                return cursor.fetchone()
+        
+        result = await adb.run(_load)
+        return result and result[0] == 5  # stage_id = 5 означает 5-й этап
     except Exception as e:
         import logging
         logging.error(f"Ошибка проверки stage_5 пользователя {telegram_id}: {e}")
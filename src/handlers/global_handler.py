@@ -3,18 +3,26 @@
 import logging
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
-from database import db
+from database import adb
 
 logger = logging.getLogger('bot')
 
 async def is_stage_completed(telegram_id: int, stage: int) -> bool:
     """Проверяет, завершен ли этап для пользователя"""
     try:
-        return db.is_stage_completed(telegram_id, stage)
+        return await adb.is_stage_completed(telegram_id, stage)
     except Exception as e:
         logger.error(f"Ошибка проверки завершения этапа {stage}: {e}")
         return False
 
+async def get_completed_stages(telegram_id: int) -> list:
+    """Возвращает список завершенных этапов пользователя"""
+    try:
+        return await adb.get_completed_stages(telegram_id)
+    except Exception as e:
+        logger.error(f"Ошибка получения завершенных этапов: {e}")
+        return []
+
 async def handle_global_unknown_messages(message: Message, state: FSMContext):
     """Глобальный обработчик для всех неизвестных сообщений"""
     telegram_id = message.from_user.id
@@ -32,50 +40,10 @@ async def handle_global_unknown_messages(message: Message, state: FSMContext):
     
     # ✅ Если пользователь не в состоянии этапа, проверяем завершенность этапов
     try:
-        # Проверяем все этапы в обратном порядке (сначала последние)
-        # Это нужно, потому что если пользователь завершил этап 4, 
-        # он автоматически завершил и предыдущие этапы
-        
-        # Сначала проверяем этап 4
-        stage_4_completed = await is_stage_completed(telegram_id, 4)
-        if stage_4_completed:
-            logger.info(f"📊 Пользователь {telegram_id} завершил этап 4 - отправляем стандартное сообщение")
-            await message.answer(
-                "🤔 *Я не понимаю, о чем Вы говорите.*\n\n"
-                "👋 Для участия в забеге используйте ссылку от организатора.\n"
-                "Для навигации используйте /menu.",
-                parse_mode="Markdown"
-            )
-            return True
-        
-        # Затем проверяем этап 3
-        stage_3_completed = await is_stage_completed(telegram_id, 3)
-        if stage_3_completed:
-            logger.info(f"📊 Пользователь {telegram_id} завершил этап 3 - отправляем стандартное сообщение")
-            await message.answer(
-                "🤔 *Я не понимаю, о чем Вы говорите.*\n\n"
-                "👋 Для участия в забеге используйте ссылку от организатора.\n"
-                "Для навигации используйте /menu.",
-                parse_mode="Markdown"
-            )
-            return True
-        
-        # Затем проверяем этап 2
-        stage_2_completed = await is_stage_completed(telegram_id, 2)
-        if stage_2_completed:
-            logger.info(f"📊 Пользователь {telegram_id} завершил этап 2 - отправляем стандартное сообщение")
-            await message.answer(
-                "🤔 *Я не понимаю, о чем Вы говорите.*\n\n"
-                "👋 Для участия в забеге используйте ссылку от организатора.\n"
-                "Для навигации используйте /menu.",
-                parse_mode="Markdown"
-            )
-            return True
-        
-        # Затем проверяем этап 1
-        stage_1_completed = await is_stage_completed(telegram_id, 1)
-        if stage_1_completed:
-            logger.info(f"📊 Пользователь {telegram_id} завершил этап 1 - отправляем стандартное сообщение")
+        # Одним запросом получаем маску завершенных этапов
+        completed_stages = await get_completed_stages(telegram_id)
+        if completed_stages:
+            logger.info(f"📊 Пользователь {telegram_id} завершил этап {max(completed_stages)} - отправляем стандартное сообщение")
             await message.answer(
                 "🤔 *Я не понимаю, о чем Вы говорите.*\n\n"
                 "👋 Для участия в забеге используйте ссылку от организатора.\n"
@@ -7,7 +7,7 @@ import string
 import asyncio
 from typing import Optional
 from datetime import datetime
-from database import db
+from database import db, adb
 
 def generate_unique_link(length=16):
     """Генерация уникальной ссылки"""
@@ -61,9 +61,7 @@ class LinkGenerationScheduler:
     async def generate_links_automatically(self):
         """Автоматическая генерация ссылок для новых пользователей"""
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 # Получаем всех пользователей из manual_upload без ссылок
                 cursor.execute('''
                     SELECT mu.participant_id, mu.last_name, mu.first_name 
@@ -89,15 +87,14 @@ class LinkGenerationScheduler:
                     generated_count += 1
                     
                     self.logger.info(f"🤖 Автоматически создана ссылка для participant_id {participant_id}: {last_name} {first_name}")
-                
-                conn.commit()
-                
+
                 return {
                     'generated': generated_count,
                     'total': len(users_without_links),
                     'timestamp': datetime.now().isoformat()
                 }
-                
+
+            return await adb.write(_write)
         except Exception as e:
             self.logger.error(f"❌ Ошибка при автоматической генерации ссылок: {e}")
             return {'generated': 0, 'total': 0, 'error': str(e)}
@@ -167,29 +164,16 @@ def is_link_scheduler_running() -> bool:
 async def get_link_scheduler_status() -> dict:
     """Получение статуса планировщика"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_users,
-                    SUM(CASE WHEN lg.participant_id IS NOT NULL THEN 1 ELSE 0 END) as users_with_links,
-                    SUM(CASE WHEN lg.participant_id IS NULL THEN 1 ELSE 0 END) as users_without_links
-                FROM manual_upload mu
-                LEFT JOIN link_generation lg ON mu.participant_id = lg.participant_id
-            ''')
-            
-            stats = cursor.fetchone()
-            total_users, users_with_links, users_without_links = stats
-            
-            return {
-                'scheduler_running': is_link_scheduler_running(),
-                'total_users': total_users,
-                'users_with_links': users_with_links,
-                'users_without_links': users_without_links,
-                'timestamp': datetime.now().isoformat()
-            }
-            
+        stats = await adb.run(db.analytics.link_summary)
+
+        return {
+            'scheduler_running': is_link_scheduler_running(),
+            'total_users': stats['total_users'],
+            'users_with_links': stats['users_with_links'],
+            'users_without_links': stats['total_users'] - stats['users_with_links'],
+            'timestamp': datetime.now().isoformat()
+        }
+
     except Exception as e:
         return {
             'scheduler_running': is_link_scheduler_running(),
@@ -207,21 +191,18 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
     async def generate_all_links_command(message: Message):
         """Генерация ссылок только для пользователей без ссылок из manual_upload"""
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
+            def _write(cursor):
                 # Получаем всех пользователей из manual_upload
                 cursor.execute('''
-                    SELECT participant_id, last_name, first_name 
+                    SELECT participant_id, last_name, first_name
                     FROM manual_upload
                 ''')
-                
+
                 users = cursor.fetchall()
-                
+
                 if not users:
-                    await message.answer("❌ В таблице manual_upload нет пользователей")
-                    return
-                
+                    return None
+
                 generated_count = 0
                 skipped_count = 0
                 
@@ -248,19 +229,26 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
                         ''', (participant_id, new_link))
                         generated_count += 1
                         logger.info(f"Создана ссылка для participant_id {participant_id}: {last_name} {first_name} (mailing_date = NULL)")
-                
-                conn.commit()
-                
-                await message.answer(
-                    f"✅ Ссылки успешно сгенерированы!\n\n"
-                    f"👥 Всего пользователей: {len(users)}\n"
-                    f"🆕 Создано новых ссылок: {generated_count}\n"
-                    f"⏭️ Пропущено (уже есть ссылки): {skipped_count}\n\n"
-                    f"📧 <b>Новые пользователи готовы к рассылке!</b>\n"
-                    f"Используйте команду /get_links чтобы получить ссылки для отправки участникам.",
-                    parse_mode="HTML"
-                )
-                
+
+                return len(users), generated_count, skipped_count
+
+            result = await adb.write(_write)
+
+            if result is None:
+                await message.answer("❌ В таблице manual_upload нет пользователей")
+                return
+
+            total_users, generated_count, skipped_count = result
+            await message.answer(
+                f"✅ Ссылки успешно сгенерированы!\n\n"
+                f"👥 Всего пользователей: {total_users}\n"
+                f"🆕 Создано новых ссылок: {generated_count}\n"
+                f"⏭️ Пропущено (уже есть ссылки): {skipped_count}\n\n"
+                f"📧 <b>Новые пользователи готовы к рассылке!</b>\n"
+                f"Используйте команду /get_links чтобы получить ссылки для отправки участникам.",
+                parse_mode="HTML"
+            )
+
         except Exception as e:
             logger.error(f"Ошибка при генерации ссылок: {e}", exc_info=True)
             await message.answer("❌ Произошла ошибка при генерации ссылок")
@@ -350,7 +338,7 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
     async def get_links_command(message: Message):
         """Получение всех активных ссылок в формате Telegram ссылок"""
         try:
-            with db.get_connection() as conn:
+            with db.get_report_connection() as conn:
                 cursor = conn.cursor()
                 
                 # Получаем все активные ссылки с информацией о пользователях
@@ -408,7 +396,7 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
     async def get_links_compact_command(message: Message):
         """Компактный вывод ссылок (только ссылки)"""
         try:
-            with db.get_connection() as conn:
+            with db.get_report_connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
@@ -442,40 +430,26 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
     async def get_link_stats_command(message: Message):
         """Получение статистики по ссылкам"""
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Статистика по ссылкам
-                cursor.execute('''
-                    SELECT 
-                        COUNT(*) as total_users,
-                        SUM(CASE WHEN lg.participant_id IS NOT NULL THEN 1 ELSE 0 END) as users_with_links,
-                        SUM(CASE WHEN lg.status = 1 THEN 1 ELSE 0 END) as active_links,
-                        SUM(CASE WHEN lg.status = 0 THEN 1 ELSE 0 END) as used_links,
-                        SUM(CASE WHEN m.participant_id IS NOT NULL THEN 1 ELSE 0 END) as registered_users,
-                        SUM(CASE WHEN lg.mailing_date IS NULL AND lg.status = 1 THEN 1 ELSE 0 END) as pending_mailing
-                    FROM manual_upload mu
-                    LEFT JOIN link_generation lg ON mu.participant_id = lg.participant_id
-                    LEFT JOIN main m ON mu.participant_id = m.participant_id
-                ''')
-                
-                stats = cursor.fetchone()
-                total_users, users_with_links, active_links, used_links, registered_users, pending_mailing = stats
-                
-                stats_message = (
-                    "📊 **Статистика ссылок:**\n\n"
-                    f"👥 Всего пользователей: {total_users}\n"
-                    f"🔗 Пользователей с ссылками: {users_with_links}\n"
-                    f"✅ Активных ссылок: {active_links}\n"
-                    f"❌ Использованных ссылок: {used_links}\n"
-                    f"🎯 Зарегистрированных: {registered_users}\n"
-                    f"📧 Ожидают рассылки: {pending_mailing}\n\n"
-                    f"📈 Охват: {registered_users}/{total_users} ({registered_users/total_users*100:.1f}%)"
-                )
-                
-                await message.answer(stats_message, parse_mode="Markdown")
-                logger.info(f"Пользователь {message.from_user.id} запросил статистику ссылок")
-                
+            # Статистика по ссылкам из колоночного снимка участников
+            stats = await adb.run(db.analytics.link_summary)
+            total_users = stats['total_users']
+            registered_users = stats['registered_users']
+            coverage = registered_users / total_users * 100 if total_users else 0.0
+
+            stats_message = (
+                "📊 **Статистика ссылок:**\n\n"
+                f"👥 Всего пользователей: {total_users}\n"
+                f"🔗 Пользователей с ссылками: {stats['users_with_links']}\n"
+                f"✅ Активных ссылок: {stats['active_links']}\n"
+                f"❌ Использованных ссылок: {stats['used_links']}\n"
+                f"🎯 Зарегистрированных: {registered_users}\n"
+                f"📧 Ожидают рассылки: {stats['pending_mailing']}\n\n"
+                f"📈 Охват: {registered_users}/{total_users} ({coverage:.1f}%)"
+            )
+
+            await message.answer(stats_message, parse_mode="Markdown")
+            logger.info(f"Пользователь {message.from_user.id} запросил статистику ссылок")
+
         except Exception as e:
             logger.error(f"Ошибка при получении статистики: {e}", exc_info=True)
             await message.answer("❌ Произошла ошибка при получении статистики")
@@ -484,26 +458,16 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
     async def reset_mailing_dates_command(message: Message):
         """Сброс mailing_date для всех активных ссылок (для тестирования)"""
         try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Сбрасываем mailing_date для всех активных ссылок
-                cursor.execute('''
-                    UPDATE link_generation 
-                    SET mailing_date = NULL 
-                    WHERE status = 1
-                ''')
-                
-                affected_rows = cursor.rowcount
-                conn.commit()
-                
-                await message.answer(
-                    f"🔄 Сброшены даты рассылки для {affected_rows} активных ссылок\n\n"
-                    f"📧 Теперь все активные пользователи готовы к рассылке!",
-                    parse_mode="HTML"
-                )
-                logger.info(f"Сброшены mailing_date для {affected_rows} активных ссылок")
-                
+            # Сбрасываем mailing_date для всех активных ссылок одним UPDATE
+            affected_rows = await adb.reset_mailing_dates()
+
+            await message.answer(
+                f"🔄 Сброшены даты рассылки для {affected_rows} активных ссылок\n\n"
+                f"📧 Теперь все активные пользователи готовы к рассылке!",
+                parse_mode="HTML"
+            )
+            logger.info(f"Сброшены mailing_date для {affected_rows} активных ссылок")
+
         except Exception as e:
             logger.error(f"Ошибка при сбросе mailing_date: {e}", exc_info=True)
             await message.answer("❌ Произошла ошибка при сбросе дат рассылки")
@@ -512,87 +476,24 @@ def setup_link_generation_handler(dp, logger: logging.Logger, bot_username: str)
 def handle_link_click(universal_link: str, telegram_id: int, telegram_username: str = None, logger: logging.Logger = None):
     """Обработка перехода по ссылке и регистрация участника"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # 1. Находим ссылку
-            cursor.execute('''
-                SELECT lg.participant_id, mu.last_name, mu.first_name, lg.status
-                FROM link_generation lg
-                JOIN manual_upload mu ON lg.participant_id = mu.participant_id
-                WHERE lg.universal_link = ?
-            ''', (universal_link,))
-            
-            link_data = cursor.fetchone()
-            
-            if not link_data:
-                return False, "Ссылка не найдена или недействительна"
-            
-            participant_id, last_name, first_name, status = link_data
-            
-            if status == 0:
-                return False, "Эта ссылка уже использована"
-            
-            # 2. Проверяем, не занят ли participant_id другим пользователем
-            cursor.execute('''
-                SELECT user_id FROM main WHERE participant_id = ?
-            ''', (participant_id,))
-            
-            existing_registration = cursor.fetchone()
-            
-            if existing_registration:
-                return False, "Этот участник уже зарегистрирован"
-            
-            # 3. Проверяем, существует ли уже пользователь с этим telegram_id
-            cursor.execute('''
-                SELECT user_id, role FROM main WHERE telegram_id = ?
-            ''', (telegram_id,))
-            
-            existing_telegram_user = cursor.fetchone()
-            
-            if existing_telegram_user:
-                user_id, current_role = existing_telegram_user
-                
-                # ✅ ВАЖНО: Сохраняем роль админа/модератора
-                if current_role in ['admin', 'moderator']:
-                    # Админ/модератор - только добавляем participant_id
-                    cursor.execute('''
-                        UPDATE main 
-                        SET participant_id = ?,
-                            telegram_username = ?
-                        WHERE telegram_id = ?
-                    ''', (participant_id, telegram_username, telegram_id))
-                    logger.info(f"Админ/модератор {telegram_id} привязан к participant_id {participant_id}")
-                else:
-                    # Обычный пользователь - обновляем все поля
-                    cursor.execute('''
-                        UPDATE main 
-                        SET participant_id = ?,
-                            telegram_username = ?,
-                            role = 'user'
-                        WHERE telegram_id = ?
-                    ''', (participant_id, telegram_username, telegram_id))
-                    logger.info(f"Обычный пользователь {telegram_id} обновлен с participant_id {participant_id}")
+        # Гашение ссылки и привязка пользователя - UPSERT в одной транзакции
+        result = db.register_by_link(universal_link, telegram_id, telegram_username)
+        
+        if result['status'] == 'not_found':
+            return False, "Ссылка не найдена или недействительна"
+        if result['status'] == 'used':
+            return False, "Эта ссылка уже использована"
+        if result['status'] == 'taken':
+            return False, "Этот участник уже зарегистрирован"
+        
+        if logger:
+            if result['role'] in ['admin', 'moderator']:
+                logger.info(f"Админ/модератор {telegram_id} привязан к participant_id {result['participant_id']}")
             else:
-                # 4. Создаем новую запись для нового пользователя
-                cursor.execute('''
-                    INSERT INTO main (participant_id, telegram_id, telegram_username, role)
-                    VALUES (?, ?, ?, 'user')
-                ''', (participant_id, telegram_id, telegram_username))
-                user_id = cursor.lastrowid
-                logger.info(f"Новый пользователь создан: user_id={user_id}, telegram_id={telegram_id}")
-            
-            # 5. Деактивируем использованную ссылку
-            cursor.execute('''
-                UPDATE link_generation 
-                SET status = 0, link_click_date = CURRENT_TIMESTAMP
-                WHERE universal_link = ?
-            ''', (universal_link,))
-            
-            conn.commit()
-            
-            return True, f"🎉 Поздравляем! Вы успешно зарегистрированы как участник: {last_name} {first_name}"
-            
+                logger.info(f"Пользователь {telegram_id} (user_id={result['user_id']}) привязан к participant_id {result['participant_id']}")
+        
+        return True, f"🎉 Поздравляем! Вы успешно зарегистрированы как участник: {result['last_name']} {result['first_name']}"
+
     except Exception as e:
         if logger:
             logger.error(f"Ошибка при обработке ссылки {universal_link}: {e}", exc_info=True)
@@ -3,7 +3,7 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram import Router, F
 from aiogram.filters import Command
 import logging
-from database import db  # Импортируем нашу базу данных
+from database import adb  # Импортируем асинхронный фасад базы данных
 
 # Создаем роутер для меню
 menu_router = Router()
@@ -134,7 +134,7 @@ async def handle_raffle(callback_query):
         # Проверяем, участвует ли пользователь уже в розыгрыше
         telegram_id = callback_query.from_user.id
         telegram_username = callback_query.from_user.username
-        is_participating = db.is_user_participating_in_raffle(telegram_id)
+        is_participating = await adb.is_user_participating_in_raffle(telegram_id)
         
         raffle_text = (
             "🎁 *Розыгрыш призов*\n\n"
@@ -204,43 +204,41 @@ async def handle_raffle_participate(callback_query):
         telegram_id = callback_query.from_user.id
         telegram_username = callback_query.from_user.username
         
-        # Проверяем, не участвует ли пользователь уже
-        if db.is_user_participating_in_raffle(telegram_id):
+        # Регистрируем одним запросом: True - добавлен сейчас, False - уже участвует
+        joined = await adb.join_raffle(
+            telegram_id=telegram_id,
+            telegram_username=telegram_username,
+            raffle_id=None  # Можно указать конкретный ID розыгрыша
+        )
+        
+        if joined is None:
+            success_text = (
+                "❌ *Произошла ошибка*\n\n"
+                "Не удалось зарегистрировать вас на розыгрыш.\n"
+                "Попробуйте позже или обратитесь к администратору."
+            )
+        elif joined:
             success_text = (
                 "🎉 *Поздравляем!*\n\n"
-                "✅ *Вы уже зарегистрированы на розыгрыш!*\n\n"
+                "✅ *Вы успешно зарегистрированы на розыгрыш!*\n\n"
                 "📅 *Розыгрыш состоится:* 07 декабря 2025 года\n\n"
                 "🔔 *Следите за новостями в нашем канале:*\n"
                 "[STARTANI_online](https://t.me/STARTANI_online)\n\n"
+                "🎯 *Не забудьте выполнить условия участия:*\n"
+                "• Подписаться на канал\n"
+                "• Следить за анонсами\n"
+                "• Выполнить дополнительные условия\n\n"
                 "🏆 *Желаем удачи!* 🍀"
             )
         else:
-            # Добавляем пользователя в базу данных
-            success = db.add_raffle_participant(
-                telegram_id=telegram_id,
-                telegram_username=telegram_username,
-                raffle_id=None  # Можно указать конкретный ID розыгрыша
+            success_text = (
+                "🎉 *Поздравляем!*\n\n"
+                "✅ *Вы уже зарегистрированы на розыгрыш!*\n\n"
+                "📅 *Розыгрыш состоится:* 07 декабря 2025 года\n\n"
+                "🔔 *Следите за новостями в нашем канале:*\n"
+                "[STARTANI_online](https://t.me/STARTANI_online)\n\n"
+                "🏆 *Желаем удачи!* 🍀"
             )
-            
-            if success:
-                success_text = (
-                    "🎉 *Поздравляем!*\n\n"
-                    "✅ *Вы успешно зарегистрированы на розыгрыш!*\n\n"
-                    "📅 *Розыгрыш состоится:* 07 декабря 2025 года\n\n"
-                    "🔔 *Следите за новостями в нашем канале:*\n"
-                    "[STARTANI_online](https://t.me/STARTANI_online)\n\n"
-                    "🎯 *Не забудьте выполнить условия участия:*\n"
-                    "• Подписаться на канал\n"
-                    "• Следить за анонсами\n"
-                    "• Выполнить дополнительные условия\n\n"
-                    "🏆 *Желаем удачи!* 🍀"
-                )
-            else:
-                success_text = (
-                    "❌ *Произошла ошибка*\n\n"
-                    "Не удалось зарегистрировать вас на розыгрыш.\n"
-                    "Попробуйте позже или обратитесь к администратору."
-                )
         
         await callback_query.message.edit_text(
             success_text,
@@ -4,7 +4,8 @@ import logging
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram import F
 from aiogram.fsm.context import FSMContext
-from database import db
+from database import adb
+from fsm_transitions import clear_user
 
 # Импортируем обработчики этапов
 from .stage_1 import handle_stage_1_quest, setup_stage_1_handlers
@@ -19,92 +20,22 @@ from .common_intro import get_stage_history
 
 async def force_clear_all_states(bot, telegram_id: int, storage):
     """Полная очистка всех состояний пользователя"""
-    try:
-        from aiogram.fsm.storage.base import StorageKey
-        
-        # Создаем ключ для пользователя
-        try:
-            user_key = StorageKey(
-                chat_id=telegram_id,
-                user_id=telegram_id,
-                bot_id=bot.id
-            )
-        except AttributeError:
-            user_key = StorageKey(
-                chat_id=telegram_id,
-                user_id=telegram_id,
-                bot_id=telegram_id
-            )
-        
-        # Очищаем состояние
-        await storage.set_state(key=user_key, state=None)
-        await storage.set_data(key=user_key, data={})
-        
-        logging.info(f"✅ Все состояния пользователя {telegram_id} полностью очищены")
-        return True
-    except Exception as e:
-        logging.error(f"❌ Ошибка очистки состояний пользователя {telegram_id}: {e}")
-        return False
+    return await clear_user(storage, bot, telegram_id)
 
 def setup_quest_handler(dp, logger: logging.Logger):
     """Настройка обработчиков квеста"""
     
     async def get_user_stage_id(telegram_id: int):
         """Получить stage_id пользователя из manual_upload через main"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT mu.stage_id 
-                    FROM main m
-                    JOIN manual_upload mu ON m.participant_id = mu.participant_id
-                    WHERE m.telegram_id = ?
-                ''', (telegram_id,))
-                
-                result = cursor.fetchone()
-                return result[0] if result else None
-                
-        except Exception as e:
-            logger.error(f"Ошибка при получении stage_id пользователя {telegram_id}: {e}")
-            return None
+        return await adb.get_user_stage_id(telegram_id)
 
     async def record_quest_start(telegram_id: int, logger: logging.Logger):
         """Запись в БД о начале квеста"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    UPDATE main 
-                    SET quest_started = 1, quest_started_at = CURRENT_TIMESTAMP
-                    WHERE telegram_id = ?
-                ''', (telegram_id,))
-                
-                conn.commit()
-                logger.info(f"Записано начало квеста для пользователя {telegram_id}")
-                return True
-                
-        except Exception as e:
-            logger.error(f"Ошибка при записи начала квеста в БД: {e}")
-            return False
+        return await adb.record_quest_start(telegram_id)
 
     async def get_user_current_stage(telegram_id: int) -> int:
         """Получает текущий этап пользователя из БД"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT current_stage FROM main WHERE telegram_id = ?",
-                    (telegram_id,)
-                )
-                result = cursor.fetchone()
-                if result and result[0] is not None:
-                    return int(result[0])
-                return 1
-        except Exception as e:
-            logger.error(f"Ошибка получения current_stage для {telegram_id}: {e}")
-            return 1
+        return await adb.get_user_current_stage(telegram_id)
 
     async def continue_from_current_stage(callback_query: CallbackQuery, state: FSMContext, current_stage: int):
         """Продолжает квест с текущего этапа для пользователей stage_5"""
@@ -10,8 +10,8 @@ from aiogram.types import CallbackQuery, Message, FSInputFile, InlineKeyboardMar
 from aiogram import F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.base import StorageKey
-from database import db
+from database import db, adb
+from fsm_transitions import clear_user, transition_user
 import logging
 from datetime import datetime
 from utils.video_optimizer import send_optimized_video
@@ -97,76 +97,42 @@ def get_media_file(filename: str) -> str:
 
 async def get_user_id_from_db(telegram_id: int) -> int:
     """Получает user_id из таблицы main по telegram_id"""
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT user_id FROM main WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            result = cursor.fetchone()
-            return result[0] if result else None
-    except Exception as e:
-        logging.error(f"Ошибка получения user_id для telegram_id {telegram_id}: {e}")
-        return None
+    return await adb.get_user_id(telegram_id)
 
 async def update_user_stage(telegram_id: int, new_stage: int) -> bool:
     """Обновляет текущий этап пользователя в БД"""
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE main SET current_stage = ? WHERE telegram_id = ?",
-                (new_stage, telegram_id)
-            )
-            conn.commit()
-            logging.info(f"Обновлен этап пользователя {telegram_id} на {new_stage}")
-            return True
-    except Exception as e:
-        logging.error(f"Ошибка обновления этапа для {telegram_id}: {e}")
-        return False
+    return await adb.update_user_current_stage(telegram_id, new_stage)
 
 async def save_running_data_to_db(user_id: int, date: str, distance: str, running_data: dict) -> bool:
     """Сохраняет данные о пробежке в таблицу verification"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Проверяем корректность данных
-            if not date or not distance or date == 'не найдено' or distance == 'не найдено':
-                logging.error(f"Не удалось извлечь данные из ответа AI: {running_data}")
-                return False
-            
-            # Извлекаем числовое значение дистанции
-            distance_match = re.search(r'(\d+\.?\d*)', distance)
-            if not distance_match:
-                logging.error(f"Не удалось извлечь числовое значение дистанции из: {distance}")
-                return False
-            
-            distance_km = float(distance_match.group(1))
-            
-            # Преобразуем дату в формат YYYY-MM-DD
-            try:
-                # Парсим дату в формате dd.mm.yyyy
-                run_date = datetime.strptime(date, '%d.%m.%Y').date()
-            except ValueError:
-                logging.error(f"Неверный формат даты: {date}")
-                return False
-            
-            # Проверяем дату забега (не ранее 25.11.2025)
-            check_date = datetime(2025, 11, 25).date()
-            answer_check = 1 if run_date >= check_date else 0
-            
-            # Сохраняем в таблицу verification
-            cursor.execute('''
-                INSERT OR REPLACE INTO verification 
-                (user_id, distance, run_date, answer_check)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, distance_km, run_date.isoformat(), answer_check))
-            
-            conn.commit()
-            logging.info(f"Данные пробежки сохранены для user_id {user_id}: {distance_km} км, {run_date}, check={answer_check}")
-            return True
+        # Проверяем корректность данных
+        if not date or not distance or date == 'не найдено' or distance == 'не найдено':
+            logging.error(f"Не удалось извлечь данные из ответа AI: {running_data}")
+            return False
+        
+        # Извлекаем числовое значение дистанции
+        distance_match = re.search(r'(\d+\.?\d*)', distance)
+        if not distance_match:
+            logging.error(f"Не удалось извлечь числовое значение дистанции из: {distance}")
+            return False
+        
+        distance_km = float(distance_match.group(1))
+        
+        # Преобразуем дату в формат YYYY-MM-DD
+        try:
+            # Парсим дату в формате dd.mm.yyyy
+            run_date = datetime.strptime(date, '%d.%m.%Y').date()
+        except ValueError:
+            logging.error(f"Неверный формат даты: {date}")
+            return False
+        
+        # Проверяем дату забега (не ранее 25.11.2025)
+        check_date = datetime(2025, 11, 25).date()
+        answer_check = 1 if run_date >= check_date else 0
+        
+        # Сохраняем в таблицу verification
+        return await adb.save_verification(user_id, distance_km, run_date.isoformat(), answer_check)
             
     except Exception as e:
         logging.error(f"Ошибка сохранения данных пробежки в БД: {e}")
@@ -174,15 +140,7 @@ async def save_running_data_to_db(user_id: int, date: str, distance: str, runnin
 
 async def get_moderator_ids() -> list:
     """Получает список ID модераторов из БД"""
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM main WHERE role = 'moderator'")
-            results = cursor.fetchall()
-            return [row[0] for row in results] if results else []
-    except Exception as e:
-        logging.error(f"Ошибка получения модераторов: {e}")
-        return []
+    return await adb.get_moderator_ids()
 
 async def send_moderator_notification(telegram_id: int, username: str, image_path: str, attempts: int, message: Message):
     """Отправляет уведомление модератору о проблеме с распознаванием"""
@@ -336,8 +294,18 @@ async def handle_recognition_failure(telegram_id: int, user_id: int, image_path:
         )
 
 async def send_moderator_approved_quest(bot, telegram_id: int, storage):
-    """Отправляет продолжение квеста после одобрения модератором"""
+    """Переводит пользователя к загадке и отправляет продолжение квеста после одобрения модератором"""
     try:
+        # ✅ Состояние и данные - одной операцией хранилища, до сообщений с паузами
+        is_stage_5_user = await check_if_stage_5_user(telegram_id)
+        await transition_user(storage, bot, telegram_id, Stage1States.waiting_for_riddle_answer, {
+            'telegram_id': telegram_id,
+            'is_stage_5_user': is_stage_5_user,
+            'attempts_left': 3,
+            'recognition_attempts': 0,
+            'moderator_approved': True
+        })
+
         await asyncio.sleep(1)
         
         message5 = "🎉 *Ура! Ты оказался в порту и выполнил первую часть задания!*"
@@ -387,114 +355,11 @@ async def send_moderator_approved_quest(bot, telegram_id: int, storage):
             parse_mode="Markdown"
         )
         
-        # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: Устанавливаем правильное состояние для пользователя
-        try:
-            from aiogram.fsm.storage.base import StorageKey
-            from aiogram.fsm.context import FSMContext
-            
-            # Создаем ключ для пользователя
-            user_key = StorageKey(
-                chat_id=telegram_id, 
-                user_id=telegram_id, 
-                bot_id=bot.id
-            )
-            
-            # ✅ ИСПРАВЛЕНИЕ: Используем переданный storage вместо bot.storage
-            user_state = FSMContext(storage=storage, key=user_key)
-            
-            # ✅ ПРОВЕРЯЕМ: Получаем данные пользователя
-            is_stage_5_user = await check_if_stage_5_user(telegram_id)
-            
-            # ✅ УСТАНАВЛИВАЕМ ПРАВИЛЬНОЕ СОСТОЯНИЕ И ДАННЫЕ
-            await user_state.set_state(Stage1States.waiting_for_riddle_answer)
-            await user_state.set_data({
-                'telegram_id': telegram_id,
-                'is_stage_5_user': is_stage_5_user,
-                'attempts_left': 3,
-                'recognition_attempts': 0,
-                'moderator_approved': True
-            })
-            
-            logging.info(f"✅ Установлено состояние waiting_for_riddle_answer для пользователя {telegram_id} (этап 1)")
-            
-        except Exception as state_error:
-            logging.error(f"❌ Ошибка установки состояния для пользователя {telegram_id}: {state_error}")
-        
         logging.info(f"✅ Квест продолжен для пользователя {telegram_id} после одобрения модератора (этап 1)")
         
     except Exception as e:
         logging.error(f"Ошибка при отправке квеста после одобрения модератора (этап 1): {e}")
 
-async def force_update_user_state(storage, telegram_id: int, target_state):
-    """Принудительное обновление состояния пользователя"""
-    try:
-        # ✅ ИСПРАВЛЕНИЕ: Создаем ключ без bot.id если его нет
-        try:
-            # Пробуем создать ключ с bot.id
-            user_key = StorageKey(chat_id=telegram_id, user_id=telegram_id, bot_id=storage.bot.id)
-        except AttributeError:
-            # Если нет bot.id, создаем ключ без него
-            user_key = StorageKey(chat_id=telegram_id, user_id=telegram_id, bot_id=telegram_id)
-        
-        await storage.set_state(key=user_key, state=target_state)
-        
-        logging.info(f"✅ Принудительно обновлено состояние пользователя {telegram_id} на {target_state}")
-        return True
-    except Exception as e:
-        logging.error(f"❌ Ошибка принудительного обновления состояния: {e}")
-        return False
-
-async def update_user_state_directly(bot, telegram_id: int, target_state, storage):
-    """Прямое обновление состояния пользователя через создание нового контекста"""
-    try:
-        # ✅ ИСПРАВЛЕНИЕ: Используем правильный формат ключа
-        from aiogram.fsm.storage.base import StorageKey
-        
-        # ✅ ИСПРАВЛЕНИЕ: Создаем ключ без bot.id если его нет
-        try:
-            # Пробуем создать ключ с bot.id
-            user_key = StorageKey(
-                chat_id=telegram_id, 
-                user_id=telegram_id, 
-                bot_id=bot.id
-            )
-        except AttributeError:
-            # Если нет bot.id, создаем ключ без него
-            user_key = StorageKey(
-                chat_id=telegram_id, 
-                user_id=telegram_id, 
-                bot_id=telegram_id  # Используем telegram_id как fallback
-            )
-        
-        # Создаем новый FSMContext для пользователя
-        user_state = FSMContext(storage=storage, key=user_key)
-        
-        # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: Получаем user_id из БД
-        user_id = await get_user_id_from_db(telegram_id)
-        is_stage_5_user = await check_if_stage_5_user(telegram_id)
-        
-        # Устанавливаем новое состояние
-        await user_state.set_state(target_state)
-        
-        # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: Сохраняем ВСЕ необходимые данные
-        user_state_data = {
-            'telegram_id': telegram_id,
-            'user_id': user_id,
-            'is_stage_5_user': is_stage_5_user,
-            'attempts_left': 3,
-            'recognition_attempts': 0,
-            'quest_continued': True,  # Флаг что квест продолжен
-            'moderator_approved': True  # Флаг что модератор одобрил
-        }
-        await user_state.set_data(user_state_data)
-        
-        logging.info(f"✅ Состояние пользователя {telegram_id} напрямую обновлено на {target_state}")
-        return True
-        
-    except Exception as e:
-        logging.error(f"❌ Ошибка прямого обновления состояния: {e}")
-        return False
-
 async def handle_moderator_approve_1(callback_query: CallbackQuery, state: FSMContext):
     """Обработка решения модератора 'Проверено'"""
     try:
@@ -556,17 +421,7 @@ async def handle_moderator_approve_1(callback_query: CallbackQuery, state: FSMCo
                 parse_mode="Markdown"
             )
             
-            # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: Очищаем состояние пользователя
-            try:
-                storage = state.storage
-                user_key = StorageKey(chat_id=telegram_id, user_id=telegram_id, bot_id=storage.bot.id)
-                await storage.set_state(key=user_key, state=None)
-                await storage.set_data(key=user_key, data={})
-                logging.info(f"✅ Состояние пользователя {telegram_id} очищено после одобрения модератора (этап 1)")
-            except Exception as storage_error:
-                logging.error(f"Ошибка очистки состояния пользователя {telegram_id} (этап 1): {storage_error}")
-            
-            # ✅ ИСПРАВЛЕНИЕ: Передаем storage в функцию
+            # ✅ Переход к загадке заменяет состояние и данные пользователя целиком
             await send_moderator_approved_quest(callback_query.bot, telegram_id, state.storage)
             
         else:
@@ -580,33 +435,6 @@ async def handle_moderator_approve_1(callback_query: CallbackQuery, state: FSMCo
         logging.error(f"Ошибка при обработке решения модератора (этап 1): {e}")
         await callback_query.answer("❌ Ошибка при обработке", show_alert=True)
 
-async def check_user_state(telegram_id: int, storage) -> tuple:
-    """Проверяет текущее состояние пользователя"""
-    try:
-        from aiogram.fsm.storage.base import StorageKey
-        
-        # ✅ ИСПРАВЛЕНИЕ: Создаем ключ без bot.id если его нет
-        try:
-            user_key = StorageKey(
-                chat_id=telegram_id, 
-                user_id=telegram_id, 
-                bot_id=storage.bot.id
-            )
-        except AttributeError:
-            user_key = StorageKey(
-                chat_id=telegram_id, 
-                user_id=telegram_id, 
-                bot_id=telegram_id
-            )
-        
-        current_state = await storage.get_state(key=user_key)
-        user_data = await storage.get_data(key=user_key)
-        
-        return current_state, user_data
-    except Exception as e:
-        logging.error(f"Ошибка проверки состояния пользователя {telegram_id}: {e}")
-        return None, {}
-
 async def handle_moderator_decision_waiting(message: Message, state: FSMContext):
     """Обработчик для состояния ожидания решения модератора"""
     try:
@@ -674,7 +502,7 @@ async def save_user_address_to_db(telegram_id: int, address: str, stage: int = 1
     try:
         username = None  # Можно добавить получение username из состояния если нужно
         
-        success = db.save_user_address(telegram_id, username, address, stage)
+        success = await adb.save_user_address(telegram_id, username, address, stage)
         if success:
             logging.info(f"✅ Адрес сохранен для пользователя {telegram_id}: {address}")
             return True
@@ -711,7 +539,7 @@ async def handle_stage_1_riddle_answer(message: Message, state: FSMContext):
         if user_answer == correct_answer:
             # ✅ ПРАВИЛЬНЫЙ ОТВЕТ - обновляем в БД
             logger.info(f"🎉 Пользователь {telegram_id} дал правильный ответ!")
-            update_user_answer_in_db(telegram_id, user_answer)
+            await update_user_answer_in_db(telegram_id, user_answer)
             
             # ✅ ПРОВЕРКА НА 5-Й ЭТАП
             is_stage_5_user = user_data.get('is_stage_5_user', False)
@@ -1114,7 +942,7 @@ async def handle_stage_1_quest(callback_query: CallbackQuery, state: FSMContext)
             logging.error(f"Ошибка отправки видео: {video_error}")
         
         # Общее вступление с названием этапа из БД
-        message1 = get_common_intro(1)
+        message1 = await get_common_intro(1)
         await callback_query.message.answer(message1, parse_mode="Markdown")
         await asyncio.sleep(3)
         
@@ -1195,7 +1023,7 @@ async def handle_stage_1_image(message: Message, state: FSMContext):
         await message.bot.download_file(file_path, local_path)
         
         # ✅ Сохраняем путь в базу данных через общую функцию
-        save_user_data_to_db(telegram_id, local_path)
+        await save_user_data_to_db(telegram_id, local_path)
         
         logger.info(f"Сохранено изображение для пользователя {telegram_id}: {local_path}")
         
@@ -1258,15 +1086,8 @@ async def handle_moderator_reject_1(callback_query: CallbackQuery, state: FSMCon
             text=user_message
         )
         
-        # ✅ Очищаем состояние пользователя через storage
-        try:
-            storage = state.storage
-            user_key = StorageKey(chat_id=telegram_id, user_id=telegram_id, bot_id=storage.bot.id)
-            await storage.set_state(key=user_key, state=None)
-            await storage.set_data(key=user_key, data={})
-            logging.info(f"✅ Состояние пользователя {telegram_id} очищено после отказа модератора (этап 1)")
-        except Exception as storage_error:
-            logging.error(f"Ошибка очистки состояния пользователя {telegram_id} (этап 1): {storage_error}")
+        # ✅ Очищаем состояние пользователя одной операцией хранилища
+        await clear_user(state.storage, callback_query.bot, telegram_id)
         
     except Exception as e:
         logging.error(f"Ошибка при обработке отказа модератора (этап 1): {e}")
@@ -1274,15 +1095,7 @@ async def handle_moderator_reject_1(callback_query: CallbackQuery, state: FSMCon
 
 async def clear_user_state(bot, telegram_id: int, storage):
     """Очищает состояние пользователя после решения модератора"""
-    try:
-        user_key = StorageKey(chat_id=telegram_id, user_id=telegram_id, bot_id=bot.id)
-        await storage.set_state(key=user_key, state=None)
-        await storage.set_data(key=user_key, data={})
-        logging.info(f"✅ Состояние пользователя {telegram_id} очищено (этап 1)")
-        return True
-    except Exception as e:
-        logging.error(f"❌ Ошибка очистки состояния пользователя {telegram_id} (этап 1): {e}")
-        return False
+    return await clear_user(storage, bot, telegram_id)
 
 def setup_stage_1_handlers(dp):
     """Настройка обработчиков для этапа 1"""
@@ -1367,16 +1180,20 @@ def setup_stage_1_handlers(dp):
 async def add_moderator_to_db(telegram_id: int, username: str = None):
     """Добавляет модератора в БД"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
+        def _write(cursor):
+            # UPSERT: у существующего пользователя меняется только роль (и username),
+            # прогресс этапов и participant_id остаются
             cursor.execute('''
-                INSERT OR REPLACE INTO main 
-                (telegram_id, username, role, current_stage, registration_date)
+                INSERT INTO main (telegram_id, telegram_username, role, current_stage, registration_date)
                 VALUES (?, ?, 'moderator', 1, datetime('now'))
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    telegram_username = COALESCE(excluded.telegram_username, telegram_username),
+                    role = CASE WHEN role = 'admin' THEN role ELSE 'moderator' END
             ''', (telegram_id, username))
-            conn.commit()
-            logging.info(f"✅ Модератор добавлен: {telegram_id} (@{username})")
-            return True
+
+        await adb.write(_write, invalidate=telegram_id, shard=db.shard_of(telegram_id))
+        logging.info(f"✅ Модератор добавлен: {telegram_id} (@{username})")
+        return True
     except Exception as e:
         logging.error(f"❌ Ошибка добавления модератора: {e}")
         return False
@@ -1385,7 +1202,7 @@ async def add_moderator_to_db(telegram_id: int, username: str = None):
 async def is_stage_1_completed(telegram_id: int) -> bool:
     """Проверяет, завершен ли этап 1 для пользователя"""
     try:
-        return db.is_stage_completed(telegram_id, 1)
+        return await adb.is_stage_completed(telegram_id, 1)
     except Exception as e:
         logging.error(f"Ошибка проверки завершения этапа 1: {e}")
         return False
@@ -1394,7 +1211,7 @@ async def is_stage_1_completed(telegram_id: int) -> bool:
 async def mark_stage_1_completed(telegram_id: int) -> bool:
     """Отмечает этап 1 как завершенный"""
     try:
-        return db.mark_stage_completed(telegram_id, 1)
+        return await adb.mark_stage_completed(telegram_id, 1)
     except Exception as e:
         logging.error(f"Ошибка отметки завершения этапа 1: {e}")
         return False
@@ -5,7 +5,7 @@ from aiogram.types import CallbackQuery, Message, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram import F
-from database import db
+from database import db, adb
 from pathlib import Path
 
 # ✅ ПРАВИЛЬНЫЕ ПУТИ
@@ -25,25 +25,12 @@ class Stage5States(StatesGroup):
 
 async def get_user_current_stage(telegram_id: int) -> int:
     """Получает текущий этап пользователя из БД"""
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT current_stage FROM main WHERE telegram_id = ?",
-                (telegram_id,)
-            )
-            result = cursor.fetchone()
-            if result and result[0] is not None:
-                return int(result[0])
-            return 1
-    except Exception as e:
-        logging.error(f"Ошибка получения текущего этапа для {telegram_id}: {e}")
-        return 1
+    return await adb.get_user_current_stage(telegram_id)
 
 async def is_stage_completed(telegram_id: int, stage: int) -> bool:
     """Проверяет, завершен ли конкретный этап для пользователя"""
     try:
-        return db.is_stage_completed(telegram_id, stage)
+        return await adb.is_stage_completed(telegram_id, stage)
     except Exception as e:
         logging.error(f"Ошибка проверки завершения этапа {stage}: {e}")
         return False
@@ -64,26 +51,14 @@ async def get_next_uncompleted_stage(telegram_id: int) -> int:
 
 async def update_user_stage(telegram_id: int, new_stage: int) -> bool:
     """Обновляет текущий этап пользователя в БД"""
-    try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE main SET current_stage = ? WHERE telegram_id = ?",
-                (new_stage, telegram_id)
-            )
-            conn.commit()
-            logging.info(f"Обновлен этап пользователя {telegram_id} на {new_stage}")
-            return True
-    except Exception as e:
-        logging.error(f"Ошибка обновления этапа для {telegram_id}: {e}")
-        return False
+    return await adb.update_user_current_stage(telegram_id, new_stage)
 
 async def save_user_address_to_db(telegram_id: int, address: str, stage: int) -> bool:
     """Сохраняет адрес пользователя в таблицу user_addresses"""
     try:
         username = None
         
-        success = db.save_user_address(telegram_id, username, address, stage)
+        success = await adb.save_user_address(telegram_id, username, address, stage)
         if success:
             logging.info(f"✅ Адрес сохранен для пользователя {telegram_id}: {address} (этап {stage})")
             return True
@@ -172,7 +147,7 @@ async def handle_stage_5_address(message: Message, state: FSMContext):
         # ✅ ОТМЕЧАЕМ ЭТАП КАК ЗАВЕРШЕННЫЙ
         if current_stage <= 4:
             try:
-                success = db.mark_stage_completed(telegram_id, current_stage)
+                success = await adb.mark_stage_completed(telegram_id, current_stage)
                 if success:
                     logger.info(f"✅ Этап {current_stage} отмечен как завершенный для пользователя {telegram_id}")
                 else:
@@ -180,39 +155,10 @@ async def handle_stage_5_address(message: Message, state: FSMContext):
             except Exception as e:
                 logger.error(f"❌ Ошибка отметки завершения этапа {current_stage}: {e}")
         
-        # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: ПРИНУДИТЕЛЬНАЯ ОЧИСТКА СОСТОЯНИЙ ПЕРЕД ПЕРЕХОДОМ
-        # 1. Сначала очищаем текущее состояние
+        # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: ОЧИСТКА СОСТОЯНИЯ ПЕРЕД ПЕРЕХОДОМ
+        # (state записывается в хранилище одной операцией после обработчика)
         await state.clear()
         
-        # 2. Затем принудительно очищаем в storage (для всех возможных состояний этапов)
-        try:
-            from aiogram.fsm.storage.base import StorageKey
-            storage = state.storage
-            
-            # Создаем ключ пользователя
-            try:
-                user_key = StorageKey(
-                    chat_id=telegram_id,
-                    user_id=telegram_id,
-                    bot_id=storage.bot.id
-                )
-            except AttributeError:
-                user_key = StorageKey(
-                    chat_id=telegram_id,
-                    user_id=telegram_id,
-                    bot_id=telegram_id
-                )
-            
-            # Очищаем состояние
-            await storage.set_state(key=user_key, state=None)
-            await storage.set_data(key=user_key, data={})
-            
-            logger.info(f"✅ Состояние пользователя {telegram_id} полностью очищено в storage")
-            
-        except Exception as storage_error:
-            logger.error(f"⚠️ Ошибка очистки storage: {storage_error}")
-            # Продолжаем работу даже если очистка storage не удалась
-        
         # ✅ НАХОДИМ СЛЕДУЮЩИЙ НЕЗАВЕРШЕННЫЙ ЭТАП
         next_stage = await get_next_uncompleted_stage(telegram_id)
         logger.info(f"🔍 [STAGE_5_ADDRESS] Следующий незавершенный этап: {next_stage}")
@@ -240,33 +186,16 @@ async def handle_stage_5_address(message: Message, state: FSMContext):
             
             fake_callback = FakeCallback(message)
             
-            # ✅ ВАЖНОЕ ИСПРАВЛЕНИЕ: Передаем СОЗДАННЫЙ НОВЫЙ STATE, а не текущий
-            # Создаем новый FSMContext для следующего этапа
-            from aiogram.fsm.context import FSMContext
-            from aiogram.fsm.storage.base import StorageKey
-            
-            try:
-                storage = state.storage
-                user_key = StorageKey(
-                    chat_id=telegram_id,
-                    user_id=telegram_id,
-                    bot_id=storage.bot.id
-                )
-                fresh_state = FSMContext(storage=storage, key=user_key)
-                
-                # ✅ УСТАНАВЛИВАЕМ ФЛАГ ДЛЯ STAGE_5 ПОЛЬЗОВАТЕЛЯ
-                await fresh_state.update_data(
-                    is_stage_5_user=True,
-                    telegram_id=telegram_id,
-                    current_stage=next_stage,
-                    attempts_left=3
-                )
-                
-                logger.info(f"✅ Создан новый state для этапа {next_stage} с флагом stage_5")
-                
-            except Exception as state_error:
-                logger.error(f"❌ Ошибка создания нового state: {state_error}")
-                fresh_state = state  # Используем текущий state как fallback
+            # ✅ Состояние очищено выше: следующий этап начинается с чистого state
+            # (отдельный FSMContext на тот же ключ разошелся бы с записью state после обработчика)
+            fresh_state = state
+            await fresh_state.update_data(
+                is_stage_5_user=True,
+                telegram_id=telegram_id,
+                current_stage=next_stage,
+                attempts_left=3
+            )
+            logger.info(f"✅ Подготовлен state для этапа {next_stage} с флагом stage_5")
             
             # ✅ ЗАПУСК СЛЕДУЮЩЕГО ЭТАПА
             stage_handlers = {
@@ -324,23 +253,7 @@ async def handle_stage_5_address(message: Message, state: FSMContext):
             # ✅ ФИНАЛЬНОЕ ЗАВЕРШЕНИЕ
             await update_user_stage(telegram_id, 5)
             
-            # ✅ ПРИНУДИТЕЛЬНОЕ ОЧИЩЕНИЕ ВСЕХ СОСТОЯНИЙ ПОСЛЕ ЗАВЕРШЕНИЯ
-            try:
-                from aiogram.fsm.storage.base import StorageKey
-                storage = state.storage
-                
-                user_key = StorageKey(
-                    chat_id=telegram_id,
-                    user_id=telegram_id,
-                    bot_id=storage.bot.id if hasattr(storage, 'bot') else telegram_id
-                )
-                
-                # Очищаем все возможные состояния
-                await storage.set_state(key=user_key, state=None)
-                await storage.set_data(key=user_key, data={})
-                
-            except Exception as final_clear_error:
-                logger.error(f"⚠️ Ошибка финальной очистки: {final_clear_error}")
+            # ✅ Состояние уже очищено выше (state.clear)
             
             await message.answer(
                 "🎊 *УРА! ВСЕ ЭТАПЫ ПРОЙДЕНЫ!*\n\n"
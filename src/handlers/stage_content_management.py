@@ -3,7 +3,7 @@ from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, ContentType
-from database import db
+from database import db, adb
 import logging
 
 # Получаем логгер из вашей системы
@@ -38,37 +38,39 @@ async def add_stage_content_command(message: Message, state: FSMContext):
         return
     
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем список этапов
-            cursor.execute('SELECT stage_id, stage_name FROM stages ORDER BY stage_id')
-            stages = cursor.fetchall()
-            
-            if not stages:
-                await message.answer("❌ Нет доступных этапов. Сначала создайте этап с помощью /add_stage")
-                return
-            
-            # Сохраняем список этапов в состоянии для последующего использования
-            stages_dict = {f"Этап {stage_id}: {name}": stage_id for stage_id, name in stages}
-            await state.update_data(available_stages=stages_dict)
-            
-            # Создаем клавиатуру с этапами (ИЗМЕНЕНО: добавляем префикс "Добавить в ")
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text=f"Добавить в этап {stage_id}: {name}")]  # ИЗМЕНЕНО: другой формат
-                    for stage_id, name in stages
-                ] + [[KeyboardButton(text="❌ Отмена")]],
-                resize_keyboard=True
-            )
-            
-            await message.answer(
-                "📝 Выберите этап для добавления контента:",
-                reply_markup=keyboard
-            )
-            await state.set_state(AddStageContent.waiting_for_stage_selection)
-            logger.info(f"📝 Установлено состояние: waiting_for_stage_selection")
-            
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT stage_id, stage_name FROM stages ORDER BY stage_id')
+                return cursor.fetchall()
+
+        # Получаем список этапов
+        stages = await adb.run(_load)
+
+        if not stages:
+            await message.answer("❌ Нет доступных этапов. Сначала создайте этап с помощью /add_stage")
+            return
+
+        # Сохраняем список этапов в состоянии для последующего использования
+        stages_dict = {f"Этап {stage_id}: {name}": stage_id for stage_id, name in stages}
+        await state.update_data(available_stages=stages_dict)
+
+        # Создаем клавиатуру с этапами (ИЗМЕНЕНО: добавляем префикс "Добавить в ")
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text=f"Добавить в этап {stage_id}: {name}")]  # ИЗМЕНЕНО: другой формат
+                for stage_id, name in stages
+            ] + [[KeyboardButton(text="❌ Отмена")]],
+            resize_keyboard=True
+        )
+
+        await message.answer(
+            "📝 Выберите этап для добавления контента:",
+            reply_markup=keyboard
+        )
+        await state.set_state(AddStageContent.waiting_for_stage_selection)
+        logger.info(f"📝 Установлено состояние: waiting_for_stage_selection")
+
     except Exception as e:
         logger.error(f"❌ Ошибка при получении списка этапов: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка")
@@ -96,44 +98,48 @@ async def process_stage_selection(message: Message, state: FSMContext):
         stage_id = available_stages[message.text]
         logger.info(f"🔍 Получен stage_id из словаря: {stage_id}")
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Проверяем существование этапа в БД
-            cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
-            stage_data = cursor.fetchone()
-            
-            if not stage_data:
-                await message.answer("❌ Этап не найден в базе данных", reply_markup=ReplyKeyboardRemove())
-                await state.clear()
-                return
-            
-            stage_name = stage_data[0]
-            logger.info(f"✅ Найден этап: {stage_name}")
-            
-            # Получаем максимальный порядковый номер для этого этапа
-            cursor.execute('''
-                SELECT MAX(order_number) FROM stage_content WHERE stage_id = ?
-            ''', (stage_id,))
-            max_order = cursor.fetchone()[0] or 0
-            logger.info(f"📊 Максимальный порядковый номер: {max_order}")
-            
-            await state.update_data(
-                stage_id=stage_id,
-                stage_name=stage_name,
-                next_order=max_order + 1
-            )
-            
-            await message.answer(
-                f"📋 Этап: {stage_name}\n"
-                f"🆔 ID: {stage_id}\n\n"
-                f"📊 Текущий порядковый номер для нового сообщения: {max_order + 1}\n\n"
-                f"Введите порядковый номер для нового сообщения (или оставьте {max_order + 1}):",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            await state.set_state(AddStageContent.waiting_for_order_number)
-            logger.info(f"➡️ Переход в состояние: waiting_for_order_number")
-            
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+
+                # Проверяем существование этапа в БД
+                cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
+                stage_data = cursor.fetchone()
+                if not stage_data:
+                    return None, 0
+
+                # Получаем максимальный порядковый номер для этого этапа
+                cursor.execute('''
+                    SELECT MAX(order_number) FROM stage_content WHERE stage_id = ?
+                ''', (stage_id,))
+                return stage_data[0], cursor.fetchone()[0] or 0
+
+        stage_name, max_order = await adb.run(_load)
+
+        if stage_name is None:
+            await message.answer("❌ Этап не найден в базе данных", reply_markup=ReplyKeyboardRemove())
+            await state.clear()
+            return
+
+        logger.info(f"✅ Найден этап: {stage_name}")
+        logger.info(f"📊 Максимальный порядковый номер: {max_order}")
+
+        await state.update_data(
+            stage_id=stage_id,
+            stage_name=stage_name,
+            next_order=max_order + 1
+        )
+
+        await message.answer(
+            f"📋 Этап: {stage_name}\n"
+            f"🆔 ID: {stage_id}\n\n"
+            f"📊 Текущий порядковый номер для нового сообщения: {max_order + 1}\n\n"
+            f"Введите порядковый номер для нового сообщения (или оставьте {max_order + 1}):",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        await state.set_state(AddStageContent.waiting_for_order_number)
+        logger.info(f"➡️ Переход в состояние: waiting_for_order_number")
+
     except Exception as e:
         logger.error(f"❌ Ошибка при выборе этапа: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка", reply_markup=ReplyKeyboardRemove())
@@ -464,15 +470,12 @@ async def save_stage_content(message: Message, state: FSMContext):
         data = await state.get_data()
         logger.info(f"📦 Данные для сохранения: {data}")
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Генерируем message_id
+        def _write(cursor):
+            # Генерируем message_id (в транзакции писателя - без гонки с другими добавлениями)
             cursor.execute('SELECT COALESCE(MAX(message_id), 0) + 1 FROM stage_content')
             result = cursor.fetchone()
             message_id = result[0] if result else 1
-            logger.info(f"🆔 Сгенерирован message_id: {message_id}")
-            
+
             # Вставляем данные в таблицу stage_content
             cursor.execute('''
                 INSERT INTO stage_content (
@@ -492,37 +495,38 @@ async def save_stage_content(message: Message, state: FSMContext):
                 data.get('has_feedback', 0),
                 data.get('puzzle_check')
             ))
-            
-            conn.commit()
-            logger.info(f"✅ Контент успешно сохранен в БД, message_id: {message_id}")
-            
-            # Формируем информационное сообщение
-            info_message = (
-                f"✅ Контент успешно добавлен к этапу!\n\n"
-                f"📋 Этап: {data['stage_name']}\n"
-                f"🆔 ID этапа: {data['stage_id']}\n"
-                f"📝 ID сообщения: {message_id}\n"
-                f"🔢 Порядковый номер: {data['order_number']}\n"
-            )
-            
-            if data.get('has_image'):
-                info_message += f"🖼️ Изображение: ✅\n"
-            if data.get('has_video'):
-                info_message += f"🎥 Видео: ✅\n"
-            if data.get('has_feedback'):
-                info_message += f"📝 Обратная связь: ✅\n"
-                info_message += f"🔐 Правильный ответ: {data.get('puzzle_check', 'не указан')}\n"
-            
-            await message.answer(
-                info_message,
-                reply_markup=create_content_management_keyboard()
-            )
-            
-            logger.info(
-                f"🎉 Успешно добавлен контент: stage_id={data['stage_id']}, "
-                f"message_id={message_id}, order={data['order_number']}"
-            )
-            
+            return message_id
+
+        message_id = await adb.write(_write)
+        logger.info(f"✅ Контент успешно сохранен в БД, message_id: {message_id}")
+
+        # Формируем информационное сообщение
+        info_message = (
+            f"✅ Контент успешно добавлен к этапу!\n\n"
+            f"📋 Этап: {data['stage_name']}\n"
+            f"🆔 ID этапа: {data['stage_id']}\n"
+            f"📝 ID сообщения: {message_id}\n"
+            f"🔢 Порядковый номер: {data['order_number']}\n"
+        )
+
+        if data.get('has_image'):
+            info_message += f"🖼️ Изображение: ✅\n"
+        if data.get('has_video'):
+            info_message += f"🎥 Видео: ✅\n"
+        if data.get('has_feedback'):
+            info_message += f"📝 Обратная связь: ✅\n"
+            info_message += f"🔐 Правильный ответ: {data.get('puzzle_check', 'не указан')}\n"
+
+        await message.answer(
+            info_message,
+            reply_markup=create_content_management_keyboard()
+        )
+
+        logger.info(
+            f"🎉 Успешно добавлен контент: stage_id={data['stage_id']}, "
+            f"message_id={message_id}, order={data['order_number']}"
+        )
+
     except Exception as e:
         logger.error(f"❌ Ошибка при сохранении контента этапа: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при сохранении контента")
@@ -535,13 +539,9 @@ async def get_user_role(telegram_id: int) -> str:
     """Получить роль пользователя"""
     logger.debug(f"👤 Получение роли пользователя: {telegram_id}")
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT role FROM main WHERE telegram_id = ?', (telegram_id,))
-            result = cursor.fetchone()
-            role = result[0] if result else 'user'
-            logger.debug(f"✅ Роль пользователя {telegram_id}: {role}")
-            return role
+        role = await adb.get_user_role(telegram_id) or 'user'
+        logger.debug(f"✅ Роль пользователя {telegram_id}: {role}")
+        return role
     except Exception as e:
         logger.error(f"❌ Ошибка при получении роли пользователя: {e}", exc_info=True)
         return 'user'
@@ -5,7 +5,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 import logging
-from database import db
+from database import db, adb
 
 # Создаем роутер
 stage_router = Router()
@@ -51,33 +51,33 @@ async def process_stage_name(message: Message, state: FSMContext):
         return
     
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Проверяем, существует ли уже этап с таким названием
-            cursor.execute('SELECT stage_id FROM stages WHERE stage_name = ?', (stage_name,))
-            existing_stage = cursor.fetchone()
-            
-            if existing_stage:
-                await message.answer(f"❌ Этап с названием '{stage_name}' уже существует")
-                await state.clear()
-                return
-            
-            # Добавляем новый этап
-            cursor.execute('INSERT INTO stages (stage_name) VALUES (?)', (stage_name,))
-            stage_id = cursor.lastrowid
-            
-            conn.commit()
-            
-            await message.answer(
-                f"✅ Этап успешно добавлен!\n\n"
-                f"🆔 ID этапа: {stage_id}\n"
-                f"📝 Название: {stage_name}",
-                reply_markup=create_stage_management_keyboard()
-            )
-            
-            logging.info(f"Добавлен новый этап: ID={stage_id}, название='{stage_name}'")
-            
+        def _write(cursor):
+            # Этап с таким названием уже существует - ничего не добавляем
+            cursor.execute('''
+                INSERT INTO stages (stage_name) VALUES (?)
+                ON CONFLICT(stage_name) DO NOTHING
+                RETURNING stage_id
+            ''', (stage_name,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+        # Запись через писателя базы, а не отдельным соединением
+        stage_id = await adb.write(_write)
+
+        if stage_id is None:
+            await message.answer(f"❌ Этап с названием '{stage_name}' уже существует")
+            await state.clear()
+            return
+
+        await message.answer(
+            f"✅ Этап успешно добавлен!\n\n"
+            f"🆔 ID этапа: {stage_id}\n"
+            f"📝 Название: {stage_name}",
+            reply_markup=create_stage_management_keyboard()
+        )
+
+        logging.info(f"Добавлен новый этап: ID={stage_id}, название='{stage_name}'")
+
     except Exception as e:
         logging.error(f"Ошибка при добавлении этапа: {e}")
         await message.answer("❌ Произошла ошибка при добавлении этапа")
@@ -89,35 +89,39 @@ async def process_stage_name(message: Message, state: FSMContext):
 async def list_stages_command(message: Message):
     """Показать список всех этапов"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT stage_id, stage_name 
-                FROM stages 
-                ORDER BY stage_id
-            ''')
-            
-            stages = cursor.fetchall()
-            
-            if not stages:
-                await message.answer("📋 Список этапов пуст")
-                return
-            
-            stages_message = "📋 **Список этапов:**\n\n"
-            
-            for stage_id, stage_name in stages:
-                # Получаем количество пользователей на этом этапе
+        def _load():
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+
                 cursor.execute('''
-                    SELECT COUNT(*) FROM manual_upload WHERE stage_id = ?
-                ''', (stage_id,))
-                user_count = cursor.fetchone()[0]
-                
-                stages_message += f"🆔 **{stage_id}**: {stage_name}\n"
-                stages_message += f"   👥 Участников: {user_count}\n\n"
-            
-            await message.answer(stages_message, parse_mode="Markdown")
-            
+                    SELECT stage_id, stage_name
+                    FROM stages
+                    ORDER BY stage_id
+                ''')
+
+                stages = []
+                for stage_id, stage_name in cursor.fetchall():
+                    # Получаем количество пользователей на этом этапе
+                    cursor.execute('''
+                        SELECT COUNT(*) FROM manual_upload WHERE stage_id = ?
+                    ''', (stage_id,))
+                    stages.append((stage_id, stage_name, cursor.fetchone()[0]))
+                return stages
+
+        stages = await adb.run(_load)
+
+        if not stages:
+            await message.answer("📋 Список этапов пуст")
+            return
+
+        stages_message = "📋 **Список этапов:**\n\n"
+
+        for stage_id, stage_name, user_count in stages:
+            stages_message += f"🆔 **{stage_id}**: {stage_name}\n"
+            stages_message += f"   👥 Участников: {user_count}\n\n"
+
+        await message.answer(stages_message, parse_mode="Markdown")
+
     except Exception as e:
         logging.error(f"Ошибка при получении списка этапов: {e}")
         await message.answer("❌ Произошла ошибка при получении списка этапов")
@@ -134,36 +138,32 @@ async def delete_stage_command(message: Message):
         return
     
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем список этапов
-            cursor.execute('SELECT stage_id, stage_name FROM stages ORDER BY stage_id')
-            stages = cursor.fetchall()
-            
-            if not stages:
-                await message.answer("📋 Нет этапов для удаления")
-                return
-            
-            # Создаем клавиатуру с этапами (ИЗМЕНЕН ФОРМАТ - отличный от content_router)
-            keyboard = ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text=f"Удалить этап {stage_id}: {name}")]  # ИЗМЕНЕНО: другой формат
-                    for stage_id, name in stages
-                ] + [[KeyboardButton(text="❌ Отмена")]],
-                resize_keyboard=True
-            )
-            
-            await message.answer(
-                "🗑️ Выберите этап для удаления:\n\n"
-                "⚠️ **Внимание**: Эта операция необратима!\n"
-                "При удалении этапа:\n"
-                "• Удалятся все пользователи с этого этапа из manual_upload\n"
-                "• Удалятся связанные ссылки из link_generation\n"
-                "• Обнулятся participant_id в таблице main",
-                reply_markup=keyboard
-            )
-            
+        # Получаем список этапов
+        stages = await adb.run(load_stages)
+
+        if not stages:
+            await message.answer("📋 Нет этапов для удаления")
+            return
+
+        # Создаем клавиатуру с этапами (ИЗМЕНЕН ФОРМАТ - отличный от content_router)
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=[
+                [KeyboardButton(text=f"Удалить этап {stage_id}: {name}")]  # ИЗМЕНЕНО: другой формат
+                for stage_id, name in stages
+            ] + [[KeyboardButton(text="❌ Отмена")]],
+            resize_keyboard=True
+        )
+
+        await message.answer(
+            "🗑️ Выберите этап для удаления:\n\n"
+            "⚠️ **Внимание**: Эта операция необратима!\n"
+            "При удалении этапа:\n"
+            "• Удалятся все пользователи с этого этапа из manual_upload\n"
+            "• Удалятся связанные ссылки из link_generation\n"
+            "• Обнулятся participant_id в таблице main",
+            reply_markup=keyboard
+        )
+
     except Exception as e:
         logging.error(f"Ошибка при подготовке удаления этапа: {e}")
         await message.answer("❌ Произошла ошибка")
@@ -181,90 +181,45 @@ async def process_stage_deletion(message: Message):
         # Извлекаем ID этапа из текста (формат: "Удалить этап 1: Название этапа")
         stage_id = int(message.text.split(':')[0].replace("Удалить этап ", "").strip())
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Получаем название этапа для подтверждения
-            cursor.execute('SELECT stage_name FROM stages WHERE stage_id = ?', (stage_id,))
-            stage_data = cursor.fetchone()
-            
-            if not stage_data:
-                await message.answer("❌ Этап не найден", reply_markup=ReplyKeyboardRemove())
-                return
-            
-            stage_name = stage_data[0]
-            
-            # Получаем количество пользователей на этом этапе
-            cursor.execute('SELECT COUNT(*) FROM manual_upload WHERE stage_id = ?', (stage_id,))
-            user_count = cursor.fetchone()[0]
-            
-            if user_count == 0:
-                # Если нет пользователей - просто удаляем этап
-                cursor.execute('DELETE FROM stages WHERE stage_id = ?', (stage_id,))
-                conn.commit()
-                
-                await message.answer(
-                    f"✅ Этап удален:\n\n"
-                    f"🆔 ID: {stage_id}\n"
-                    f"📝 Название: {stage_name}\n"
-                    f"👥 Пользователей: 0",
-                    reply_markup=ReplyKeyboardRemove()
-                )
-                
-                logging.info(f"Удален этап: ID={stage_id}, название='{stage_name}'")
-                return
-            
-            # Если есть пользователи - выполняем каскадное удаление
-            
-            # 1. Получаем всех participant_id с этого этапа
-            cursor.execute('SELECT participant_id FROM manual_upload WHERE stage_id = ?', (stage_id,))
-            participant_ids = [row[0] for row in cursor.fetchall()]
-            
-            deleted_users_count = 0
-            deleted_links_count = 0
-            updated_main_count = 0
-            
-            # 2. Для каждого participant_id выполняем каскадные операции
-            for participant_id in participant_ids:
-                # Удаляем из link_generation
-                cursor.execute('DELETE FROM link_generation WHERE participant_id = ?', (participant_id,))
-                deleted_links_count += cursor.rowcount
-                
-                # Обнуляем participant_id в таблице main (НЕ удаляем пользователя!)
-                cursor.execute('''
-                    UPDATE main 
-                    SET participant_id = NULL 
-                    WHERE participant_id = ?
-                ''', (participant_id,))
-                updated_main_count += cursor.rowcount
-                
-                # Удаляем из manual_upload
-                cursor.execute('DELETE FROM manual_upload WHERE participant_id = ?', (participant_id,))
-                deleted_users_count += cursor.rowcount
-            
-            # 3. Удаляем сам этап
-            cursor.execute('DELETE FROM stages WHERE stage_id = ?', (stage_id,))
-            
-            conn.commit()
-            
+        # Каскадное удаление набором запросов в одной транзакции
+        result = await adb.delete_stage_cascade(stage_id)
+        
+        if result is None:
+            await message.answer("❌ Этап не найден", reply_markup=ReplyKeyboardRemove())
+            return
+        
+        stage_name = result['stage_name']
+        
+        if result['deleted_users'] == 0:
             await message.answer(
-                f"✅ Этап удален с каскадным удалением:\n\n"
-                f"🆔 ID этапа: {stage_id}\n"
+                f"✅ Этап удален:\n\n"
+                f"🆔 ID: {stage_id}\n"
                 f"📝 Название: {stage_name}\n"
-                f"🗑️ Удалено пользователей: {deleted_users_count}\n"
-                f"🔗 Удалено ссылок: {deleted_links_count}\n"
-                f"🔄 Обновлено записей в main: {updated_main_count}",
+                f"👥 Пользователей: 0",
                 reply_markup=ReplyKeyboardRemove()
             )
             
-            logging.info(
-                f"Удален этап с каскадным удалением: "
-                f"ID={stage_id}, название='{stage_name}', "
-                f"пользователей={deleted_users_count}, "
-                f"ссылок={deleted_links_count}, "
-                f"обновлено main={updated_main_count}"
-            )
-            
+            logging.info(f"Удален этап: ID={stage_id}, название='{stage_name}'")
+            return
+        
+        await message.answer(
+            f"✅ Этап удален с каскадным удалением:\n\n"
+            f"🆔 ID этапа: {stage_id}\n"
+            f"📝 Название: {stage_name}\n"
+            f"🗑️ Удалено пользователей: {result['deleted_users']}\n"
+            f"🔗 Удалено ссылок: {result['deleted_links']}\n"
+            f"🔄 Обновлено записей в main: {result['updated_main']}",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        
+        logging.info(
+            f"Удален этап с каскадным удалением: "
+            f"ID={stage_id}, название='{stage_name}', "
+            f"пользователей={result['deleted_users']}, "
+            f"ссылок={result['deleted_links']}, "
+            f"обновлено main={result['updated_main']}"
+        )
+        
     except ValueError:
         await message.answer("❌ Неверный формат этапа", reply_markup=ReplyKeyboardRemove())
     except Exception as e:
@@ -272,14 +227,17 @@ async def process_stage_deletion(message: Message):
         await message.answer("❌ Произошла ошибка при удалении этапа", reply_markup=ReplyKeyboardRemove())
 
 # Вспомогательные функции
+def load_stages() -> list:
+    """Список этапов [(stage_id, stage_name)] (выполняется в потоке БД)"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT stage_id, stage_name FROM stages ORDER BY stage_id')
+        return cursor.fetchall()
+
 async def get_user_role(telegram_id: int) -> str:
     """Получить роль пользователя"""
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT role FROM main WHERE telegram_id = ?', (telegram_id,))
-            result = cursor.fetchone()
-            return result[0] if result else 'user'
+        return await adb.get_user_role(telegram_id) or 'user'
     except Exception:
         return 'user'
 
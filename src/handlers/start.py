@@ -4,78 +4,27 @@ import logging
 import asyncio
 import os
 from handlers.link_generation import handle_link_click
-from database import db
+from database import adb
 
 def setup_start_handler(dp, shutdown_manager, logger: logging.Logger, bot_username: str = None):
     """Настройка обработчиков команд /start"""
     
     async def get_user_name_patronymic(telegram_id: int):
         """Получить Имя и Отчество пользователя из manual_upload"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT mu.first_name, mu.middle_name 
-                    FROM main m
-                    JOIN manual_upload mu ON m.participant_id = mu.participant_id
-                    WHERE m.telegram_id = ?
-                ''', (telegram_id,))
-                
-                user_data = cursor.fetchone()
-                if user_data:
-                    first_name, middle_name = user_data
-                    # Формируем строку "Имя Отчество", если отчество есть
-                    if middle_name:
-                        return f"{first_name} {middle_name}"
-                    else:
-                        return first_name
-                return None
-        except Exception as e:
-            logger.error(f"Ошибка при получении имени пользователя: {e}")
-            return None
+        user_data = await adb.get_participant_name(telegram_id)
+        if user_data:
+            first_name, middle_name = user_data
+            # Формируем строку "Имя Отчество", если отчество есть
+            if middle_name:
+                return f"{first_name} {middle_name}"
+            else:
+                return first_name
+        return None
     
     async def register_user(telegram_id: int, telegram_username: str = None) -> bool:
         """Регистрация пользователя при обычном /start"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Проверяем, не зарегистрирован ли уже пользователь
-                cursor.execute('''
-                    SELECT user_id, role FROM main WHERE telegram_id = ?
-                ''', (telegram_id,))
-                
-                existing_user = cursor.fetchone()
-                
-                if existing_user:
-                    user_id, current_role = existing_user
-                    logger.info(f"Пользователь {telegram_id} уже зарегистрирован с ролью: {current_role}")
-                    
-                    # ✅ ПРОВЕРКА: Если админ/модератор - оставляем как есть
-                    if current_role in ['admin', 'moderator']:
-                        logger.info(f"Админ/модератор {telegram_id} сохраняет свою роль")
-                        return True
-                    
-                    # ✅ СТАРАЯ ЛОГИКА: Просто возвращаем True для обычных пользователей
-                    # Не обновляем username, не меняем ничего
-                    logger.info(f"Обычный пользователь {telegram_id} уже зарегистрирован")
-                    return True
-                
-                # ✅ СТАРАЯ ЛОГИКА: Регистрируем нового пользователя с ролью 'user'
-                cursor.execute('''
-                    INSERT INTO main (telegram_id, telegram_username, role)
-                    VALUES (?, ?, 'user')
-                ''', (telegram_id, telegram_username))
-                
-                user_id = cursor.lastrowid
-                conn.commit()
-                
-                logger.info(f"Зарегистрирован новый пользователь: user_id={user_id}, telegram_id={telegram_id}, username={telegram_username}, role=user")
-                return True
-                
-        except Exception as e:
-            logger.error(f"Ошибка при регистрации пользователя {telegram_id}: {e}", exc_info=True)
-            return False
+        # Админы/модераторы и уже зарегистрированные пользователи не изменяются
+        return await adb.register_user(telegram_id, telegram_username)
 
     async def send_welcome_sequence(message: Message, user_name: str = None, user_stage_id: int = None):
         """Отправка приветственной последовательности с таймаутами"""
@@ -167,23 +116,7 @@ def setup_start_handler(dp, shutdown_manager, logger: logging.Logger, bot_userna
 
     async def get_user_stage_id(telegram_id: int):
         """Получить stage_id пользователя из manual_upload через main"""
-        try:
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    SELECT mu.stage_id 
-                    FROM main m
-                    JOIN manual_upload mu ON m.participant_id = mu.participant_id
-                    WHERE m.telegram_id = ?
-                ''', (telegram_id,))
-                
-                result = cursor.fetchone()
-                return result[0] if result else None
-                
-        except Exception as e:
-            logger.error(f"Ошибка при получении stage_id пользователя {telegram_id}: {e}")
-            return None
+        return await adb.get_user_stage_id(telegram_id)
 
     @dp.message(CommandStart())
     async def handle_start(message: Message):
@@ -201,7 +134,8 @@ def setup_start_handler(dp, shutdown_manager, logger: logging.Logger, bot_userna
                 
                 logger.info(f"Пользователь {message.from_user.id} перешел по ссылке: {universal_link}")
                 
-                success, result_message = handle_link_click(
+                success, result_message = await adb.run(
+                    handle_link_click,
                     universal_link, 
                     message.from_user.id, 
                     message.from_user.username,
@@ -23,7 +23,7 @@ except ImportError:
             logging.error("Функция process_participants_export не найдена")
             return False
 
-from database import db
+from database import db, adb
 
 # Создаем роутер
 update_router = Router()
@@ -155,54 +155,33 @@ async def data_stats_command(message: Message):
     """Команда для показа статистики данных"""
     
     try:
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Общая статистика
-            cursor.execute("SELECT COUNT(*) FROM manual_upload")
-            total_participants = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(DISTINCT email) FROM manual_upload")
-            unique_emails = cursor.fetchone()[0]
-            
-            # Статистика по этапам
-            cursor.execute('''
-                SELECT s.stage_name, COUNT(m.participant_id) 
-                FROM manual_upload m 
-                JOIN stages s ON m.stage_id = s.stage_id 
-                GROUP BY s.stage_name
-                ORDER BY s.stage_id
-            ''')
-            stage_stats = cursor.fetchall()
-            
-            # Статистика по дням регистрации
-            cursor.execute('''
-                SELECT DATE(registration_date), COUNT(*) 
-                FROM manual_upload 
-                WHERE registration_date IS NOT NULL
-                GROUP BY DATE(registration_date)
-                ORDER BY DATE(registration_date) DESC
-                LIMIT 7
-            ''')
-            date_stats = cursor.fetchall()
-            
-            # Формируем сообщение со статистикой
-            stats_text = "📊 Статистика данных:\n\n"
-            stats_text += f"👥 Всего участников: {total_participants}\n"
-            stats_text += f"📧 Уникальных email: {unique_emails}\n\n"
-            
-            stats_text += "📋 Распределение по этапам:\n"
-            for stage_name, count in stage_stats:
-                short_name = stage_name[:25] + "..." if len(stage_name) > 25 else stage_name
-                stats_text += f"• {short_name}: {count}\n"
-            
-            if date_stats:
-                stats_text += "\n📅 Регистрации за последние 7 дней:\n"
-                for date_str, count in date_stats:
-                    stats_text += f"• {date_str}: {count}\n"
-            
-            await message.answer(stats_text)
-            
+        # Счетчики по колоночному снимку участников, без запросов к базе
+        total_participants = await adb.run(db.analytics.total)
+        unique_emails = await adb.run(db.analytics.unique_emails)
+        stage_stats = [
+            (stage['stage_name'], stage['participants'])
+            for stage in await adb.run(db.analytics.stage_breakdown)
+            if stage['participants'] and stage['stage_id'] in db.analytics.stage_names
+        ]
+        date_stats = await adb.run(db.analytics.registrations_by_day, 7)
+
+        # Формируем сообщение со статистикой
+        stats_text = "📊 Статистика данных:\n\n"
+        stats_text += f"👥 Всего участников: {total_participants}\n"
+        stats_text += f"📧 Уникальных email: {unique_emails}\n\n"
+
+        stats_text += "📋 Распределение по этапам:\n"
+        for stage_name, count in stage_stats:
+            short_name = stage_name[:25] + "..." if len(stage_name) > 25 else stage_name
+            stats_text += f"• {short_name}: {count}\n"
+
+        if date_stats:
+            stats_text += "\n📅 Регистрации за последние 7 дней:\n"
+            for date_str, count in date_stats:
+                stats_text += f"• {date_str}: {count}\n"
+
+        await message.answer(stats_text)
+
     except Exception as e:
         logging.error(f"Ошибка получения статистики: {e}")
         await message.answer("❌ Ошибка при получении статистики данных")
@@ -5,19 +5,18 @@
 
 import sqlite3
 import os
+import time
 from typing import List, Dict, Any
 from datetime import datetime, timedelta
 
+from database import db
+
+# Повторная отправка письма не чаще, чем раз в 20 часов
+MAIL_RESEND_INTERVAL_SECONDS = 20 * 60 * 60
+
 def get_db_connection():
-    """Получение соединения с базой данных"""
-    current_dir = os.path.dirname(__file__)
-    parent_dir = os.path.dirname(current_dir)  # src
-    db_path = os.path.join(parent_dir, 'runners.db')
-    
-    if not os.path.exists(db_path):
-        raise FileNotFoundError(f"База данных не найдена: {db_path}")
-    
-    return sqlite3.connect(db_path)
+    """Получение соединения с базой данных из общего пула бота"""
+    return db.get_connection()
 
 def get_stage_name(stage_id: int) -> str:
     """Получение названия этапа из таблицы stages"""
@@ -97,7 +96,9 @@ def get_recipients_from_db() -> List[Dict[str, Any]]:
         
         # Получаем получателей, у которых:
         # - status = 1 (готовы к отправке)
-        # - И mailing_date отсутствует ИЛИ прошло больше 20 часов с mailing_date
+        # - И наступило время следующей отправки next_mail_due_at
+        #   (0 для новых ссылок, mailing_date + 20 часов после отправки).
+        # Выборка идет диапазоном по индексу (status, next_mail_due_at).
         cursor.execute("""
             SELECT 
                 mu.participant_id,
@@ -110,18 +111,15 @@ def get_recipients_from_db() -> List[Dict[str, Any]]:
                 lg.universal_link,
                 lg.status,
                 lg.mailing_date
-            FROM manual_upload mu
-            LEFT JOIN link_generation lg ON mu.participant_id = lg.participant_id
-            WHERE mu.email IS NOT NULL 
-                AND mu.email != ''
-                AND lg.status = 1
+            FROM link_generation lg
+            JOIN manual_upload mu ON mu.participant_id = lg.participant_id
+            WHERE lg.status = 1
+                AND lg.next_mail_due_at <= ?
                 AND lg.universal_link IS NOT NULL
                 AND lg.universal_link != ''
-                AND (
-                    lg.mailing_date IS NULL 
-                    OR datetime(lg.mailing_date) < datetime('now', '-20 hours')
-                )
-        """)
+                AND mu.email IS NOT NULL 
+                AND mu.email != ''
+        """, (int(time.time()),))
         
         recipients = []
         for row in cursor.fetchall():
@@ -160,17 +158,16 @@ def get_recipients_from_db() -> List[Dict[str, Any]]:
 def update_mailing_date(participant_id: int) -> bool:
     """Обновление даты отправки письма"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE link_generation 
-            SET mailing_date = CURRENT_TIMESTAMP
-            WHERE participant_id = ?
-        """, (participant_id,))
+        def _write(cursor):
+            cursor.execute("""
+                UPDATE link_generation 
+                SET mailing_date = CURRENT_TIMESTAMP,
+                    next_mail_due_at = CAST(strftime('%s', 'now') AS INTEGER) + ?
+                WHERE participant_id = ?
+            """, (MAIL_RESEND_INTERVAL_SECONDS, participant_id))
+
+        db.write(_write)
         
-        conn.commit()
-        conn.close()
         print(f"✅ Дата отправки обновлена для participant_id {participant_id}")
         return True
         
@@ -21,7 +21,17 @@ from handlers.global_handler import setup_global_handler
 # Импортируем интеграцию с рассылкой из текущей директории
 from mail_integration import mail_integration
 
-from database import db
+from database import db, adb
+from snapshots import DatabaseSnapshotter
+from maintenance import DatabaseMaintenance, parse_quiet_hours
+from retention import DataRetention, parse_event_start
+from analytics import ParticipantAnalytics
+from sharding import shard_path
+from fsm_storage import SQLiteStorage, RedisFSMStorage
+from fsm_context import CoalescedFSMMiddleware
+from fsm_expiry import FSMExpiry, parse_state_ttls
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from datetime import timedelta
 
 # Настройка логирования
 logger = setup_logging()
@@ -29,7 +39,18 @@ logger = setup_logging()
 # Инициализация бота
 Config.validate()
 bot = Bot(token=Config.BOT_TOKEN)
-dp = Dispatcher()
+# Состояния FSM переживают перезапуск: Redis (общий для нескольких процессов бота)
+# или таблица fsm_storage с кэшем в памяти
+if Config.REDIS_URL:
+    fsm_storage = RedisFSMStorage.from_url(Config.REDIS_URL, ttl=timedelta(days=Config.FSM_TTL_DAYS))
+    dp = Dispatcher(storage=fsm_storage, events_isolation=fsm_storage.create_isolation())
+else:
+    fsm_storage = SQLiteStorage(db, adb)
+    dp = Dispatcher(storage=fsm_storage, events_isolation=SimpleEventIsolation())
+# Данные FSM читаются один раз за обновление и записываются одной операцией после обработчика
+# (обновления одного пользователя обрабатываются по очереди - events_isolation выше)
+fsm_middleware = CoalescedFSMMiddleware()
+dp.update.outer_middleware(fsm_middleware)
 
 # Инициализация менеджера завершения работы
 shutdown_manager = ShutdownManager(bot, dp, logger)
@@ -82,6 +103,11 @@ async def on_startup():
     
     logger.info(f"Токен бота: {'*' * 10}{Config.BOT_TOKEN[-5:]}")
     logger.info(f"Путь к БД: {Config.DATABASE_PATH}")
+
+    # Шарды пользовательских таблиц включаются до первой записи
+    if Config.DB_SHARD_COUNT > 1:
+        moved = await adb.run(db.configure_shards, Config.DB_SHARD_COUNT)
+        logger.info(f"✅ Шардирование: {Config.DB_SHARD_COUNT} шардов, перенесено {moved or 'ничего'}")
     
     # Инициализация БД при запуске бота
     try:
@@ -108,6 +134,85 @@ async def on_startup():
         logger.error(f"Ошибка при инициализации БД: {e}", exc_info=True)
         raise
     
+    # Порог журнала медленных запросов
+    db.query_stats.slow_threshold = Config.SLOW_QUERY_THRESHOLD_MS / 1000
+
+    # ЗАПУСК СНИМКОВ БАЗЫ: реплика для отчетов и резервные копии
+    db.snapshots = DatabaseSnapshotter(
+        db.db_path,
+        Config.REPLICA_PATH,
+        backup_dir=Config.BACKUP_DIR,
+        refresh_minutes=Config.REPLICA_REFRESH_MINUTES,
+        max_staleness_minutes=Config.REPLICA_MAX_STALENESS_MINUTES,
+        backup_interval_hours=Config.BACKUP_INTERVAL_HOURS,
+        backup_keep=Config.BACKUP_KEEP
+    )
+    db.snapshots.start()
+    logger.info(f"✅ Снимки базы запущены: реплика {Config.REPLICA_PATH}, копии в {Config.BACKUP_DIR}")
+
+    # Архив устаревших user_data и verification (переносится в тихие часы)
+    db.retention = DataRetention(
+        db.db_path,
+        archive_path=Config.ARCHIVE_PATH,
+        event_started_at=parse_event_start(Config.EVENT_STARTED_AT)
+    )
+
+    # ЗАПУСК ОБСЛУЖИВАНИЯ БАЗЫ: optimize, checkpoint WAL, архив и vacuum в тихие часы
+    db.maintenance = DatabaseMaintenance(
+        db.db_path,
+        interval_minutes=Config.MAINTENANCE_INTERVAL_MINUTES,
+        wal_threshold_mb=Config.WAL_CHECKPOINT_THRESHOLD_MB,
+        quiet_hours=parse_quiet_hours(Config.MAINTENANCE_QUIET_HOURS),
+        retention=db.retention
+    )
+    db.maintenance.start()
+    logger.info(f"✅ Обслуживание базы запущено, тихие часы {Config.MAINTENANCE_QUIET_HOURS}")
+
+    # Реплика, архив и обслуживание каждого шарда - рядом с файлами основной базы
+    for index, path in enumerate(db.shard_paths):
+        snapshots = DatabaseSnapshotter(
+            path,
+            shard_path(Config.REPLICA_PATH, index),
+            backup_dir=Config.BACKUP_DIR,
+            refresh_minutes=Config.REPLICA_REFRESH_MINUTES,
+            max_staleness_minutes=Config.REPLICA_MAX_STALENESS_MINUTES,
+            backup_interval_hours=Config.BACKUP_INTERVAL_HOURS,
+            backup_keep=Config.BACKUP_KEEP
+        )
+        snapshots.start()
+        db.shard_snapshots.append(snapshots)
+
+        maintenance = DatabaseMaintenance(
+            path,
+            interval_minutes=Config.MAINTENANCE_INTERVAL_MINUTES,
+            wal_threshold_mb=Config.WAL_CHECKPOINT_THRESHOLD_MB,
+            quiet_hours=parse_quiet_hours(Config.MAINTENANCE_QUIET_HOURS),
+            retention=DataRetention(
+                path,
+                archive_path=shard_path(Config.ARCHIVE_PATH, index) if Config.ARCHIVE_PATH else None,
+                event_started_at=parse_event_start(Config.EVENT_STARTED_AT)
+            )
+        )
+        maintenance.start()
+        db.shard_maintenance.append(maintenance)
+    if db.shard_paths:
+        logger.info(f"✅ Снимки и обслуживание шардов запущены: {len(db.shard_paths)}")
+
+    # Истечение брошенных состояний FSM (в Redis ключи истекают сами, FSM_TTL_DAYS)
+    if isinstance(fsm_storage, SQLiteStorage):
+        fsm_expiry = FSMExpiry(
+            fsm_storage,
+            state_ttls=parse_state_ttls(Config.FSM_STATE_TTL_DAYS),
+            default_ttl=int(Config.FSM_TTL_DAYS * 86400),
+            max_tracked=Config.FSM_MAX_TRACKED
+        )
+        fsm_expiry.start()
+        logger.info(f"✅ Истечение состояний FSM запущено: {Config.FSM_STATE_TTL_DAYS}, по умолчанию {Config.FSM_TTL_DAYS:g} дн.")
+
+    # Снимок участников для статистики: первая загрузка в фоне, дальше дочитка изменений
+    db.analytics = ParticipantAnalytics(db)
+    asyncio.create_task(adb.run(db.analytics.refresh))
+
     # ЗАПУСК АВТОМАТИЧЕСКОЙ ГЕНЕРАЦИИ ССЫЛОК
     logger.info("🤖 Запуск автоматической генерации ссылок...")
     try:
@@ -166,7 +271,30 @@ async def on_shutdown():
         logger.info("🛑 Останавливаем планировщик рассылок...")
         await mail_integration.stop_scheduler()
         logger.info("✅ Планировщик рассылок остановлен")
-    
+
+    # Останавливаем снимки и обслуживание базы
+    if db.snapshots is not None:
+        db.snapshots.stop_scheduler()
+    if db.maintenance is not None:
+        db.maintenance.stop_scheduler()
+    for snapshots in db.shard_snapshots:
+        snapshots.stop_scheduler()
+    for maintenance in db.shard_maintenance:
+        maintenance.stop_scheduler()
+    if getattr(fsm_storage, 'expiry', None) is not None:
+        fsm_storage.expiry.stop_scheduler()
+
+    # Записываем накопленные состояния FSM (SQLite) или закрываем соединения Redis
+    # до остановки писателя базы: отложенная запись не должна прийти после db.close()
+    try:
+        await fsm_storage.close()
+    except Exception as e:
+        logger.error(f"❌ Ошибка закрытия хранилища FSM: {e}")
+
+    # Останавливаем потоки БД и закрываем пул соединений
+    adb.shutdown()
+    db.close()
+
     logger.info("=" * 50)
 
 async def main():
@@ -0,0 +1,229 @@
+# src/maintenance.py
+"""
+Плановое обслуживание SQLite.
+
+Каждый запуск: PRAGMA optimize (с analysis_limit, чтобы не читать большие
+таблицы целиком) и wal_checkpoint(TRUNCATE), если WAL вырос больше порога.
+В тихие часы дополнительно: полный ANALYZE раз в сутки, перенос холодных
+строк в архив (retention.py) и incremental_vacuum порциями страниц.
+Обслуживание идет через отдельное соединение вне писателя: checkpoint и
+VACUUM нельзя выполнять внутри транзакции.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Optional
+
+MAINTENANCE_INTERVAL_MINUTES = 30
+WAL_CHECKPOINT_THRESHOLD_MB = 64
+# Тихие часы [начало, конец) по локальному времени, допускается переход через полночь
+QUIET_HOURS = (3, 6)
+ANALYZE_INTERVAL_HOURS = 24
+# Строк на индекс для PRAGMA optimize (выборочная статистика)
+ANALYSIS_LIMIT = 1000
+# incremental_vacuum: страниц за шаг и максимум за один запуск
+VACUUM_PAGES_PER_STEP = 1000
+VACUUM_MAX_PAGES = 100000
+BUSY_TIMEOUT_MS = 5000
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def parse_quiet_hours(value: str) -> tuple:
+    """'3-6' -> (3, 6)"""
+    start, end = value.split('-', 1)
+    return int(start) % 24, int(end) % 24
+
+
+class DatabaseMaintenance:
+    """Фоновое обслуживание базы: статистика планировщика, checkpoint, vacuum"""
+
+    def __init__(self, db_path: str,
+                 interval_minutes: float = MAINTENANCE_INTERVAL_MINUTES,
+                 wal_threshold_mb: float = WAL_CHECKPOINT_THRESHOLD_MB,
+                 quiet_hours: tuple = QUIET_HOURS,
+                 retention=None):
+        self.db_path = db_path
+        # retention.DataRetention: перенос в архив перед incremental_vacuum
+        self.retention = retention
+        self.interval = interval_minutes * 60
+        self.wal_threshold = int(wal_threshold_mb * 1024 * 1024)
+        self.quiet_hours = quiet_hours
+        self.last_analyze_at = None
+        self.last_run = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+
+    def is_quiet_time(self, now: datetime = None) -> bool:
+        """Попадает ли время в тихие часы"""
+        hour = (now or datetime.now()).hour
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    # ---------- Операции ----------
+
+    def optimize(self, conn: sqlite3.Connection) -> float:
+        """PRAGMA optimize: ANALYZE только для таблиц, где статистика устарела"""
+        started = time.monotonic()
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        conn.execute("PRAGMA optimize").fetchall()
+        duration = time.monotonic() - started
+        logging.info(f"PRAGMA optimize выполнен за {duration:.3f} с")
+        return duration
+
+    def analyze(self, conn: sqlite3.Connection) -> float:
+        """Полный ANALYZE по всем таблицам"""
+        started = time.monotonic()
+        conn.execute("PRAGMA analysis_limit=0")
+        conn.execute("ANALYZE")
+        self.last_analyze_at = time.time()
+        duration = time.monotonic() - started
+        logging.info(f"ANALYZE выполнен за {duration:.3f} с")
+        return duration
+
+    def wal_size(self) -> int:
+        """Размер файла WAL в байтах"""
+        try:
+            return os.path.getsize(f"{self.db_path}-wal")
+        except OSError:
+            return 0
+
+    def checkpoint_if_needed(self, conn: sqlite3.Connection) -> Optional[dict]:
+        """wal_checkpoint(TRUNCATE), если WAL больше порога"""
+        size_before = self.wal_size()
+        if size_before < self.wal_threshold:
+            return None
+
+        started = time.monotonic()
+        busy, log_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        result = {
+            'busy': bool(busy),
+            'wal_bytes_before': size_before,
+            'wal_bytes_after': self.wal_size(),
+            'log_frames': log_frames,
+            'checkpointed_frames': checkpointed,
+            'seconds': time.monotonic() - started
+        }
+        if busy:
+            logging.warning(f"Checkpoint WAL не завершен (есть активные читатели): {result}")
+        else:
+            logging.info(
+                f"Checkpoint WAL за {result['seconds']:.3f} с: "
+                f"{size_before // 1024} КБ -> {result['wal_bytes_after'] // 1024} КБ"
+            )
+        return result
+
+    def incremental_vacuum(self, conn: sqlite3.Connection) -> int:
+        """Освобождение свободных страниц, возвращает число возвращенных ОС страниц.
+
+        Если база создана без auto_vacuum=INCREMENTAL, режим включается
+        один раз полным VACUUM (он блокирует запись на время выполнения,
+        поэтому только в тихие часы).
+        """
+        started = time.monotonic()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            reclaimed = pages_before - conn.execute("PRAGMA page_count").fetchone()[0]
+            logging.info(
+                f"Включен auto_vacuum=INCREMENTAL: VACUUM за {time.monotonic() - started:.3f} с, "
+                f"освобождено страниц: {reclaimed}"
+            )
+            return reclaimed
+
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_before == 0:
+            return 0
+
+        remaining = min(free_before, VACUUM_MAX_PAGES)
+        while remaining > 0:
+            step = min(remaining, VACUUM_PAGES_PER_STEP)
+            # execute() останавливается после первой страницы (PRAGMA отдает строку
+            # на каждую), executescript выполняет оператор до конца
+            conn.executescript(f"PRAGMA incremental_vacuum({step})")
+            remaining -= step
+
+        reclaimed = free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        logging.info(
+            f"incremental_vacuum за {time.monotonic() - started:.3f} с, "
+            f"освобождено страниц: {reclaimed} из {free_before}"
+        )
+        return reclaimed
+
+    def run_once(self, now: datetime = None) -> dict:
+        """Один проход обслуживания"""
+        started = time.monotonic()
+        result = {'quiet_time': self.is_quiet_time(now)}
+        conn = self._connect()
+        try:
+            result['optimize_seconds'] = self.optimize(conn)
+            result['checkpoint'] = self.checkpoint_if_needed(conn)
+
+            if result['quiet_time']:
+                analyze_due = (
+                    self.last_analyze_at is None
+                    or time.time() - self.last_analyze_at >= ANALYZE_INTERVAL_HOURS * 3600
+                )
+                if analyze_due:
+                    result['analyze_seconds'] = self.analyze(conn)
+                if self.retention is not None:
+                    result['archived'] = self.retention.compact()
+                result['reclaimed_pages'] = self.incremental_vacuum(conn)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка обслуживания базы данных: {e}")
+            result['error'] = str(e)
+        finally:
+            conn.close()
+
+        result['seconds'] = time.monotonic() - started
+        result['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        self.last_run = result
+        return result
+
+    # ---------- Планировщик ----------
+
+    async def start_scheduler(self):
+        """Цикл обслуживания"""
+        logging.info(f"⏰ Обслуживание базы каждые {self.interval / 60:g} минут")
+        while not self._stop_event.is_set():
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logging.error(f"❌ Ошибка в планировщике обслуживания базы: {e}")
+
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                continue
+            except asyncio.CancelledError:
+                break
+
+    def start(self) -> bool:
+        """Запуск планировщика в фоне"""
+        if self.is_running():
+            return True
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self.start_scheduler())
+        return True
+
+    def stop_scheduler(self):
+        """Остановка планировщика"""
+        self._stop_event.set()
+        if self._task and not self._task.done():
+            self._task.cancel()
+        logging.info("🛑 Планировщик обслуживания базы остановлен")
+
+    def is_running(self) -> bool:
+        """Проверка, работает ли планировщик"""
+        return self._task is not None and not self._task.done()
@@ -0,0 +1,643 @@
+"""
+Версионные миграции схемы базы данных.
+
+Каждая миграция — функция с номером версии; примененные версии хранятся
+в таблице schema_version. При запуске проверяется только текущая версия,
+недостающие миграции применяются по порядку, каждая в своей короткой
+транзакции. Шаги миграций должны быть безопасны для рабочей базы:
+ADD COLUMN, CREATE INDEX IF NOT EXISTS и т.п. вместо пересоздания таблиц.
+"""
+import sqlite3
+import logging
+
+# Строк за один UPDATE при заполнении существующих данных
+MIGRATION_BATCH_SIZE = 1000
+
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    """Проверка наличия колонки в таблице"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+def _add_column(cursor, table: str, column: str, definition: str):
+    """ALTER TABLE ADD COLUMN, если колонки еще нет (без перезаписи таблицы)"""
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _migration_001_baseline(cursor):
+    """Базовая схема (бывший Database.init_db)"""
+    # Таблица 4: Этапы (создаем первой из-за внешних ключей)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stages (
+            stage_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage_name TEXT NOT NULL UNIQUE
+        )
+    ''')
+
+    # Таблица 1: Ручная загрузка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS manual_upload (
+            participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_name TEXT NOT NULL,
+            first_name TEXT NOT NULL,
+            middle_name TEXT,
+            email TEXT NOT NULL,
+            phone INTEGER NOT NULL,
+            stage_id INTEGER NOT NULL,
+            FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
+        )
+    ''')
+
+    # Таблица 2: Формирование ссылки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS link_generation (
+            participant_id INTEGER PRIMARY KEY,
+            universal_link TEXT NOT NULL UNIQUE,
+            status INTEGER DEFAULT 0 CHECK(status IN (0, 1)),
+            creation_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            mailing_date DATETIME,
+            link_click_date DATETIME,
+            FOREIGN KEY (participant_id) REFERENCES manual_upload(participant_id)
+        )
+    ''')
+
+    # Таблица 3: Основная 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS main (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            participant_id INTEGER UNIQUE,
+            telegram_id INTEGER UNIQUE,
+            telegram_username TEXT,
+            role TEXT NOT NULL CHECK(role IN ('admin', 'moderator', 'user')),
+            quest_started INTEGER DEFAULT 0 CHECK(quest_started IN (0, 1)),
+            quest_started_at DATETIME,
+            current_stage INTEGER DEFAULT 1,
+            stage_1_completed INTEGER DEFAULT 0 CHECK(stage_1_completed IN (0, 1)),
+            stage_2_completed INTEGER DEFAULT 0 CHECK(stage_2_completed IN (0, 1)),
+            stage_3_completed INTEGER DEFAULT 0 CHECK(stage_3_completed IN (0, 1)),
+            stage_4_completed INTEGER DEFAULT 0 CHECK(stage_4_completed IN (0, 1)),
+            registration_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица 5: Суть этапа
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stage_content (
+            stage_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            order_number INTEGER NOT NULL,
+            message_text TEXT,
+            has_image INTEGER DEFAULT 0 CHECK(has_image IN (0, 1)),
+            image_url TEXT,
+            has_video INTEGER DEFAULT 0 CHECK(has_video IN (0, 1)),
+            video_url TEXT,
+            has_feedback INTEGER DEFAULT 0 CHECK(has_feedback IN (0, 1)),
+            puzzle_check TEXT,
+            PRIMARY KEY (stage_id, message_id),
+            FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
+        )
+    ''')
+
+    # Таблица 6: Данные пользователя (обновленная структура)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            data_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            quest_started INTEGER DEFAULT 0 CHECK(quest_started IN (0, 1)),
+            image_url TEXT,
+            answer_text TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES main(user_id)
+        )
+    ''')
+
+    # Таблица 7: Проверка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS verification (
+            user_id INTEGER PRIMARY KEY,
+            distance INTEGER NOT NULL,
+            run_date DATE NOT NULL,
+            answer_check INTEGER DEFAULT 0 CHECK(answer_check IN (0, 1)),
+            FOREIGN KEY (user_id) REFERENCES main(user_id)
+        )
+    ''')
+
+    # Таблица 8: Участники розыгрыша
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS raffle_participants (
+            raffle_participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            telegram_username TEXT,
+            participation_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            raffle_id INTEGER,
+            FOREIGN KEY (telegram_id) REFERENCES main(telegram_id),
+            UNIQUE(telegram_id, raffle_id)
+        )
+    ''')
+
+    # ✅ ТАБЛИЦА 9: Адреса пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_addresses (
+            address_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            telegram_username TEXT,
+            stage INTEGER NOT NULL DEFAULT 1,
+            address TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_id) REFERENCES main(telegram_id),
+            UNIQUE(telegram_id, stage)
+        )
+    ''')
+
+    # ✅ ТАБЛИЦА 10: Промокоды
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS promo_codes (
+            promo_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            promo_code TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL DEFAULT 'active' CHECK(status IN ('active', 'used', 'expired')),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME,
+            sent_to_telegram_id INTEGER,
+            sent_to_username TEXT,
+            FOREIGN KEY (sent_to_telegram_id) REFERENCES main(telegram_id)
+        )
+    ''')
+
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS idx_manual_upload_email ON manual_upload(email)",
+        "CREATE INDEX IF NOT EXISTS idx_manual_upload_stage ON manual_upload(stage_id)",
+        "CREATE INDEX IF NOT EXISTS idx_link_generation_status ON link_generation(status)",
+        "CREATE INDEX IF NOT EXISTS idx_main_telegram_id ON main(telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_main_role ON main(role)",
+        "CREATE INDEX IF NOT EXISTS idx_main_current_stage ON main(current_stage)", 
+        "CREATE INDEX IF NOT EXISTS idx_main_stage_1_completed ON main(stage_1_completed)",
+        "CREATE INDEX IF NOT EXISTS idx_main_stage_2_completed ON main(stage_2_completed)",
+        "CREATE INDEX IF NOT EXISTS idx_main_stage_3_completed ON main(stage_3_completed)",
+        "CREATE INDEX IF NOT EXISTS idx_main_stage_4_completed ON main(stage_4_completed)",
+        "CREATE INDEX IF NOT EXISTS idx_stage_content_stage ON stage_content(stage_id)",
+        "CREATE INDEX IF NOT EXISTS idx_stage_content_order ON stage_content(order_number)",
+        "CREATE INDEX IF NOT EXISTS idx_user_data_user ON user_data(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_data_quest ON user_data(quest_started)",
+        "CREATE INDEX IF NOT EXISTS idx_verification_date ON verification(run_date)",
+        "CREATE INDEX IF NOT EXISTS idx_raffle_participants_telegram ON raffle_participants(telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_raffle_participants_date ON raffle_participants(participation_date)",
+        "CREATE INDEX IF NOT EXISTS idx_raffle_participants_raffle ON raffle_participants(raffle_id)",
+        # ✅ ИНДЕКСЫ ДЛЯ ТАБЛИЦЫ АДРЕСОВ
+        "CREATE INDEX IF NOT EXISTS idx_user_addresses_telegram ON user_addresses(telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_addresses_stage ON user_addresses(stage)",
+        # ✅ ИНДЕКСЫ ДЛЯ ТАБЛИЦЫ ПРОМОКОДОВ
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_code ON promo_codes(promo_code)",
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_status ON promo_codes(status)",
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_sent_to ON promo_codes(sent_to_telegram_id)"
+    ]
+
+    for index_sql in indexes:
+        cursor.execute(index_sql)
+
+
+def _migration_002_manual_upload_created_at(cursor):
+    """Колонка created_at и индекс по ФИО в manual_upload.
+
+    Раньше добавлялись через fix_table_structure полным пересозданием
+    таблицы. ADD COLUMN не переписывает данные; DEFAULT CURRENT_TIMESTAMP
+    в ALTER TABLE недопустим, поэтому колонка допускает NULL.
+    """
+    _add_column(cursor, 'manual_upload', 'created_at', 'TIMESTAMP')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_manual_upload_name ON manual_upload(last_name, first_name)")
+
+
+def _migration_003_drop_manual_upload_unique(cursor):
+    """Удаление старого уникального ограничения manual_upload.
+
+    Автоиндекс UNIQUE нельзя удалить без пересоздания таблицы, поэтому
+    пересоздание выполняется только для баз, где он действительно есть,
+    и с сохранением participant_id (на него ссылаются link_generation и main).
+    """
+    cursor.execute("PRAGMA index_list(manual_upload)")
+    if not any(idx[1].startswith('sqlite_autoindex_manual_upload') and idx[2] == 1
+               for idx in cursor.fetchall()):
+        return
+
+    logging.warning("Найден уникальный автоиндекс manual_upload - пересоздаем таблицу")
+    cursor.execute('''
+        CREATE TABLE manual_upload_new (
+            participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_name TEXT NOT NULL,
+            first_name TEXT NOT NULL,
+            middle_name TEXT,
+            email TEXT NOT NULL,
+            phone INTEGER NOT NULL,
+            stage_id INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO manual_upload_new
+        (participant_id, last_name, first_name, middle_name, email, phone, stage_id, created_at)
+        SELECT participant_id, last_name, first_name, middle_name, email, phone, stage_id, created_at
+        FROM manual_upload
+    ''')
+    cursor.execute("DROP TABLE manual_upload")
+    cursor.execute("ALTER TABLE manual_upload_new RENAME TO manual_upload")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_manual_upload_email ON manual_upload(email)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_manual_upload_stage ON manual_upload(stage_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_manual_upload_name ON manual_upload(last_name, first_name)")
+
+
+def _migration_004_stage_progress(cursor):
+    """Компактный прогресс этапов: битовая маска main.stage_mask и таблица stage_progress.
+
+    Бит (N-1) маски означает завершение этапа N. Время завершения каждого
+    этапа хранится в stage_progress. Колонки stage_N_completed остаются в
+    таблице для совместимости со старыми выгрузками, но больше не обновляются;
+    их индексы удаляются.
+    """
+    _add_column(cursor, 'main', 'stage_mask', 'INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        UPDATE main
+        SET stage_mask = (COALESCE(stage_1_completed, 0))
+                       | (COALESCE(stage_2_completed, 0) << 1)
+                       | (COALESCE(stage_3_completed, 0) << 2)
+                       | (COALESCE(stage_4_completed, 0) << 3)
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stage_progress (
+            telegram_id INTEGER NOT NULL,
+            stage_number INTEGER NOT NULL CHECK(stage_number IN (1, 2, 3, 4)),
+            completed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, stage_number)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stage_progress_stage ON stage_progress(stage_number)")
+
+    # Время завершения уже пройденных этапов неизвестно - оставляем NULL
+    for stage_number in (1, 2, 3, 4):
+        cursor.execute(f'''
+            INSERT OR IGNORE INTO stage_progress (telegram_id, stage_number, completed_at)
+            SELECT telegram_id, ?, NULL FROM main
+            WHERE stage_{stage_number}_completed = 1 AND telegram_id IS NOT NULL
+        ''', (stage_number,))
+
+    for stage_number in (1, 2, 3, 4):
+        cursor.execute(f"DROP INDEX IF EXISTS idx_main_stage_{stage_number}_completed")
+
+
+def _migration_005_promo_available_index(cursor):
+    """Частичный индекс по свободным промокодам для атомарной выдачи"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_promo_codes_available
+        ON promo_codes(promo_id)
+        WHERE status = 'active' AND sent_to_telegram_id IS NULL
+    ''')
+
+
+def _migration_006_raffle_unique(cursor):
+    """Уникальность участия в розыгрыше с учетом raffle_id = NULL.
+
+    UNIQUE(telegram_id, raffle_id) не срабатывает для NULL, поэтому
+    дубликаты удаляются (остается самая ранняя запись) и создается
+    уникальный индекс по (telegram_id, IFNULL(raffle_id, 0)) - цель для UPSERT.
+    """
+    cursor.execute('''
+        DELETE FROM raffle_participants
+        WHERE raffle_participant_id NOT IN (
+            SELECT MIN(raffle_participant_id) FROM raffle_participants
+            GROUP BY telegram_id, IFNULL(raffle_id, 0)
+        )
+    ''')
+    if cursor.rowcount > 0:
+        logging.warning(f"Удалено дубликатов участников розыгрыша: {cursor.rowcount}")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_raffle_participants_unique
+        ON raffle_participants(telegram_id, IFNULL(raffle_id, 0))
+    ''')
+
+
+def _migration_007_next_mail_due_at(cursor):
+    """Время следующей рассылки (epoch) в link_generation.
+
+    Заменяет вычисление datetime(mailing_date) в запросе получателей, которое
+    не использует индекс. 0 - письмо можно отправлять сразу (новые ссылки).
+    """
+    _add_column(cursor, 'link_generation', 'next_mail_due_at', 'INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        UPDATE link_generation
+        SET next_mail_due_at = CAST(strftime('%s', mailing_date) AS INTEGER) + 20 * 3600
+        WHERE mailing_date IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_link_generation_due
+        ON link_generation(status, next_mail_due_at)
+    ''')
+
+
+def _migration_008_sort_indexes(cursor):
+    """Индексы под сортировки и поиск без учета регистра.
+
+    Выгрузки промокодов, адресов и участников розыгрыша сортировали
+    результат во временном B-дереве, удаление промокода через UPPER()
+    проходило всю таблицу. Одноколоночные индексы, ставшие префиксами
+    новых составных, удаляются.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_status_created ON promo_codes(status, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_created ON promo_codes(created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_code_upper ON promo_codes(UPPER(promo_code))")
+    cursor.execute("DROP INDEX IF EXISTS idx_promo_codes_status")
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_addresses_stage_created ON user_addresses(stage, created_at DESC)")
+    cursor.execute("DROP INDEX IF EXISTS idx_user_addresses_stage")
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_raffle_participants_raffle_date
+        ON raffle_participants(raffle_id, participation_date)
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_raffle_participants_raffle")
+
+
+# Текст для поискового индекса: ё -> е, телефон целиком и последними 10 цифрами
+_SEARCH_NAME_SQL = "replace(replace(trim({p}.last_name || ' ' || {p}.first_name || ' ' || IFNULL({p}.middle_name, '')), 'ё', 'е'), 'Ё', 'Е')"
+_SEARCH_PHONE_SQL = "{p}.phone || ' ' || substr({p}.phone, -10)"
+
+
+def _migration_009_participant_search(cursor):
+    """Полнотекстовый поиск участников (FTS5) для команды /find.
+
+    rowid participant_search = manual_upload.participant_id. ФИО, email и
+    телефон берутся из manual_upload, telegram_username - из main; индекс
+    поддерживается триггерами на обеих таблицах.
+    """
+    name = _SEARCH_NAME_SQL.format(p='new')
+    phone = _SEARCH_PHONE_SQL.format(p='new')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS participant_search USING fts5(
+            full_name, email, phone, username,
+            tokenize = "unicode61 remove_diacritics 2"
+        )
+    ''')
+    # Ранжирование по умолчанию (ORDER BY rank): веса bm25 для ФИО, email, телефона, username
+    cursor.execute("INSERT INTO participant_search (participant_search, rank) VALUES ('rank', 'bm25(10.0, 3.0, 1.0, 5.0)')")
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_insert
+        AFTER INSERT ON manual_upload
+        BEGIN
+            INSERT INTO participant_search (rowid, full_name, email, phone, username)
+            VALUES (
+                new.participant_id, {name}, new.email, {phone},
+                (SELECT telegram_username FROM main WHERE participant_id = new.participant_id)
+            );
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_update
+        AFTER UPDATE OF participant_id, last_name, first_name, middle_name, email, phone ON manual_upload
+        BEGIN
+            DELETE FROM participant_search WHERE rowid = old.participant_id;
+            INSERT INTO participant_search (rowid, full_name, email, phone, username)
+            VALUES (
+                new.participant_id, {name}, new.email, {phone},
+                (SELECT telegram_username FROM main WHERE participant_id = new.participant_id)
+            );
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_delete
+        AFTER DELETE ON manual_upload
+        BEGIN
+            DELETE FROM participant_search WHERE rowid = old.participant_id;
+        END
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_main_insert
+        AFTER INSERT ON main
+        WHEN new.participant_id IS NOT NULL
+        BEGIN
+            UPDATE participant_search SET username = new.telegram_username
+            WHERE rowid = new.participant_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_main_update
+        AFTER UPDATE OF participant_id, telegram_username ON main
+        BEGIN
+            UPDATE participant_search SET username = NULL
+            WHERE rowid = old.participant_id AND old.participant_id IS NOT new.participant_id;
+            UPDATE participant_search SET username = new.telegram_username
+            WHERE rowid = new.participant_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_participant_search_main_delete
+        AFTER DELETE ON main
+        WHEN old.participant_id IS NOT NULL
+        BEGIN
+            UPDATE participant_search SET username = NULL
+            WHERE rowid = old.participant_id;
+        END
+    ''')
+
+    cursor.execute("DELETE FROM participant_search")
+    cursor.execute(f'''
+        INSERT INTO participant_search (rowid, full_name, email, phone, username)
+        SELECT mu.participant_id, {_SEARCH_NAME_SQL.format(p='mu')}, mu.email,
+               {_SEARCH_PHONE_SQL.format(p='mu')}, m.telegram_username
+        FROM manual_upload mu
+        LEFT JOIN main m ON m.participant_id = mu.participant_id
+    ''')
+    cursor.execute("INSERT INTO participant_search (participant_search) VALUES ('optimize')")
+
+
+# Отметка об изменении участника для инкрементального обновления analytics.py
+_ANALYTICS_CHANGE_SQL = '''
+            INSERT INTO analytics_changes (participant_id, seq)
+            {source}
+            ON CONFLICT(participant_id) DO UPDATE SET seq = excluded.seq;
+'''
+# Следующий номер изменения: записи в SQLite идут по одной, поэтому номера
+# растут в порядке фиксации транзакций (MAX по индексу idx_analytics_changes_seq)
+_ANALYTICS_SEQ_SQL = "(SELECT IFNULL(MAX(seq), 0) + 1 FROM analytics_changes)"
+
+
+def _migration_010_analytics_changes(cursor):
+    """Журнал изменений участников для колоночного снимка analytics.py.
+
+    Триггеры на main, link_generation, verification и изменения/удаления
+    manual_upload отмечают participant_id и возрастающий номер изменения;
+    новые строки manual_upload снимок находит сам по participant_id. Таблица
+    не растет больше числа участников: одна строка на участника.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_changes (
+            participant_id INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_analytics_changes_seq ON analytics_changes(seq)")
+
+    def mark(row: str) -> str:
+        return _ANALYTICS_CHANGE_SQL.format(
+            source=f"SELECT {row}.participant_id, {_ANALYTICS_SEQ_SQL} WHERE {row}.participant_id IS NOT NULL"
+        )
+
+    def mark_by_user(row: str) -> str:
+        return _ANALYTICS_CHANGE_SQL.format(
+            source=f"SELECT participant_id, {_ANALYTICS_SEQ_SQL} FROM main "
+                   f"WHERE user_id = {row}.user_id AND participant_id IS NOT NULL"
+        )
+
+    triggers = {
+        'trg_analytics_main_insert': f"AFTER INSERT ON main BEGIN {mark('new')} END",
+        'trg_analytics_main_update': (
+            "AFTER UPDATE OF participant_id, quest_started, stage_mask, registration_date ON main "
+            f"BEGIN {mark('old')} {mark('new')} END"
+        ),
+        'trg_analytics_main_delete': f"AFTER DELETE ON main BEGIN {mark('old')} END",
+        'trg_analytics_link_insert': f"AFTER INSERT ON link_generation BEGIN {mark('new')} END",
+        'trg_analytics_link_update': (
+            "AFTER UPDATE OF participant_id, status, mailing_date ON link_generation "
+            f"BEGIN {mark('old')} {mark('new')} END"
+        ),
+        'trg_analytics_link_delete': f"AFTER DELETE ON link_generation BEGIN {mark('old')} END",
+        'trg_analytics_verification_insert': f"AFTER INSERT ON verification BEGIN {mark_by_user('new')} END",
+        'trg_analytics_verification_update': f"AFTER UPDATE ON verification BEGIN {mark_by_user('old')} {mark_by_user('new')} END",
+        'trg_analytics_verification_delete': f"AFTER DELETE ON verification BEGIN {mark_by_user('old')} END",
+        'trg_analytics_upload_update': (
+            "AFTER UPDATE OF participant_id, stage_id, email ON manual_upload "
+            f"BEGIN {mark('old')} {mark('new')} END"
+        ),
+        'trg_analytics_upload_delete': f"AFTER DELETE ON manual_upload BEGIN {mark('old')} END",
+    }
+    for name, body in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+
+def _migration_011_fsm_storage(cursor):
+    """Состояния и данные FSM пользователей (fsm_storage.SQLiteStorage).
+
+    Одна строка на ключ хранилища: состояние, данные в компактном JSON и
+    время последнего изменения (epoch). Пустые записи удаляются, а не
+    хранятся с NULL.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_012_fsm_storage_state_index(cursor):
+    """Индекс (state, updated_at) для истечения состояний FSM (fsm_expiry.py).
+
+    Удаление устаревших строк одного состояния, загрузка недавних строк при
+    запуске и подсчет живых состояний идут по индексу, без прохода таблицы.
+    """
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_fsm_storage_state_updated
+        ON fsm_storage(state, updated_at)
+    ''')
+
+
+def _migration_013_manual_upload_created_at_fill(cursor):
+    """Заполнение manual_upload.created_at для новых и уже загруженных участников.
+
+    DEFAULT в ALTER TABLE недопустим (миграция 002), а пересоздание таблицы
+    держит блокировку на все время перезаписи. Поэтому время загрузки
+    ставит триггер после INSERT без created_at, а пустые значения уже
+    загруженных участников заполняются порциями по первичному ключу.
+    """
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_manual_upload_created_at
+        AFTER INSERT ON manual_upload
+        WHEN new.created_at IS NULL
+        BEGIN
+            UPDATE manual_upload SET created_at = CURRENT_TIMESTAMP
+            WHERE participant_id = new.participant_id;
+        END
+    ''')
+    while True:
+        cursor.execute('''
+            UPDATE manual_upload SET created_at = CURRENT_TIMESTAMP
+            WHERE participant_id IN (
+                SELECT participant_id FROM manual_upload
+                WHERE created_at IS NULL
+                LIMIT ?
+            )
+        ''', (MIGRATION_BATCH_SIZE,))
+        if cursor.rowcount < MIGRATION_BATCH_SIZE:
+            break
+
+
+# Список миграций: (версия, описание, функция). Новые миграции — только в конец.
+MIGRATIONS = [
+    (1, 'Базовая схема', _migration_001_baseline),
+    (2, 'manual_upload.created_at и индекс по ФИО', _migration_002_manual_upload_created_at),
+    (3, 'Удаление уникального автоиндекса manual_upload', _migration_003_drop_manual_upload_unique),
+    (4, 'Битовая маска этапов и таблица stage_progress', _migration_004_stage_progress),
+    (5, 'Частичный индекс свободных промокодов', _migration_005_promo_available_index),
+    (6, 'Уникальный индекс участников розыгрыша', _migration_006_raffle_unique),
+    (7, 'Колонка next_mail_due_at и индекс (status, next_mail_due_at)', _migration_007_next_mail_due_at),
+    (8, 'Индексы под сортировки выгрузок и поиск промокода без учета регистра', _migration_008_sort_indexes),
+    (9, 'Полнотекстовый поиск участников participant_search (FTS5)', _migration_009_participant_search),
+    (10, 'Журнал изменений участников analytics_changes для аналитики', _migration_010_analytics_changes),
+    (11, 'Таблица fsm_storage для состояний FSM', _migration_011_fsm_storage),
+    (12, 'Индекс fsm_storage (state, updated_at) для истечения состояний', _migration_012_fsm_storage_state_index),
+    (13, 'Триггер и заполнение manual_upload.created_at', _migration_013_manual_upload_created_at_fill),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn) -> int:
+    """Текущая версия схемы (0 - миграции не применялись)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn) -> int:
+    """Применение недостающих миграций, возвращает итоговую версию схемы"""
+    version = get_schema_version(conn)
+    conn.commit()
+    if version >= LATEST_VERSION:
+        logging.info(f"Схема базы данных актуальна (версия {version})")
+        return version
+
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Повторная проверка под блокировкой: другой процесс мог успеть раньше
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (number, description)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.error(f"Ошибка миграции {number} ({description}): {e}")
+            raise
+        logging.info(f"Применена миграция {number}: {description}")
+        version = number
+
+    return version
@@ -116,25 +116,14 @@ class PromoCodeManager:
         try:
             logging.info(f"🔍 Поиск промокода для пользователя {telegram_id} (@{username})")
             
-            # Получаем доступный промокод
-            promo_code = self.db.get_available_promo_code()
-            
-            logging.info(f"📊 Результат get_available_promo_code(): {promo_code}")
-            
-            if not promo_code:
-                logging.warning("❌ Нет доступных промокодов")
-                return None
-            
-            # Отмечаем промокод как использованный
-            success = self.db.mark_promo_code_as_used(promo_code, telegram_id, username)
-            
-            logging.info(f"📊 Результат mark_promo_code_as_used(): {success}")
+            # Выбираем и отмечаем промокод одним атомарным запросом
+            promo_code = self.db.claim_promo_code(telegram_id, username)
             
-            if success:
+            if promo_code:
                 logging.info(f"✅ Промокод {promo_code} назначен пользователю {telegram_id}")
                 return promo_code
             else:
-                logging.error(f"❌ Не удалось назначить промокод {promo_code}")
+                logging.warning("❌ Нет доступных промокодов")
                 return None
                 
         except Exception as e:
@@ -263,18 +252,17 @@ class PromoCodeManager:
             return "❌ Ошибка получения списка"
     
     def export_promo_codes_to_file(self, output_path: str, status: str = None) -> bool:
-        """Экспорт промокодов в файл"""
+        """Экспорт промокодов в файл (строки пишутся из курсора порциями)"""
         try:
-            csv_data = self.db.export_promo_codes_to_csv(status)
+            with open(output_path, 'w', encoding='utf-8', newline='') as f:
+                count = self.db.write_promo_codes_csv(f, status)
             
-            if csv_data.startswith("Ошибка"):
-                logging.error(f"Ошибка экспорта: {csv_data}")
+            if count < 0:
+                logging.error(f"Ошибка экспорта промокодов в {output_path}")
+                os.remove(output_path)
                 return False
             
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(csv_data)
-            
-            logging.info(f"Промокоды экспортированы в {output_path}")
+            logging.info(f"Промокоды экспортированы в {output_path}: {count}")
             return True
             
         except Exception as e:
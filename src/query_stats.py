@@ -0,0 +1,308 @@
+# src/query_stats.py
+"""
+Статистика выполнения SQL по нормализованному тексту запроса.
+
+Соединения пула и писателя открываются с factory=TimedConnection, поэтому
+каждый execute/executemany и последующие fetch* учитываются: число вызовов,
+суммарное и максимальное время, строки (возвращенные SELECT или измененные
+INSERT/UPDATE/DELETE). Литералы и списки IN (?, ?, ...) в тексте заменяются
+на ?, чтобы один и тот же запрос с разными значениями попадал в одну запись.
+
+Запрос, время которого (execute плюс чтение результата) превысило порог,
+пишется в лог bot.slow_queries вместе с вызывающим кодом: обработчиком,
+из которого пришел вызов через adb, и методом Database.
+
+    from query_stats import query_stats
+    query_stats.top(10)                # самые затратные запросы
+    query_stats.export_prometheus()    # метрики в текстовом формате Prometheus
+"""
+import contextvars
+import functools
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+SLOW_QUERY_THRESHOLD_MS = 200
+# Сколько последних медленных запросов хранить в памяти
+SLOW_QUERY_HISTORY = 100
+# Ограничение числа различных запросов, остальные учитываются одной записью
+MAX_STATEMENTS = 1000
+OTHER_STATEMENTS = '<прочие запросы>'
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+_SKIPPED_FILES_SELF = os.path.abspath(__file__)
+_SKIPPED_FILES = {_SKIPPED_FILES_SELF, os.path.join(SRC_DIR, 'database.py')}
+
+slow_logger = logging.getLogger('bot.slow_queries')
+
+# Код обработчика, из которого вызван метод через adb (объект code, имя
+# вычисляется только для медленных запросов)
+current_caller = contextvars.ContextVar('db_caller', default=None)
+
+_COMMENT = re.compile(r'--[^\n]*')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql: str) -> str:
+    """Текст запроса без комментариев, литералов и лишних пробелов"""
+    sql = _COMMENT.sub(' ', sql)
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (?)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+@functools.lru_cache(maxsize=1024)
+def code_name(code) -> str:
+    """'handlers/menu.py:handle_raffle' для объекта code"""
+    filename = os.path.abspath(code.co_filename)
+    if filename.startswith(SRC_DIR + os.sep):
+        filename = os.path.relpath(filename, SRC_DIR).replace(os.sep, '/')
+    else:
+        filename = os.path.basename(filename)
+    # Вложенные _write/_load показываем как метод, в котором они объявлены
+    qualname = code.co_qualname.split('.<locals>.', 1)[0]
+    return f"{filename}:{qualname}"
+
+
+def find_caller() -> str:
+    """Вызывающий код: обработчик и метод Database, через который идет запрос"""
+    method = None
+    source = None
+    # Служебные запросы (BEGIN, COMMIT, PRAGMA) показываем по месту вызова
+    nearest = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename not in _SKIPPED_FILES and filename.startswith(SRC_DIR + os.sep):
+            source = frame.f_code
+            break
+        if nearest is None and filename != _SKIPPED_FILES_SELF:
+            nearest = frame.f_code
+        if method is None and frame.f_code.co_qualname.startswith('Database.'):
+            method = frame.f_code
+        frame = frame.f_back
+
+    if source is None:
+        source = current_caller.get()
+    if source is None and method is None:
+        method = nearest
+    parts = [code_name(code) for code in (source, method) if code is not None]
+    return ' -> '.join(parts) or 'неизвестно'
+
+
+class _Entry:
+    """Накопленная статистика одного запроса"""
+    __slots__ = ('calls', 'total', 'max', 'rows', 'slow')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+
+
+class QueryStats:
+    """Статистика запросов и журнал медленных запросов (потокобезопасно)"""
+
+    def __init__(self, slow_threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+                 history: int = SLOW_QUERY_HISTORY, max_statements: int = MAX_STATEMENTS):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.max_statements = max_statements
+        self.started_at = time.time()
+        self._entries = {}
+        self._slow = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def entry(self, sql: str) -> _Entry:
+        """Запись статистики для текста запроса"""
+        key = normalize_sql(sql)
+        entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    if len(self._entries) >= self.max_statements:
+                        key = OTHER_STATEMENTS
+                    entry = self._entries.setdefault(key, _Entry())
+        return entry
+
+    def record(self, entry: _Entry, elapsed: float, rows: int, call_elapsed: float, new_call: bool = False):
+        """Учет выполнения или очередной порции чтения результата"""
+        with self._lock:
+            if new_call:
+                entry.calls += 1
+            entry.total += elapsed
+            entry.rows += rows
+            if call_elapsed > entry.max:
+                entry.max = call_elapsed
+
+    def slow_query(self, entry: _Entry, sql: str, call_elapsed: float, rows: int):
+        """Запись медленного запроса в журнал"""
+        caller = find_caller()
+        text = normalize_sql(sql)
+        with self._lock:
+            entry.slow += 1
+            self._slow.append({
+                'at': datetime.now().isoformat(timespec='seconds'),
+                'ms': call_elapsed * 1000,
+                'rows': rows,
+                'caller': caller,
+                'sql': text
+            })
+        slow_logger.warning(f"Медленный запрос {call_elapsed * 1000:.1f} мс, строк {rows}, {caller}: {text}")
+
+    # ---------- Отчеты ----------
+
+    def snapshot(self) -> list:
+        """Статистика всех запросов, от самых затратных по суммарному времени"""
+        with self._lock:
+            items = [
+                {
+                    'sql': sql,
+                    'calls': entry.calls,
+                    'total_ms': entry.total * 1000,
+                    'avg_ms': entry.total * 1000 / entry.calls if entry.calls else 0.0,
+                    'max_ms': entry.max * 1000,
+                    'rows': entry.rows,
+                    'slow': entry.slow
+                }
+                for sql, entry in self._entries.items()
+            ]
+        items.sort(key=lambda item: item['total_ms'], reverse=True)
+        return items
+
+    def top(self, limit: int = 10, key: str = 'total_ms') -> list:
+        """Первые limit запросов по key (total_ms, max_ms, calls, rows)"""
+        return sorted(self.snapshot(), key=lambda item: item[key], reverse=True)[:limit]
+
+    def slow_queries(self, limit: int = None) -> list:
+        """Последние медленные запросы, от новых к старым"""
+        with self._lock:
+            items = list(reversed(self._slow))
+        return items[:limit] if limit else items
+
+    def reset(self):
+        """Сброс статистики и журнала"""
+        with self._lock:
+            self._entries.clear()
+            self._slow.clear()
+            self.started_at = time.time()
+
+    def export_prometheus(self, prefix: str = 'runner_sql') -> str:
+        """Метрики в текстовом формате Prometheus"""
+        metrics = (
+            ('calls_total', 'counter', 'Число выполнений запроса', 'calls', 1),
+            ('duration_seconds_total', 'counter', 'Суммарное время выполнения', 'total_ms', 0.001),
+            ('duration_seconds_max', 'gauge', 'Максимальное время одного выполнения', 'max_ms', 0.001),
+            ('rows_total', 'counter', 'Строк возвращено или изменено', 'rows', 1),
+            ('slow_total', 'counter', 'Выполнений дольше порога', 'slow', 1),
+        )
+        items = self.snapshot()
+        lines = []
+        for name, kind, description, field, scale in metrics:
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for item in items:
+                statement = item['sql'].replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+                lines.append(f'{prefix}_{name}{{statement="{statement}"}} {item[field] * scale:g}')
+        lines.append(f"# HELP {prefix}_slow_threshold_seconds Порог медленного запроса")
+        lines.append(f"# TYPE {prefix}_slow_threshold_seconds gauge")
+        lines.append(f"{prefix}_slow_threshold_seconds {self.slow_threshold:g}")
+        return '\n'.join(lines) + '\n'
+
+
+# Общая статистика всех соединений процесса
+query_stats = QueryStats()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, учитывающий время execute и чтения результата"""
+    __slots__ = ('_sql', '_entry', '_call_elapsed', '_call_rows', '_slow_logged')
+
+    def _timed(self, method, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._sql = sql
+            self._entry = query_stats.entry(sql)
+            self._call_elapsed = elapsed
+            self._call_rows = max(self.rowcount, 0)
+            self._slow_logged = False
+            query_stats.record(self._entry, elapsed, self._call_rows, elapsed, new_call=True)
+            self._check_slow()
+
+    def _check_slow(self):
+        if not self._slow_logged and self._call_elapsed >= query_stats.slow_threshold:
+            self._slow_logged = True
+            query_stats.slow_query(self._entry, self._sql, self._call_elapsed, self._call_rows)
+
+    def _fetched(self, started: float, rows: int):
+        entry = getattr(self, '_entry', None)
+        if entry is None:
+            return
+        elapsed = time.perf_counter() - started
+        self._call_elapsed += elapsed
+        self._call_rows += rows
+        query_stats.record(entry, elapsed, rows, self._call_elapsed)
+        self._check_slow()
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(started, 0)
+            raise
+        self._fetched(started, 1)
+        return row
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все курсоры которого учитываются в query_stats"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,242 @@
+# src/retention.py
+"""
+Перенос холодных строк user_data и verification в архивные таблицы.
+
+Горячие пути читают только последнюю запись user_data пользователя
+(update_last_user_answer), а новая запись добавляется на каждый скриншот.
+В архив уходят:
+  - записи user_data, у пользователя которых есть более новая запись;
+  - записи user_data, созданные до начала текущего мероприятия;
+  - записи verification с датой пробежки до начала мероприятия.
+
+Архив лежит в той же базе (user_data_archive, verification_archive) или в
+отдельном файле, который подключается через ATTACH. Перенос идет порциями:
+каждая порция - отдельная короткая транзакция (копия в архив и удаление),
+между порциями писатель успевает выполнить накопившиеся записи. Освободившиеся
+страницы возвращает incremental_vacuum в maintenance.py.
+
+С отдельным файлом архива в режиме WAL транзакция атомарна в пределах
+каждого файла; копирование идет через INSERT OR IGNORE/REPLACE, поэтому
+повторный проход после сбоя не создает дублей.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+RETENTION_BATCH_SIZE = 5000
+RETENTION_BATCH_PAUSE = 0.05  # секунды между порциями
+BUSY_TIMEOUT_MS = 5000
+
+
+def parse_event_start(value: str) -> Optional[datetime]:
+    """'2026-05-01' или '2026-05-01 10:00' -> datetime, пустая строка -> None"""
+    value = (value or '').strip()
+    return datetime.fromisoformat(value) if value else None
+
+
+class DataRetention:
+    """Архивирование устаревших строк user_data и verification"""
+
+    def __init__(self, db_path: str, archive_path: str = None, event_started_at: datetime = None,
+                 batch_size: int = RETENTION_BATCH_SIZE, pause: float = RETENTION_BATCH_PAUSE):
+        self.db_path = db_path
+        self.archive_path = archive_path or None
+        self.event_started_at = event_started_at
+        self.batch_size = batch_size
+        self.pause = pause
+        self.last_run = None
+        self._lock = threading.Lock()
+
+    @property
+    def schema(self) -> str:
+        """Схема архивных таблиц: отдельный файл или основная база"""
+        return 'archive' if self.archive_path else 'main'
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        return conn
+
+    def ensure_archive_tables(self, conn: sqlite3.Connection):
+        """Создание архивных таблиц, если их еще нет"""
+        schema = self.schema
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {schema}.user_data_archive (
+                data_id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                quest_started INTEGER,
+                image_url TEXT,
+                answer_text TEXT,
+                created_at DATETIME,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_user_data_archive_user ON user_data_archive(user_id)")
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {schema}.verification_archive (
+                user_id INTEGER NOT NULL,
+                distance INTEGER NOT NULL,
+                run_date DATE NOT NULL,
+                answer_check INTEGER,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, run_date)
+            )
+        ''')
+
+    # ---------- Перенос ----------
+
+    def _move_batch(self, conn: sqlite3.Connection, select_sql: str, params: tuple,
+                    copy_sql: str, delete_sql: str) -> tuple:
+        """Одна порция: (перенесено строк, последний ключ порции)"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM temp.retention_batch")
+            conn.execute(f"INSERT INTO temp.retention_batch (id) {select_sql}", params)
+            last_id = conn.execute("SELECT MAX(id) FROM temp.retention_batch").fetchone()[0]
+            if last_id is None:
+                conn.execute("COMMIT")
+                return 0, None
+            conn.execute(copy_sql)
+            moved = conn.execute(delete_sql).rowcount
+            conn.execute("COMMIT")
+            return moved, last_id
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _archive_user_data(self, conn: sqlite3.Connection) -> int:
+        """Перенос замененных и старых записей user_data"""
+        conditions = [
+            "EXISTS (SELECT 1 FROM user_data newer WHERE newer.user_id = u.user_id AND newer.data_id > u.data_id)"
+        ]
+        params = []
+        if self.event_started_at is not None:
+            conditions.append("u.created_at < ?")
+            params.append(self.event_started_at.strftime('%Y-%m-%d %H:%M:%S'))
+
+        # Проход по data_id с продолжением от последнего ключа, без повторного чтения начала таблицы
+        select_sql = f'''
+            SELECT u.data_id FROM user_data u
+            WHERE u.data_id > ? AND ({' OR '.join(conditions)})
+            ORDER BY u.data_id LIMIT ?
+        '''
+        copy_sql = f'''
+            INSERT OR IGNORE INTO {self.schema}.user_data_archive
+                (data_id, user_id, quest_started, image_url, answer_text, created_at)
+            SELECT data_id, user_id, quest_started, image_url, answer_text, created_at
+            FROM user_data WHERE data_id IN (SELECT id FROM temp.retention_batch)
+        '''
+        delete_sql = "DELETE FROM user_data WHERE data_id IN (SELECT id FROM temp.retention_batch)"
+
+        total = 0
+        last_id = 0
+        while True:
+            moved, batch_last = self._move_batch(
+                conn, select_sql, (last_id, *params, self.batch_size), copy_sql, delete_sql
+            )
+            if batch_last is None:
+                return total
+            total += moved
+            last_id = batch_last
+            time.sleep(self.pause)
+
+    def _archive_verification(self, conn: sqlite3.Connection) -> int:
+        """Перенос результатов пробежек до начала мероприятия"""
+        if self.event_started_at is None:
+            return 0
+
+        select_sql = '''
+            SELECT user_id FROM verification
+            WHERE user_id > ? AND run_date < ?
+            ORDER BY user_id LIMIT ?
+        '''
+        copy_sql = f'''
+            INSERT OR REPLACE INTO {self.schema}.verification_archive
+                (user_id, distance, run_date, answer_check)
+            SELECT user_id, distance, run_date, answer_check
+            FROM verification WHERE user_id IN (SELECT id FROM temp.retention_batch)
+        '''
+        delete_sql = "DELETE FROM verification WHERE user_id IN (SELECT id FROM temp.retention_batch)"
+        event_date = self.event_started_at.date().isoformat()
+
+        total = 0
+        last_id = 0
+        while True:
+            moved, batch_last = self._move_batch(
+                conn, select_sql, (last_id, event_date, self.batch_size), copy_sql, delete_sql
+            )
+            if batch_last is None:
+                return total
+            total += moved
+            last_id = batch_last
+            time.sleep(self.pause)
+
+    def compact(self) -> Optional[dict]:
+        """Перенос холодных строк в архив, None - перенос уже выполняется"""
+        if not self._lock.acquire(blocking=False):
+            logging.info("Перенос в архив уже выполняется")
+            return None
+
+        started = time.monotonic()
+        result = {'user_data': 0, 'verification': 0}
+        try:
+            conn = self._connect()
+            try:
+                self.ensure_archive_tables(conn)
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS retention_batch (id INTEGER PRIMARY KEY)")
+                result['user_data'] = self._archive_user_data(conn)
+                result['verification'] = self._archive_verification(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка переноса данных в архив: {e}")
+            result['error'] = str(e)
+        finally:
+            self._lock.release()
+
+        result['seconds'] = time.monotonic() - started
+        result['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        self.last_run = result
+        logging.info(
+            f"Перенос в архив за {result['seconds']:.2f} с: "
+            f"user_data {result['user_data']}, verification {result['verification']}"
+        )
+        return result
+
+    # ---------- Состояние ----------
+
+    def stats(self) -> dict:
+        """Число строк в рабочих и архивных таблицах"""
+        result = {
+            'archive_path': self.archive_path,
+            'event_started_at': self.event_started_at,
+            'last_run': self.last_run
+        }
+        try:
+            conn = self._connect()
+            try:
+                self.ensure_archive_tables(conn)
+                for table in ('user_data', 'verification'):
+                    result[table] = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+                    result[f"{table}_archive"] = conn.execute(
+                        f"SELECT COUNT(*) FROM {self.schema}.{table}_archive"
+                    ).fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка получения статистики архива: {e}")
+            result['error'] = str(e)
+
+        if self.archive_path:
+            try:
+                result['archive_bytes'] = os.path.getsize(self.archive_path)
+            except OSError:
+                result['archive_bytes'] = 0
+        return result
@@ -0,0 +1,224 @@
+# src/sharding.py
+"""
+Разбиение пользовательских таблиц на несколько файлов SQLite по telegram_id.
+
+В режиме шардирования таблицы одного пользователя (main, user_data,
+verification, user_addresses, raffle_participants, stage_progress) живут
+в файле шарда runners.shard{N}.db, общие таблицы (stages, manual_upload,
+link_generation, promo_codes, stage_content, ...) остаются в основном файле.
+У каждого шарда свой писатель, поэтому записи разных пользователей не ждут
+друг друга.
+
+Шард пользователя - crc32(telegram_id) % число шардов. user_id выдается
+в диапазоне шарда (SHARD_USER_ID_RANGE на шард), поэтому шард записей
+user_data и verification определяется по самому user_id.
+
+Соединения:
+  - соединение шарда подключает основной файл как shared: запросы с JOIN
+    к manual_upload и link_generation работают без изменений;
+  - соединение основной базы подключает шарды как shard0, shard1, ... и
+    видит пользовательские таблицы через временные представления UNION ALL
+    (только чтение), поэтому отчеты и старый код с SQL по main читают
+    всех пользователей сразу.
+
+Схема пользовательских таблиц в шардах повторяет основной файл: при
+запуске недостающие таблицы, колонки, индексы и триггеры создаются по
+sqlite_master основной базы. Триггеры полнотекстового поиска пишут в общий
+индекс participant_search и создаются во временной схеме каждого соединения
+шарда (постоянный триггер не может ссылаться на другой файл).
+"""
+import logging
+import os
+import re
+import sqlite3
+import zlib
+
+# Таблицы пользователя, которые переезжают в шарды
+SHARDED_TABLES = ('main', 'user_data', 'verification', 'user_addresses', 'raffle_participants', 'stage_progress')
+# Служебные таблицы, которые есть в каждом файле отдельно (журнал изменений для analytics.py)
+SHARD_LOCAL_TABLES = ('analytics_changes',)
+# Триггеры пользовательских таблиц, которые пишут в общий файл
+SHARED_TRIGGER_PREFIX = 'trg_participant_search_'
+
+# Диапазон user_id одного шарда: шард N выдает user_id от N * SHARD_USER_ID_RANGE
+SHARD_USER_ID_RANGE = 10 ** 12
+# Основной файл подключает все шарды (ограничение SQLite - 10 подключенных баз)
+MAX_SHARDS = 8
+
+_CREATE_TRIGGER = re.compile(r'^\s*CREATE\s+TRIGGER\s+(IF\s+NOT\s+EXISTS\s+)?', re.IGNORECASE)
+
+
+def shard_path(path: str, index: int) -> str:
+    """'runners.db' -> 'runners.shard0.db'"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def shard_for_telegram_id(telegram_id: int, count: int) -> int:
+    """Номер шарда пользователя (стабилен между запусками)"""
+    if telegram_id is None:
+        return 0
+    return zlib.crc32(int(telegram_id).to_bytes(8, 'little', signed=True)) % count
+
+
+def shard_for_user_id(user_id: int) -> int:
+    """Номер шарда по user_id из диапазона шарда"""
+    return int(user_id) // SHARD_USER_ID_RANGE
+
+
+def _table_columns(conn: sqlite3.Connection, schema: str, table: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _schema_objects(conn: sqlite3.Connection, schema: str, kind: str, tables: tuple) -> list:
+    placeholders = ','.join('?' * len(tables))
+    return conn.execute(
+        f"SELECT name, sql FROM {schema}.sqlite_master "
+        f"WHERE type = ? AND tbl_name IN ({placeholders}) AND sql IS NOT NULL ORDER BY rowid",
+        (kind, *tables)
+    ).fetchall()
+
+
+def sync_shard_schema(conn: sqlite3.Connection, index: int):
+    """Создание в шарде недостающих таблиц, колонок, индексов и триггеров по основному файлу.
+
+    conn - соединение шарда с подключенным основным файлом (shared).
+    """
+    tables = SHARDED_TABLES + SHARD_LOCAL_TABLES
+    existing = {
+        (kind, name) for kind, name in conn.execute("SELECT type, name FROM main.sqlite_master")
+    }
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for name, sql in _schema_objects(conn, 'shared', 'table', tables):
+            if ('table', name) not in existing:
+                conn.execute(sql)
+                continue
+            # Колонки, добавленные миграциями после создания шарда
+            shard_columns = set(_table_columns(conn, 'main', name))
+            for _, column, column_type, _, default, _ in conn.execute(f"PRAGMA shared.table_info({name})"):
+                if column not in shard_columns:
+                    default_sql = f" DEFAULT {default}" if default is not None else ""
+                    conn.execute(f"ALTER TABLE main.{name} ADD COLUMN {column} {column_type}{default_sql}")
+
+        for kind in ('index', 'trigger'):
+            for name, sql in _schema_objects(conn, 'shared', kind, tables):
+                if kind == 'trigger' and name.startswith(SHARED_TRIGGER_PREFIX):
+                    continue
+                if (kind, name) not in existing:
+                    conn.execute(sql)
+
+        # user_id нового пользователя - из диапазона шарда
+        first_user_id = index * SHARD_USER_ID_RANGE
+        conn.execute('''
+            INSERT INTO main.sqlite_sequence (name, seq)
+            SELECT 'main', ? WHERE NOT EXISTS (SELECT 1 FROM main.sqlite_sequence WHERE name = 'main')
+        ''', (first_user_id,))
+        conn.execute("UPDATE main.sqlite_sequence SET seq = ? WHERE name = 'main' AND seq < ?",
+                     (first_user_id, first_user_id))
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def attach_shared(conn: sqlite3.Connection, global_path: str):
+    """Подключение основного файла к соединению шарда и триггеров общего индекса поиска"""
+    conn.execute("ATTACH DATABASE ? AS shared", (global_path,))
+    for name, sql in _schema_objects(conn, 'shared', 'trigger', SHARDED_TABLES):
+        if name.startswith(SHARED_TRIGGER_PREFIX):
+            conn.execute(_CREATE_TRIGGER.sub('CREATE TEMP TRIGGER IF NOT EXISTS ', sql, count=1))
+
+
+def attach_shards(conn: sqlite3.Connection, paths: list):
+    """Подключение шардов к соединению основной базы и представлений UNION ALL над ними.
+
+    Временные представления перекрывают пустые пользовательские таблицы
+    основного файла: имя без схемы SQLite ищет сначала в temp.
+    """
+    for index, path in enumerate(paths):
+        conn.execute("ATTACH DATABASE ? AS ?", (path, f"shard{index}"))
+    for table in SHARDED_TABLES:
+        columns = ', '.join(_table_columns(conn, 'main', table))
+        union = ' UNION ALL '.join(
+            f"SELECT {columns} FROM shard{index}.{table}" for index in range(len(paths))
+        )
+        conn.execute(f"CREATE TEMP VIEW IF NOT EXISTS {table} AS {union}")
+
+
+def distribute_rows(global_path: str, paths: list) -> dict:
+    """Перенос пользователей из основного файла в шарды (при включении шардирования).
+
+    Копирование и удаление - две транзакции: если процесс прервется между
+    ними, повторный запуск скопирует строки еще раз (INSERT OR IGNORE) и
+    удалит их из основного файла. user_id переносимых пользователей
+    сдвигается в диапазон их шарда. Возвращает {таблица: перенесено строк}.
+    """
+    count = len(paths)
+    conn = sqlite3.connect(global_path, isolation_level=None)
+    try:
+        conn.create_function(
+            'shard_of', 1, lambda telegram_id: shard_for_telegram_id(telegram_id, count), deterministic=True
+        )
+        if not any(conn.execute(f"SELECT EXISTS (SELECT 1 FROM main.{table})").fetchone()[0]
+                   for table in SHARDED_TABLES):
+            return {}
+        for index, path in enumerate(paths):
+            conn.execute("ATTACH DATABASE ? AS ?", (path, f"shard{index}"))
+
+        # Шард строки по user_id: шард владельца, сироты - в шард 0
+        user_shard = "IFNULL((SELECT shard_of(m.telegram_id) FROM main.main m WHERE m.user_id = t.user_id), 0)"
+        moved = {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in SHARDED_TABLES:
+                columns = _table_columns(conn, 'main', table)
+                if table == 'main':
+                    shard_sql = "shard_of(t.telegram_id)"
+                elif 'user_id' in columns:
+                    shard_sql = user_shard
+                else:
+                    shard_sql = "shard_of(t.telegram_id)"
+                values = ', '.join(
+                    f"t.user_id + ? * {SHARD_USER_ID_RANGE}" if column == 'user_id' else f"t.{column}"
+                    for column in columns
+                )
+                moved[table] = 0
+                for index in range(count):
+                    params = (index, index) if 'user_id' in columns else (index,)
+                    moved[table] += conn.execute(
+                        f"INSERT OR IGNORE INTO shard{index}.{table} ({', '.join(columns)}) "
+                        f"SELECT {values} FROM main.{table} t WHERE {shard_sql} = ?",
+                        params
+                    ).rowcount
+            # sqlite_sequence шардов AUTOINCREMENT поднимает сам по вставленным user_id
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Сначала строки, которые ссылаются на main по user_id
+            for table in reversed(SHARDED_TABLES):
+                conn.execute(f"DELETE FROM main.{table}")
+            # Триггер удаления из main очистил username в индексе поиска - восстанавливаем
+            for index in range(count):
+                conn.execute(f'''
+                    UPDATE participant_search
+                    SET username = (
+                        SELECT telegram_username FROM shard{index}.main m
+                        WHERE m.participant_id = participant_search.rowid
+                    )
+                    WHERE rowid IN (SELECT participant_id FROM shard{index}.main WHERE participant_id IS NOT NULL)
+                ''')
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+        logging.info(f"Пользователи перенесены в шарды: {moved}")
+        return moved
+    finally:
+        conn.close()
@@ -0,0 +1,239 @@
+# src/snapshots.py
+"""
+Снимки базы через sqlite3 backup API: реплика для отчетов и резервные копии.
+
+Копирование идет небольшими порциями страниц с паузами. В режиме WAL
+чтение не блокирует писателя, но запись из другого соединения заставляет
+backup начинать заново; если перезапусков слишком много, копия снимается
+за один шаг (это по-прежнему только блокировка чтения).
+
+Реплика обновляется по таймеру и подменяется атомарно (os.replace), поэтому
+открытые на ней отчеты дочитывают старую версию. Отчеты и выгрузки берут
+соединение через Database.get_report_connection(): реплика используется,
+пока она не старше допустимого, иначе запрос идет в основную базу.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+# Страниц за шаг backup и пауза между шагами
+SNAPSHOT_PAGES_PER_STEP = 256
+SNAPSHOT_STEP_PAUSE = 0.005
+# Сколько раз копирование может начаться заново из-за записей
+SNAPSHOT_MAX_RESTARTS = 3
+
+REPLICA_REFRESH_MINUTES = 5
+REPLICA_MAX_STALENESS_MINUTES = 15
+BACKUP_INTERVAL_HOURS = 6
+BACKUP_KEEP = 7
+
+
+class _BackupRestarted(Exception):
+    """Копирование слишком часто начинается заново"""
+
+
+def _file_uri(path: str, **params) -> str:
+    query = '&'.join(f"{key}={value}" for key, value in params.items())
+    return f"{Path(path).resolve().as_uri()}?{query}"
+
+
+def backup_database(source_path: str, target_path: str,
+                    pages: int = SNAPSHOT_PAGES_PER_STEP,
+                    pause: float = SNAPSHOT_STEP_PAUSE,
+                    max_restarts: int = SNAPSHOT_MAX_RESTARTS) -> float:
+    """Согласованная копия базы в target_path, возвращает длительность в секундах.
+
+    Копия пишется во временный файл и переводится в journal_mode=DELETE,
+    чтобы ее можно было открыть только для чтения без -wal/-shm.
+    """
+    started = time.monotonic()
+    tmp_path = f"{target_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    source = sqlite3.connect(_file_uri(source_path, mode='ro'), uri=True)
+    target = sqlite3.connect(tmp_path)
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise _BackupRestarted()
+        state['remaining'] = remaining
+
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=pause)
+        except _BackupRestarted:
+            logging.info(f"Копирование {source_path} перезапускалось {state['restarts']} раз, копируем за один шаг")
+            source.backup(target)
+        target.execute("PRAGMA journal_mode=DELETE")
+        target.commit()
+    finally:
+        target.close()
+        source.close()
+
+    os.replace(tmp_path, target_path)
+    return time.monotonic() - started
+
+
+class DatabaseSnapshotter:
+    """Фоновое обновление реплики для отчетов и ротация резервных копий"""
+
+    def __init__(self, db_path: str, replica_path: str, backup_dir: str = None,
+                 refresh_minutes: float = REPLICA_REFRESH_MINUTES,
+                 max_staleness_minutes: float = REPLICA_MAX_STALENESS_MINUTES,
+                 backup_interval_hours: float = BACKUP_INTERVAL_HOURS,
+                 backup_keep: int = BACKUP_KEEP):
+        self.db_path = db_path
+        self.replica_path = replica_path
+        self.backup_dir = backup_dir
+        self.refresh_interval = refresh_minutes * 60
+        self.max_staleness = max_staleness_minutes * 60
+        self.backup_interval = backup_interval_hours * 3600
+        self.backup_keep = backup_keep
+        self.last_refresh_seconds = None
+        self.last_backup_path = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+
+    # ---------- Реплика ----------
+
+    def refresh_replica(self) -> bool:
+        """Снятие свежей реплики"""
+        try:
+            self.last_refresh_seconds = backup_database(self.db_path, self.replica_path)
+            logging.info(f"Реплика {self.replica_path} обновлена за {self.last_refresh_seconds:.2f} с")
+            return True
+        except (sqlite3.Error, OSError) as e:
+            logging.error(f"Ошибка обновления реплики: {e}")
+            return False
+
+    def replica_age(self) -> Optional[float]:
+        """Возраст реплики в секундах (None - реплики нет)"""
+        try:
+            return max(0.0, time.time() - os.path.getmtime(self.replica_path))
+        except OSError:
+            return None
+
+    def replica_uri(self, max_staleness: float = None) -> Optional[str]:
+        """URI реплики только для чтения или None, если она устарела"""
+        age = self.replica_age()
+        limit = self.max_staleness if max_staleness is None else max_staleness
+        if age is None or age > limit:
+            return None
+        # Файл реплики не меняется на месте, только подменяется целиком
+        return _file_uri(self.replica_path, mode='ro', immutable=1)
+
+    def connect_replica(self, max_staleness: float = None) -> Optional[sqlite3.Connection]:
+        """Соединение только для чтения с репликой или None, если она устарела"""
+        uri = self.replica_uri(max_staleness)
+        if uri is None:
+            return None
+        try:
+            return sqlite3.connect(uri, uri=True)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка открытия реплики: {e}")
+            return None
+
+    # ---------- Резервные копии ----------
+
+    def list_backups(self) -> list:
+        """Резервные копии от новых к старым"""
+        if not self.backup_dir or not os.path.isdir(self.backup_dir):
+            return []
+        prefix = f"{Path(self.db_path).stem}_"
+        names = [
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith(prefix) and name.endswith('.db')
+        ]
+        return [os.path.join(self.backup_dir, name) for name in sorted(names, reverse=True)]
+
+    def create_backup(self) -> Optional[str]:
+        """Резервная копия с удалением старых сверх backup_keep"""
+        if not self.backup_dir:
+            return None
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            path = os.path.join(self.backup_dir, f"{Path(self.db_path).stem}_{timestamp}.db")
+            duration = backup_database(self.db_path, path)
+            self.last_backup_path = path
+            logging.info(f"Резервная копия {path} создана за {duration:.2f} с")
+        except (sqlite3.Error, OSError) as e:
+            logging.error(f"Ошибка создания резервной копии: {e}")
+            return None
+
+        for old_path in self.list_backups()[self.backup_keep:]:
+            try:
+                os.remove(old_path)
+                logging.info(f"Удалена старая резервная копия {old_path}")
+            except OSError as e:
+                logging.error(f"Ошибка удаления резервной копии {old_path}: {e}")
+        return path
+
+    def _backup_due(self) -> bool:
+        if not self.backup_dir:
+            return False
+        backups = self.list_backups()
+        if not backups:
+            return True
+        try:
+            return time.time() - os.path.getmtime(backups[0]) >= self.backup_interval
+        except OSError:
+            return True
+
+    # ---------- Планировщик ----------
+
+    async def start_scheduler(self):
+        """Цикл обновления реплики и резервных копий"""
+        logging.info(f"⏰ Снимки базы: реплика каждые {self.refresh_interval / 60:g} минут")
+        while not self._stop_event.is_set():
+            try:
+                await asyncio.to_thread(self.refresh_replica)
+                if self._backup_due():
+                    await asyncio.to_thread(self.create_backup)
+            except Exception as e:
+                logging.error(f"❌ Ошибка в планировщике снимков базы: {e}")
+
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.refresh_interval)
+            except asyncio.TimeoutError:
+                continue
+            except asyncio.CancelledError:
+                break
+
+    def start(self) -> bool:
+        """Запуск планировщика в фоне"""
+        if self.is_running():
+            return True
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self.start_scheduler())
+        return True
+
+    def stop_scheduler(self):
+        """Остановка планировщика"""
+        self._stop_event.set()
+        if self._task and not self._task.done():
+            self._task.cancel()
+        logging.info("🛑 Планировщик снимков базы остановлен")
+
+    def is_running(self) -> bool:
+        """Проверка, работает ли планировщик"""
+        return self._task is not None and not self._task.done()
+
+    def stats(self) -> dict:
+        """Состояние реплики и резервных копий"""
+        return {
+            'replica_age': self.replica_age(),
+            'max_staleness': self.max_staleness,
+            'last_refresh_seconds': self.last_refresh_seconds,
+            'backups': len(self.list_backups()),
+            'last_backup': self.last_backup_path
+        }
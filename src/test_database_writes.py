@@ -0,0 +1,264 @@
+# test_database_writes.py
+"""
+Проверка записей и выгрузок Database (database.py) на временной базе после миграций.
+
+Запуск: python test_database_writes.py  (или python -m pytest test_database_writes.py)
+"""
+import contextlib
+import csv
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+# Добавляем путь к текущей директории
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from database import Database, _write_csv, stages_from_mask, wait_write
+
+
+@contextlib.contextmanager
+def temp_database():
+    """Database на временном файле; писатель и пул закрываются после проверки"""
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, 'runners.db'))
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def test_concurrent_claims_never_share_a_code():
+    """Одновременные claim_promo_code из многих потоков не выдают один код дважды"""
+    with temp_database() as db:
+        codes = [f'RUN{number:04d}' for number in range(50)]
+        assert db.add_promo_codes_batch(codes) == (50, 0)
+
+        claimed = {}
+        barrier = threading.Barrier(8)
+
+        def claim(worker: int):
+            barrier.wait()
+            claimed[worker] = [db.claim_promo_code(worker * 100 + attempt) for attempt in range(10)]
+
+        threads = [threading.Thread(target=claim, args=(worker,)) for worker in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        issued = [code for worker_codes in claimed.values() for code in worker_codes if code is not None]
+        # 80 запросов на 50 кодов: выданы все коды, каждый один раз, остальным - None
+        assert sorted(issued) == codes
+        assert sum(code is None for worker_codes in claimed.values() for code in worker_codes) == 30
+
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*), COUNT(DISTINCT sent_to_telegram_id) FROM promo_codes
+                WHERE status = 'used'
+            ''')
+            assert cursor.fetchone() == (50, 50)
+
+
+class ChunkedCursor:
+    """Курсор с заданными строками, запоминающий размеры fetchmany"""
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.sizes = []
+
+    def fetchmany(self, size: int) -> list:
+        self.sizes.append(size)
+        chunk, self.rows = self.rows[:size], self.rows[size:]
+        return chunk
+
+
+def test_csv_written_in_fetchmany_chunks():
+    """_write_csv читает результат порциями EXPORT_FETCH_SIZE, а не fetchall"""
+    cursor = ChunkedCursor([(number, f'код {number}') for number in range(2500)])
+    with tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='') as out:
+        assert _write_csv(cursor, out, ['number', 'code']) == 2500
+        out.seek(0)
+        rows = list(csv.reader(out, delimiter=';'))
+    assert cursor.sizes == [database.EXPORT_FETCH_SIZE] * 4
+    assert rows[0] == ['number', 'code']
+    assert rows[-1] == ['2499', 'код 2499']
+    assert len(rows) == 2501
+
+
+def test_large_export_spools_to_disk():
+    """Выгрузка больше EXPORT_SPOOL_MAX_SIZE уходит во временный файл на диске целиком"""
+    with temp_database() as db:
+        codes = [f'RUN{number:05d}' for number in range(3000)]
+        db.add_promo_codes_batch(codes)
+
+        max_size = database.EXPORT_SPOOL_MAX_SIZE
+        database.EXPORT_SPOOL_MAX_SIZE = 4096
+        try:
+            out, count = db.export_promo_codes_to_csv()
+        finally:
+            database.EXPORT_SPOOL_MAX_SIZE = max_size
+        with out:
+            assert count == 3000
+            assert out._rolled
+            rows = list(csv.reader(out, delimiter=';'))
+        assert len(rows) == 3001
+        assert sorted(row[0] for row in rows[1:]) == codes
+
+        small, count = db.export_promo_codes_to_csv(status='expired')
+        with small:
+            assert count == 0
+            assert not small._rolled
+
+
+def test_wait_write_reports_failure_only_for_cancelled_writes():
+    """Просроченная, но начатая запись дожидается результата; ошибка - только у снятой с очереди"""
+    with temp_database() as db:
+        started, release = threading.Event(), threading.Event()
+
+        def _slow(cursor):
+            started.set()
+            release.wait(5)
+            cursor.execute("INSERT INTO stages (stage_name) VALUES ('Начатая запись')")
+            return cursor.lastrowid
+
+        def _queued(cursor):
+            cursor.execute("INSERT INTO stages (stage_name) VALUES ('Снятая с очереди')")
+
+        slow = db.writer.submit(_slow)
+        assert started.wait(5)
+        queued = db.writer.submit(_queued)
+
+        try:
+            wait_write(queued, timeout=0.05)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError("Не начатая запись должна завершиться ошибкой")
+        assert queued.cancelled()
+
+        threading.Timer(0.2, release.set).start()
+        stage_id = wait_write(slow, timeout=0.05)
+
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT stage_id, stage_name FROM stages")
+            assert cursor.fetchall() == [(stage_id, 'Начатая запись')]
+
+
+def add_participants(db: Database, stage_name: str, telegram_ids: list) -> int:
+    """Этап с участниками, их ссылками и пользователями в main; возвращает stage_id"""
+    def _write(cursor):
+        cursor.execute("INSERT INTO stages (stage_name) VALUES (?)", (stage_name,))
+        stage_id = cursor.lastrowid
+        for telegram_id in telegram_ids:
+            cursor.execute('''
+                INSERT INTO manual_upload (last_name, first_name, email, phone, stage_id)
+                VALUES ('Иванов', 'Иван', ?, 79990000000, ?)
+            ''', (f'{telegram_id}@example.com', stage_id))
+            participant_id = cursor.lastrowid
+            cursor.execute(
+                "INSERT INTO link_generation (participant_id, universal_link) VALUES (?, ?)",
+                (participant_id, f'link-{telegram_id}')
+            )
+            cursor.execute(
+                "INSERT INTO main (participant_id, telegram_id, role) VALUES (?, ?, 'user')",
+                (participant_id, telegram_id)
+            )
+        return stage_id
+
+    return db.write(_write)
+
+
+def progress_by_user(db: Database) -> dict:
+    """{telegram_id: (этапы по stage_mask, этапы по stage_progress)}"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT telegram_id, stage_mask FROM main")
+        progress = {telegram_id: (stages_from_mask(mask), []) for telegram_id, mask in cursor.fetchall()}
+        cursor.execute("SELECT telegram_id, stage_number FROM stage_progress ORDER BY stage_number")
+        for telegram_id, stage_number in cursor.fetchall():
+            progress[telegram_id][1].append(stage_number)
+    return progress
+
+
+def assert_progress_consistent(db: Database) -> dict:
+    progress = progress_by_user(db)
+    for telegram_id, (by_mask, by_table) in progress.items():
+        assert by_mask == by_table, f"{telegram_id}: stage_mask {by_mask}, stage_progress {by_table}"
+    return {telegram_id: by_mask for telegram_id, (by_mask, _) in progress.items()}
+
+
+def test_delete_stage_cascade():
+    """Удаление этапа удаляет его участников и ссылки, пользователи и их прогресс остаются"""
+    with temp_database() as db:
+        removed = add_participants(db, 'Весенний забег', [101, 102])
+        kept = add_participants(db, 'Осенний забег', [201])
+        for telegram_id in (101, 201):
+            db.mark_stage_completed(telegram_id, 1)
+
+        result = db.delete_stage_cascade(removed)
+        assert result == {
+            'stage_name': 'Весенний забег', 'deleted_users': 2, 'deleted_links': 2, 'updated_main': 2
+        }
+        assert db.delete_stage_cascade(removed) is None
+
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT stage_id FROM stages")
+            assert cursor.fetchall() == [(kept,)]
+            cursor.execute("SELECT COUNT(*) FROM manual_upload WHERE stage_id = ?", (removed,))
+            assert cursor.fetchone()[0] == 0
+            cursor.execute("SELECT COUNT(*) FROM link_generation")
+            assert cursor.fetchone()[0] == 1
+            cursor.execute("SELECT telegram_id, participant_id IS NULL FROM main ORDER BY telegram_id")
+            assert cursor.fetchall() == [(101, 1), (102, 1), (201, 0)]
+            cursor.execute("SELECT COUNT(*) FROM participant_search")
+            assert cursor.fetchone()[0] == 1
+
+        assert assert_progress_consistent(db) == {101: [1], 102: [], 201: [1]}
+
+
+def test_bulk_reset_keeps_mask_and_progress_consistent():
+    """Массовый сброс одинаково меняет stage_mask и stage_progress"""
+    with temp_database() as db:
+        telegram_ids = list(range(301, 311))
+        add_participants(db, 'Летний забег', telegram_ids)
+        for telegram_id in telegram_ids:
+            for stage_number in (1, 2, 3):
+                db.mark_stage_completed(telegram_id, stage_number)
+
+        # Этап 2 у части пользователей (и несуществующий пользователь)
+        assert db.reset_stage_completion_bulk([301, 302, 303, 999], stage_number=2) == 3
+        progress = assert_progress_consistent(db)
+        assert progress[301] == [1, 3]
+        assert progress[304] == [1, 2, 3]
+        assert db.get_completed_stages(302) == [1, 3]
+
+        # Этап 3 у всех
+        assert db.reset_stage_completion_bulk(stage_number=3) == 10
+        progress = assert_progress_consistent(db)
+        assert progress[301] == [1]
+        assert progress[304] == [1, 2]
+
+        # Все этапы у одного и у всех
+        assert db.reset_stage_completion_bulk([304]) == 1
+        assert assert_progress_consistent(db)[304] == []
+        assert db.reset_stage_completion_bulk() == 9
+        assert set(map(tuple, assert_progress_consistent(db).values())) == {()}
+        assert db.get_stage_completion_counts() == {1: 0, 2: 0, 3: 0, 4: 0}
+
+        assert db.reset_stage_completion_bulk(stage_number=7) == -1
+
+
+if __name__ == "__main__":
+    print("🔍 Проверка записей и выгрузок Database...")
+    print("=" * 60)
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    for test in tests:
+        test()
+        print(f"✅ {test.__doc__}")
+    print(f"✅ Все проверки пройдены: {len(tests)}")
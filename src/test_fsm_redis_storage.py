@@ -0,0 +1,195 @@
+# test_fsm_redis_storage.py
+"""
+Проверка RedisFSMStorage (fsm_storage.py).
+
+По умолчанию тесты идут на fakeredis (pip install fakeredis). Если задан
+TEST_REDIS_URL, используется настоящий redis-server по этому адресу (база
+очищается FLUSHDB).
+
+Несколько экземпляров хранилища с общим сервером - это несколько
+процессов бота, обслуживающих одних и тех же пользователей.
+
+Запуск: python test_fsm_redis_storage.py  (или python -m pytest test_fsm_redis_storage.py)
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import timedelta
+
+# Добавляем путь к текущей директории
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import RedisFSMStorage
+from fsm_transitions import get_user_record, transition_users
+
+TEST_REDIS_URL = os.getenv('TEST_REDIS_URL', '')
+BOT_ID = 42
+
+
+class QuestStates(StatesGroup):
+    waiting_for_image = State()
+    waiting_for_moderator_decision = State()
+
+
+def user_key(telegram_id: int) -> StorageKey:
+    return StorageKey(bot_id=BOT_ID, chat_id=telegram_id, user_id=telegram_id)
+
+
+async def create_workers(count: int, **kwargs) -> list:
+    """count хранилищ с общим сервером Redis"""
+    if TEST_REDIS_URL:
+        from redis.asyncio import Redis
+        workers = [RedisFSMStorage(Redis.from_url(TEST_REDIS_URL), **kwargs) for _ in range(count)]
+        await workers[0].redis.flushdb()
+        return workers
+
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return [RedisFSMStorage(fakeredis.FakeAsyncRedis(server=server), **kwargs) for _ in range(count)]
+
+
+async def close_workers(workers: list):
+    for storage in workers:
+        await storage.close()
+
+
+def run(coroutine_function, **kwargs):
+    """Запуск сценария с хранилищами в новом event loop"""
+    async def scenario():
+        workers = await create_workers(2, **kwargs)
+        try:
+            await coroutine_function(*workers)
+        finally:
+            await close_workers(workers)
+    asyncio.run(scenario())
+
+
+def test_state_and_data_roundtrip():
+    """Состояние и данные читаются так же, как записаны; пустой ключ удаляется"""
+    async def scenario(storage, _):
+        key = user_key(1001)
+        assert await storage.get_state(key) is None
+        assert await storage.get_data(key) == {}
+
+        await storage.set_state(key, QuestStates.waiting_for_image)
+        await storage.set_data(key, {'recognition_attempts': 2, 'last_image_path': 'фото/1001.jpg'})
+        assert await storage.get_state(key) == QuestStates.waiting_for_image.state
+        assert await storage.get_data(key) == {'recognition_attempts': 2, 'last_image_path': 'фото/1001.jpg'}
+        assert await storage.get_record(key) == (
+            QuestStates.waiting_for_image.state,
+            {'recognition_attempts': 2, 'last_image_path': 'фото/1001.jpg'}
+        )
+
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        assert await storage.redis.exists(storage.key_builder.build(key)) == 0
+
+    run(scenario)
+
+
+def test_compact_serialization():
+    """Один хэш на ключ, данные - JSON без пробелов и экранирования кириллицы"""
+    async def scenario(storage, _):
+        key = user_key(1002)
+        await storage.set_state(key, QuestStates.waiting_for_image)
+        await storage.set_data(key, {'name': 'Мария', 'attempts': [1, 2]})
+
+        stored = await storage.redis.hgetall(storage.key_builder.build(key))
+        assert stored == {
+            b's': QuestStates.waiting_for_image.state.encode('utf-8'),
+            b'd': json.dumps({'name': 'Мария', 'attempts': [1, 2]}, ensure_ascii=False,
+                             separators=(',', ':')).encode('utf-8')
+        }
+
+    run(scenario)
+
+
+def test_ttl_refreshed_on_write():
+    """Запись продлевает TTL ключа"""
+    async def scenario(storage, _):
+        key = user_key(1003)
+        name = storage.key_builder.build(key)
+        await storage.set_state(key, QuestStates.waiting_for_image)
+        assert 0 < await storage.redis.ttl(name) <= 3600
+
+        await storage.redis.expire(name, 10)
+        await storage.update_data(key, {'recognition_attempts': 1})
+        assert await storage.redis.ttl(name) > 10
+
+    run(scenario, ttl=timedelta(hours=1))
+
+
+def test_pipelined_writes():
+    """Запись и продление TTL - один обмен с сервером, чтение состояния и данных - один"""
+    async def scenario(storage, _):
+        key = user_key(1004)
+        before = storage.round_trips
+        await storage.set_state(key, QuestStates.waiting_for_image)
+        await storage.set_data(key, {'user_id': 7})
+        await storage.get_record(key)
+        assert storage.round_trips - before == 3
+
+    run(scenario, ttl=3600)
+
+
+def test_workers_share_state():
+    """Состояние, записанное одним процессом, видно другому"""
+    async def scenario(first, second):
+        key = user_key(1005)
+        await first.set_state(key, QuestStates.waiting_for_moderator_decision)
+        await first.set_data(key, {'user_id': 77})
+        assert await second.get_state(key) == QuestStates.waiting_for_moderator_decision.state
+        assert await second.get_data(key) == {'user_id': 77}
+
+        await second.set_state(key, QuestStates.waiting_for_image)
+        assert await first.get_state(key) == QuestStates.waiting_for_image.state
+
+    run(scenario)
+
+
+def test_concurrent_update_data_keeps_all_fields():
+    """Одновременные update_data из разных процессов не теряют изменения друг друга"""
+    async def scenario(first, second):
+        key = user_key(1006)
+        await asyncio.gather(*(
+            (first if number % 2 else second).update_data(key, {f'field_{number}': number})
+            for number in range(40)
+        ))
+        assert await first.get_data(key) == {f'field_{number}': number for number in range(40)}
+
+    run(scenario)
+
+
+def test_bulk_transition_single_round_trip():
+    """Перевод нескольких пользователей (решения модератора) - один обмен с сервером"""
+    class Bot:
+        id = BOT_ID
+
+    async def scenario(storage, other):
+        await storage.set_data(user_key(2001), {'recognition_attempts': 3})
+        before = storage.round_trips
+        assert await transition_users(storage, Bot, [
+            (2001, QuestStates.waiting_for_image, {'moderator_approved': True}),
+            (2002, None, {})
+        ])
+        assert storage.round_trips - before == 1
+        assert await get_user_record(other, Bot, 2001) == (
+            QuestStates.waiting_for_image.state, {'moderator_approved': True}
+        )
+        assert await get_user_record(other, Bot, 2002) == (None, {})
+
+    run(scenario)
+
+
+if __name__ == "__main__":
+    print("🔍 Проверка RedisFSMStorage...")
+    print("=" * 60)
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    for test in tests:
+        test()
+        print(f"✅ {test.__doc__}")
+    print(f"✅ Все проверки пройдены: {len(tests)}")
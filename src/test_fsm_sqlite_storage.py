@@ -0,0 +1,299 @@
+# test_fsm_sqlite_storage.py
+"""
+Проверка SQLiteStorage (fsm_storage.py), объединения записей FSM за
+обновление (fsm_context.py) и истечения состояний (fsm_expiry.py) на
+временной базе после миграций.
+
+Запуск: python test_fsm_sqlite_storage.py  (или python -m pytest test_fsm_sqlite_storage.py)
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# Добавляем путь к текущей директории
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from database import AsyncDatabase, Database
+from fsm_context import CoalescedFSMMiddleware
+from fsm_expiry import FSMExpiry, parse_state_ttls
+import fsm_storage
+from fsm_storage import SQLiteStorage
+
+BOT_ID = 42
+
+
+class QuestStates(StatesGroup):
+    waiting_for_image = State()
+    waiting_for_moderator_decision = State()
+
+
+class FailingWrites:
+    """adb, у которого писатель отвечает ошибкой, пока failing = True"""
+
+    def __init__(self, adb):
+        self._adb = adb
+        self.failing = True
+
+    def __getattr__(self, name):
+        return getattr(self._adb, name)
+
+    async def write(self, func, **kwargs):
+        if self.failing:
+            raise RuntimeError("Писатель базы данных недоступен")
+        return await self._adb.write(func, **kwargs)
+
+
+class CountingWrites:
+    """adb, считающий операции писателя"""
+
+    def __init__(self, adb):
+        self._adb = adb
+        self.writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self._adb, name)
+
+    async def write(self, func, **kwargs):
+        self.writes += 1
+        return await self._adb.write(func, **kwargs)
+
+
+def user_key(telegram_id: int) -> StorageKey:
+    return StorageKey(bot_id=BOT_ID, chat_id=telegram_id, user_id=telegram_id)
+
+
+def stored_row(db: Database, storage: SQLiteStorage, key: StorageKey):
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT state, data FROM fsm_storage WHERE storage_key = ?",
+                       (storage.key_builder.build(key),))
+        return cursor.fetchone()
+
+
+def run(coroutine_function, wrap=None, **kwargs):
+    """Запуск сценария с хранилищем на временной базе в новом event loop"""
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, 'fsm.db'))
+        adb = AsyncDatabase(db)
+        storage_adb = wrap(adb) if wrap else adb
+
+        async def scenario():
+            storage = SQLiteStorage(db, storage_adb, **kwargs)
+            try:
+                await coroutine_function(storage, db)
+            finally:
+                await storage.close()
+
+        try:
+            asyncio.run(scenario())
+        finally:
+            adb.shutdown()
+            db.close()
+
+
+def test_state_and_data_persisted():
+    """Состояние и данные записываются в fsm_storage и читаются новым хранилищем"""
+    async def scenario(storage, db):
+        key = user_key(1001)
+        await storage.set_state(key, QuestStates.waiting_for_image)
+        await storage.set_data(key, {'recognition_attempts': 2})
+        assert stored_row(db, storage, key) == (QuestStates.waiting_for_image.state, '{"recognition_attempts":2}')
+
+        fresh = SQLiteStorage(db, storage.adb)
+        assert await fresh.get_record(key) == (QuestStates.waiting_for_image.state, {'recognition_attempts': 2})
+
+        await storage.set_record(key, None, {})
+        assert stored_row(db, storage, key) is None
+
+    run(scenario)
+
+
+def test_evicted_key_read_from_database():
+    """Вытесненный из кэша ключ читается из базы, в кэше не больше max_entries ключей"""
+    async def scenario(storage, db):
+        for telegram_id in range(1, 6):
+            await storage.set_state(user_key(telegram_id), QuestStates.waiting_for_image)
+        assert storage.stats()['size'] == 2
+
+        misses = storage.misses
+        assert await storage.get_state(user_key(1)) == QuestStates.waiting_for_image.state
+        assert storage.misses == misses + 1
+
+    run(scenario, max_entries=2)
+
+
+def test_failing_writer_resolves_batch_and_keeps_changes():
+    """Ошибка писателя не подвешивает обработчики, изменения записываются следующей пачкой"""
+    async def scenario(storage, db):
+        key = user_key(1002)
+        await asyncio.wait_for(storage.set_state(key, QuestStates.waiting_for_image), timeout=5)
+        assert storage.stats()['pending'] == 1
+        assert stored_row(db, storage, key) is None
+        assert await storage.get_state(key) == QuestStates.waiting_for_image.state
+
+        storage.adb.failing = False
+        await asyncio.wait_for(storage.set_data(key, {'user_id': 7}), timeout=5)
+        assert storage.stats()['pending'] == 0
+        assert stored_row(db, storage, key) == (QuestStates.waiting_for_image.state, '{"user_id":7}')
+
+    run(scenario, wrap=FailingWrites)
+
+
+def test_failed_batch_retried_without_new_writes():
+    """Незаписанная пачка повторяется сама, без новых изменений других ключей"""
+    async def scenario(storage, db):
+        key = user_key(1005)
+        await asyncio.wait_for(storage.set_state(key, QuestStates.waiting_for_image), timeout=5)
+        assert storage.stats()['pending'] == 1
+
+        # Пока писатель недоступен, повторы откладываются все дальше
+        await asyncio.sleep(0.07)
+        assert stored_row(db, storage, key) is None
+        assert storage._retry_delay > fsm_storage.FSM_RETRY_DELAY
+
+        storage.adb.failing = False
+        for _ in range(100):
+            if stored_row(db, storage, key) is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert stored_row(db, storage, key) == (QuestStates.waiting_for_image.state, None)
+        assert storage.stats()['pending'] == 0
+        assert storage._retry_delay == 0
+
+    retry_delay, max_delay = fsm_storage.FSM_RETRY_DELAY, fsm_storage.FSM_RETRY_MAX_DELAY
+    fsm_storage.FSM_RETRY_DELAY, fsm_storage.FSM_RETRY_MAX_DELAY = 0.02, 0.05
+    try:
+        run(scenario, wrap=FailingWrites)
+    finally:
+        fsm_storage.FSM_RETRY_DELAY, fsm_storage.FSM_RETRY_MAX_DELAY = retry_delay, max_delay
+
+
+def test_non_serializable_data_skips_only_its_key():
+    """Несериализуемые данные одного ключа не мешают записи остальных ключей пачки"""
+    async def scenario(storage, db):
+        bad, good = user_key(1003), user_key(1004)
+        await asyncio.wait_for(asyncio.gather(
+            storage.set_data(bad, {'photo': object()}),
+            storage.set_state(good, QuestStates.waiting_for_moderator_decision)
+        ), timeout=5)
+        assert storage.stats()['pending'] == 0
+        assert stored_row(db, storage, bad) is None
+        assert stored_row(db, storage, good) == (QuestStates.waiting_for_moderator_decision.state, None)
+
+    run(scenario)
+
+
+def test_writes_of_one_interval_share_one_writer_operation():
+    """Изменения нескольких ключей за flush_interval - одна операция писателя"""
+    async def scenario(storage, db):
+        await asyncio.gather(*(
+            storage.set_state(user_key(telegram_id), QuestStates.waiting_for_image)
+            for telegram_id in range(2001, 2011)
+        ))
+        assert storage.adb.writes == 1
+        assert storage.stats()['rows_written'] == 10
+
+    # Интервал с запасом: первое обращение к ключу читает базу в потоке БД
+    run(scenario, wrap=CountingWrites, flush_interval=0.5)
+
+
+def test_middleware_coalesces_update_into_one_write():
+    """set_state, set_data и update_data одного обновления - одна запись состояния и данных"""
+    async def scenario(storage, db):
+        key = user_key(3001)
+        middleware = CoalescedFSMMiddleware()
+
+        async def handler(event, data):
+            state = data['state']
+            await state.set_state(QuestStates.waiting_for_image)
+            await state.set_data({'user_id': 3001})
+            await state.update_data(recognition_attempts=1)
+            await state.update_data(last_image_path='фото/3001.jpg')
+            # Обработчик видит свои изменения до записи
+            assert await state.get_state() == QuestStates.waiting_for_image.state
+            assert (await state.get_data())['recognition_attempts'] == 1
+            assert stored_row(db, storage, key) is None
+
+        await middleware(handler, None, {'state': FSMContext(storage, key), 'raw_state': None})
+        assert storage.adb.writes == 1
+        assert middleware.stats() == {'updates': 1, 'writes': 1}
+        assert await storage.get_record(key) == (
+            QuestStates.waiting_for_image.state,
+            {'user_id': 3001, 'recognition_attempts': 1, 'last_image_path': 'фото/3001.jpg'}
+        )
+
+        # Обновление без изменений ничего не пишет
+        async def reader(event, data):
+            await data['state'].get_data()
+
+        await middleware(reader, None, {
+            'state': FSMContext(storage, key), 'raw_state': QuestStates.waiting_for_image.state
+        })
+        assert storage.adb.writes == 1
+        assert middleware.stats() == {'updates': 2, 'writes': 1}
+
+    run(scenario, wrap=CountingWrites)
+
+
+def test_expiry_removes_idle_state_by_its_ttl():
+    """run_once удаляет ключ после срока его состояния; ожидание модератора не истекает"""
+    async def scenario(storage, db):
+        expiry = FSMExpiry(storage, parse_state_ttls('waiting_for_image=0.001,waiting_for_moderator_decision=0'),
+                           default_ttl=3600, tick=1, slots=512)
+        idle, waiting, data_only = user_key(4001), user_key(4002), user_key(4003)
+        await storage.set_state(idle, QuestStates.waiting_for_image)
+        await storage.set_state(waiting, QuestStates.waiting_for_moderator_decision)
+        await storage.set_data(data_only, {'user_id': 4003})
+        assert expiry.stats()['tracked'] == 2
+
+        now = time.time()
+        # Срок waiting_for_image - 86.4 секунды
+        assert await expiry.run_once(now + 60) == 0
+        assert stored_row(db, storage, idle) is not None
+
+        assert await expiry.run_once(now + 90) == 1
+        assert stored_row(db, storage, idle) is None
+        assert await storage.get_state(idle) is None
+        assert stored_row(db, storage, waiting) is not None
+        assert stored_row(db, storage, data_only) is not None
+        assert expiry.stats()['expired'] == 1
+
+        # Новая запись ключа продлевает срок
+        await storage.set_state(idle, QuestStates.waiting_for_image)
+        assert storage.key_builder.build(idle) in expiry.wheel
+
+    run(scenario)
+
+
+def test_sweep_removes_untracked_stale_rows():
+    """Ключи сверх max_tracked и записанные до запуска удаляет проход по индексу"""
+    async def scenario(storage, db):
+        expiry = FSMExpiry(storage, parse_state_ttls('waiting_for_image=1'), max_tracked=1, tick=1, slots=64)
+        for telegram_id in (5001, 5002):
+            await storage.set_state(user_key(telegram_id), QuestStates.waiting_for_image)
+        assert expiry.stats()['tracked'] == 1
+        assert expiry.stats()['untracked'] == 1
+
+        now = time.time() + 2 * 86400
+        assert await expiry.sweep(now) == 2
+        assert stored_row(db, storage, user_key(5001)) is None
+        assert await storage.get_state(user_key(5002)) is None
+        assert expiry.stats()['tracked'] == 0
+
+    run(scenario)
+
+
+if __name__ == "__main__":
+    print("🔍 Проверка SQLiteStorage...")
+    print("=" * 60)
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    for test in tests:
+        test()
+        print(f"✅ {test.__doc__}")
+    print(f"✅ Все проверки пройдены: {len(tests)}")
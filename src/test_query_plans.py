@@ -0,0 +1,214 @@
+# test_query_plans.py
+"""
+Проверка планов запросов на свежей базе после миграций.
+
+Все SELECT/INSERT/UPDATE/DELETE из database.py, mail_service/utils.py,
+handlers/link_generation.py, utils/database_processor.py, analytics.py,
+fsm_storage.py и fsm_expiry.py извлекаются из исходников, для каждого
+выполняется EXPLAIN QUERY PLAN. Тест падает,
+если запрос проходит таблицу целиком (SCAN) или сортирует результат во
+временном B-дереве, и это не объяснено в ALLOWED.
+
+Запуск: python test_query_plans.py  (или python -m pytest test_query_plans.py)
+"""
+import ast
+import os
+import sqlite3
+import sys
+
+# Добавляем путь к текущей директории
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import migrations
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SOURCE_FILES = [
+    'database.py',
+    'mail_service/utils.py',
+    'handlers/link_generation.py',
+    'utils/database_processor.py',
+    'analytics.py',
+    'fsm_storage.py',
+    'fsm_expiry.py'
+]
+
+CHECKED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# Осознанные исключения. Ключ - "файл:функция" (все запросы функции)
+# или "файл:функция#N" (N-й запрос функции, с 1).
+# Значение - (разрешенные нарушения из {'scan', 'temp_btree'}, причина).
+ALLOWED = {
+    # Отчеты и выгрузки по всей таблице: результат - все строки
+    'database.py:Database.get_promo_codes_stats': ({'scan'}, "агрегат по всем промокодам"),
+    'database.py:Database.get_all_promo_codes#2': ({'scan'}, "полный список, порядок из idx_promo_codes_created"),
+    'database.py:Database.write_promo_codes_csv#2': ({'scan'}, "полная выгрузка, порядок из idx_promo_codes_created"),
+    'database.py:Database.get_stage_completion_counts': ({'scan'}, "агрегат по stage_progress"),
+    'database.py:Database.reset_stage_completion_bulk#1': ({'scan'}, "сброс этапа у всех пользователей"),
+    'database.py:Database.reset_stage_completion_bulk#3': ({'scan'}, "сброс всех этапов у всех пользователей"),
+    'database.py:Database.write_addresses_csv#2': ({'scan'}, "полная выгрузка, порядок из idx_user_addresses_stage_created"),
+    'database.py:Database.get_addresses_report': ({'scan', 'temp_btree'}, "полная выгрузка с сортировкой по ФИО из другой таблицы"),
+    'database.py:Database.get_raffle_participants#2': ({'scan'}, "полный список, порядок из idx_raffle_participants_date"),
+    'database.py:Database.get_raffle_participants_count': ({'scan'}, "COUNT(*) по всей таблице"),
+    # Выдача промокода: первая запись частичного индекса, LIMIT 1
+    'database.py:Database.claim_promo_code': ({'scan'}, "LIMIT 1 по частичному индексу idx_promo_codes_available"),
+    # Поиск /find: подсчет совпадений по индексу FTS5 (MATCH), не больше LIMIT
+    'database.py:Database.search_participants': ({'scan'}, "FTS5 MATCH по инвертированному индексу"),
+    'database.py:Database.search_participants._load_users': ({'scan'}, "проход по списку найденных participant_id (json_each)"),
+    # Генерация ссылок и отчеты администратора по всем участникам
+    'handlers/link_generation.py:LinkGenerationScheduler.generate_links_automatically': ({'scan'}, "проход по всем участникам без ссылок"),
+    'handlers/link_generation.py:setup_link_generation_handler.generate_all_links_command': ({'scan'}, "проход по всем участникам"),
+    'handlers/link_generation.py:setup_link_generation_handler.get_links_command': ({'temp_btree'}, "список ссылок с сортировкой по ФИО из manual_upload"),
+    'handlers/link_generation.py:setup_link_generation_handler.get_links_compact_command': ({'temp_btree'}, "список ссылок с сортировкой по ФИО из manual_upload"),
+    # Снимок аналитики: справочник этапов при каждом обновлении
+    'analytics.py:ParticipantAnalytics._load_stage_names': ({'scan'}, "справочник этапов"),
+    # Число живых состояний FSM для /db_stats: COUNT по покрывающему индексу
+    'fsm_expiry.py:FSMExpiry._count_states': ({'scan'}, "GROUP BY state по idx_fsm_storage_state_updated"),
+    # Загрузка Excel: счетчики до/после и последние 10 записей
+    'utils/database_processor.py:process_excel_to_database#1': ({'scan'}, "COUNT(*) до загрузки"),
+    'utils/database_processor.py:process_excel_to_database#4': ({'scan'}, "COUNT(*) после загрузки"),
+    'utils/database_processor.py:process_excel_to_database#5': ({'scan'}, "последние 10 записей по rowid, LIMIT 10"),
+}
+
+
+class _StatementCollector(ast.NodeVisitor):
+    """Сбор строковых литералов из вызовов execute/executemany"""
+
+    def __init__(self):
+        self.scope = []
+        self.statements = []
+        self.counters = {}
+
+    def _visit_scope(self, node):
+        self.scope.append(node.name)
+        self.generic_visit(node)
+        self.scope.pop()
+
+    visit_ClassDef = _visit_scope
+    visit_AsyncFunctionDef = _visit_scope
+
+    def visit_FunctionDef(self, node):
+        # Вложенные _write/_load относятся к методу, в котором объявлены
+        if node.name in ('_write', '_load') and self.scope:
+            self.generic_visit(node)
+        else:
+            self._visit_scope(node)
+
+    def visit_Call(self, node):
+        func = node.func
+        if (isinstance(func, ast.Attribute) and func.attr in ('execute', 'executemany')
+                and node.args and isinstance(node.args[0], ast.Constant)
+                and isinstance(node.args[0].value, str)):
+            sql = node.args[0].value
+            # Комментарии в SQL не мешают определить тип запроса
+            first_word = ' '.join(
+                line for line in sql.splitlines() if not line.strip().startswith('--')
+            ).split(None, 1)
+            if first_word and first_word[0].upper() in CHECKED_STATEMENTS:
+                function = '.'.join(self.scope) or '<module>'
+                self.counters[function] = self.counters.get(function, 0) + 1
+                self.statements.append((function, self.counters[function], node.lineno, sql))
+        self.generic_visit(node)
+
+
+def collect_statements() -> list:
+    """Запросы из проверяемых файлов: (файл:функция, номер в функции, строка, SQL)"""
+    statements = []
+    for relative_path in SOURCE_FILES:
+        with open(os.path.join(SRC_DIR, relative_path), encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+        collector = _StatementCollector()
+        collector.visit(tree)
+        for function, number, lineno, sql in collector.statements:
+            statements.append((f"{relative_path}:{function}", number, lineno, sql))
+    return statements
+
+
+def create_migrated_db() -> sqlite3.Connection:
+    """Свежая база в памяти со всеми миграциями"""
+    conn = sqlite3.connect(':memory:')
+    migrations.migrate(conn)
+    return conn
+
+
+def plan_problems(conn: sqlite3.Connection, sql: str) -> tuple:
+    """Нарушения в плане запроса: (множество типов, строки плана)"""
+    params = [None] * sql.count('?')
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    kinds = set()
+    details = []
+    for row in plan:
+        detail = row[3]
+        if detail.startswith('SCAN') and 'CONSTANT ROW' not in detail:
+            kinds.add('scan')
+            details.append(detail)
+        elif 'USE TEMP B-TREE' in detail:
+            kinds.add('temp_btree')
+            details.append(detail)
+    return kinds, details
+
+
+def allowed_for(function_key: str, number: int) -> set:
+    """Разрешенные нарушения для запроса"""
+    allowed = set()
+    for key in (function_key, f"{function_key}#{number}"):
+        if key in ALLOWED:
+            allowed |= ALLOWED[key][0]
+    return allowed
+
+
+def find_plan_regressions() -> list:
+    """Запросы, план которых хуже разрешенного"""
+    conn = create_migrated_db()
+    regressions = []
+    try:
+        for function_key, number, lineno, sql in collect_statements():
+            try:
+                kinds, details = plan_problems(conn, sql)
+            except sqlite3.Error as e:
+                regressions.append(f"{function_key}#{number} (строка {lineno}): ошибка разбора: {e}")
+                continue
+            unexpected = kinds - allowed_for(function_key, number)
+            if unexpected:
+                regressions.append(
+                    f"{function_key}#{number} (строка {lineno}): {', '.join(details)}"
+                )
+    finally:
+        conn.close()
+    return regressions
+
+
+def test_statements_collected():
+    """Сборщик находит запросы во всех проверяемых файлах"""
+    files = {key.split(':', 1)[0] for key, _, _, _ in collect_statements()}
+    assert files == set(SOURCE_FILES), f"Нет запросов в: {set(SOURCE_FILES) - files}"
+
+
+def test_allowed_keys_exist():
+    """Исключения ссылаются на существующие запросы"""
+    keys = set()
+    for function_key, number, _, _ in collect_statements():
+        keys.add(function_key)
+        keys.add(f"{function_key}#{number}")
+    stale = sorted(set(ALLOWED) - keys)
+    assert not stale, f"Устаревшие исключения: {stale}"
+
+
+def test_hot_query_plans():
+    """Запросы используют индексы и не сортируют во временном B-дереве"""
+    regressions = find_plan_regressions()
+    assert not regressions, "Планы запросов ухудшились:\n" + "\n".join(regressions)
+
+
+if __name__ == "__main__":
+    print("🔍 Проверка планов запросов...")
+    print("=" * 60)
+    statements = collect_statements()
+    regressions = find_plan_regressions()
+    print(f"📊 Проверено запросов: {len(statements)}")
+    if regressions:
+        print(f"❌ Ухудшенных планов: {len(regressions)}")
+        for regression in regressions:
+            print(f"   {regression}")
+        sys.exit(1)
+    print("✅ Все запросы используют индексы")
@@ -0,0 +1,266 @@
+# test_sharding.py
+"""
+Проверка шардирования пользовательских таблиц (sharding.py, Database.configure_shards)
+на временных файлах основной базы и шардов.
+
+Запуск: python test_sharding.py  (или python -m pytest test_sharding.py)
+"""
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+
+# Добавляем путь к текущей директории
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sharding
+from database import Database
+
+SHARDS = 2
+
+
+def telegram_ids_by_shard(count: int = SHARDS, per_shard: int = 2, other_counts: tuple = ()) -> list:
+    """По per_shard telegram_id на каждый шард: [[шард 0], [шард 1], ...].
+
+    other_counts - берутся только telegram_id, которые при каждом из этих
+    чисел шардов попали бы в другой шард.
+    """
+    by_shard = [[] for _ in range(count)]
+    telegram_id = 100000
+    while any(len(ids) < per_shard for ids in by_shard):
+        telegram_id += 1
+        shard = sharding.shard_for_telegram_id(telegram_id, count)
+        if any(sharding.shard_for_telegram_id(telegram_id, other) == shard for other in other_counts):
+            continue
+        if len(by_shard[shard]) < per_shard:
+            by_shard[shard].append(telegram_id)
+    return by_shard
+
+
+@contextlib.contextmanager
+def temp_path():
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, 'runners.db')
+
+
+@contextlib.contextmanager
+def opened(path: str, shards: int = SHARDS):
+    """Database на path с включенными шардами; писатели и пулы закрываются после проверки"""
+    db = Database(path)
+    try:
+        if shards:
+            db.configure_shards(shards)
+        yield db
+    finally:
+        db.close()
+
+
+def add_links(db: Database, stage_name: str, count: int) -> list:
+    """Этап с участниками и активными ссылками (без пользователей); возвращает [(participant_id, ссылка)]"""
+    def _write(cursor):
+        cursor.execute("INSERT INTO stages (stage_name) VALUES (?)", (stage_name,))
+        stage_id = cursor.lastrowid
+        links = []
+        for number in range(count):
+            cursor.execute('''
+                INSERT INTO manual_upload (last_name, first_name, email, phone, stage_id)
+                VALUES ('Петров', ?, ?, 79990000000, ?)
+            ''', (f'Участник{number}', f'runner{number}@example.com', stage_id))
+            participant_id = cursor.lastrowid
+            link = f'link-{stage_id}-{number}'
+            cursor.execute(
+                "INSERT INTO link_generation (participant_id, universal_link, status) VALUES (?, ?, 1)",
+                (participant_id, link)
+            )
+            links.append((participant_id, link))
+        return links
+
+    return db.write(_write)
+
+
+def shard_rows(path: str, index: int, sql: str, params: tuple = ()) -> list:
+    """Строки файла шарда напрямую, без пула и представлений"""
+    conn = sqlite3.connect(sharding.shard_path(path, index))
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def main_file_rows(path: str, sql: str, params: tuple = ()) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def test_distribute_rows_moves_existing_users():
+    """Пользователи основного файла переезжают в свои шарды с user_id из диапазона шарда"""
+    by_shard = telegram_ids_by_shard()
+    with temp_path() as path:
+        with opened(path, shards=0) as db:
+            links = add_links(db, 'Весенний забег', 4)
+            for (participant_id, link), telegram_id in zip(links, sum(by_shard, [])):
+                assert db.register_by_link(link, telegram_id, f'user{telegram_id}')['status'] == 'registered'
+                db.mark_stage_completed(telegram_id, 2)
+            user_id = db.get_user_id(by_shard[1][0])
+            assert db.save_verification(user_id, 5.0, '2026-05-01', 1)
+
+        with opened(path) as db:
+            assert main_file_rows(path, "SELECT COUNT(*) FROM main") == [(0,)]
+            for index, telegram_ids in enumerate(by_shard):
+                assert sorted(row[0] for row in shard_rows(path, index, "SELECT telegram_id FROM main")) == telegram_ids
+                for telegram_id in telegram_ids:
+                    user = db.get_user_by_telegram_id(telegram_id)
+                    assert user['user_id'] // sharding.SHARD_USER_ID_RANGE == index
+                    assert db.get_completed_stages(telegram_id) == [2]
+
+            # verification переезжает вслед за владельцем и со сдвинутым user_id
+            moved_user_id = db.get_user_id(by_shard[1][0])
+            assert moved_user_id == user_id + sharding.SHARD_USER_ID_RANGE
+            assert shard_rows(path, 1, "SELECT user_id, distance FROM verification") == [(moved_user_id, 5.0)]
+            assert shard_rows(path, 0, "SELECT COUNT(*) FROM verification") == [(0,)]
+
+            # Индекс поиска сохранил username после удаления строк из основного файла
+            found = db.search_participants(f'@user{by_shard[0][0]}')
+            assert [result['telegram_id'] for result in found['results']] == [by_shard[0][0]]
+
+        # Повторное включение с тем же числом шардов ничего не переносит
+        with opened(path, shards=0) as db:
+            assert db.configure_shards(SHARDS) == {}
+            assert db.get_user_by_telegram_id(by_shard[0][0]) is not None
+
+
+def test_routing_by_telegram_id_and_user_id():
+    """Записи пользователя уходят в шард по telegram_id, записи по user_id - в шард его диапазона"""
+    by_shard = telegram_ids_by_shard()
+    with temp_path() as path, opened(path) as db:
+        for index, telegram_ids in enumerate(by_shard):
+            for telegram_id in telegram_ids:
+                assert db.shard_of(telegram_id) == index
+                assert db.register_user(telegram_id, f'user{telegram_id}')
+                user_id = db.get_user_id(telegram_id)
+                assert db.shard_of_user(user_id) == index
+                assert db.save_verification(user_id, 10.0, '2026-06-01', 1)
+                assert db.add_user_image(telegram_id, f'фото/{telegram_id}.jpg')
+
+        for index, telegram_ids in enumerate(by_shard):
+            assert sorted(row[0] for row in shard_rows(path, index, "SELECT telegram_id FROM main")) == telegram_ids
+            user_ids = [row[0] for row in shard_rows(path, index, "SELECT user_id FROM verification")]
+            assert len(user_ids) == len(telegram_ids)
+            assert all(user_id // sharding.SHARD_USER_ID_RANGE == index for user_id in user_ids)
+            assert shard_rows(path, index, "SELECT COUNT(*) FROM user_data") == [(len(telegram_ids),)]
+        assert main_file_rows(path, "SELECT COUNT(*) FROM main") == [(0,)]
+
+        # Основная база видит пользователей всех шардов через представления
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM main")
+            assert cursor.fetchone()[0] == sum(len(ids) for ids in by_shard)
+
+
+def test_register_by_link_across_shards():
+    """Ссылки гасятся в основной базе, пользователи привязываются в своих шардах; used и taken видны между шардами"""
+    by_shard = telegram_ids_by_shard()
+    with temp_path() as path, opened(path) as db:
+        (first_id, first_link), (second_id, second_link), (taken_id, taken_link) = add_links(db, 'Летний забег', 3)
+
+        first = db.register_by_link(first_link, by_shard[0][0], 'first')
+        assert first['status'] == 'registered'
+        assert first['participant_id'] == first_id
+        assert first['user_id'] // sharding.SHARD_USER_ID_RANGE == 0
+        second = db.register_by_link(second_link, by_shard[1][0], 'second')
+        assert second['status'] == 'registered'
+        assert second['user_id'] // sharding.SHARD_USER_ID_RANGE == 1
+        assert shard_rows(path, 0, "SELECT participant_id FROM main") == [(first_id,)]
+        assert shard_rows(path, 1, "SELECT participant_id FROM main") == [(second_id,)]
+
+        # Погашенная ссылка не выдается пользователю другого шарда
+        assert db.register_by_link(first_link, by_shard[1][1])['status'] == 'used'
+        assert db.register_by_link('link-missing', by_shard[0][1])['status'] == 'not_found'
+
+        # Участник уже привязан в шарде 1, а ссылка снова активна - taken из шарда 0
+        db.write(lambda cursor: cursor.execute(
+            "INSERT INTO main (participant_id, telegram_id, role) VALUES (?, ?, 'user')",
+            (taken_id, by_shard[1][1])
+        ), shard=1)
+        assert db.register_by_link(taken_link, by_shard[0][1])['status'] == 'taken'
+        assert main_file_rows(path, "SELECT status FROM link_generation WHERE universal_link = ?",
+                              (taken_link,)) == [(1,)]
+        assert db.get_user_by_telegram_id(by_shard[0][1]) is None
+
+
+def test_search_and_stage_counts_across_shards():
+    """Поиск и статистика этапов собирают пользователей всех шардов"""
+    by_shard = telegram_ids_by_shard()
+    with temp_path() as path, opened(path) as db:
+        links = add_links(db, 'Осенний забег', 4)
+        telegram_ids = sum(by_shard, [])
+        for (_, link), telegram_id in zip(links, telegram_ids):
+            assert db.register_by_link(link, telegram_id, f'user{telegram_id}')['status'] == 'registered'
+        for telegram_id in telegram_ids:
+            db.mark_stage_completed(telegram_id, 1)
+        for telegram_id in (by_shard[0][0], by_shard[1][0]):
+            db.mark_stage_completed(telegram_id, 3)
+
+        found = db.search_participants('Петров')
+        assert found['matches'] == 4
+        assert sorted(result['telegram_id'] for result in found['results']) == sorted(telegram_ids)
+        assert all(result['completed_stages'] for result in found['results'])
+
+        # username пишут временные триггеры соединений шардов
+        found = db.search_participants(f'@user{by_shard[1][1]}')
+        assert [result['telegram_id'] for result in found['results']] == [by_shard[1][1]]
+
+        assert db.get_stage_completion_counts() == {1: 4, 2: 0, 3: 2, 4: 0}
+
+
+def test_reconfigure_with_different_shard_count_refused():
+    """Шардирование не включается повторно и не меняет число шардов заполненной базы"""
+    by_shard = telegram_ids_by_shard(count=3, per_shard=1, other_counts=(4,))
+    with temp_path() as path:
+        with opened(path, shards=3) as db:
+            for telegram_ids in by_shard:
+                db.register_user(telegram_ids[0])
+            try:
+                db.configure_shards(3)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError("Повторное включение шардирования должно быть отклонено")
+
+        # Меньше шардов: шард 2 уже существует
+        with opened(path, shards=0) as db:
+            try:
+                db.configure_shards(2)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError("Уменьшение числа шардов должно быть отклонено")
+
+        # Больше шардов: пользователи распределены по трем, файл шарда 3 не остается
+        with opened(path, shards=0) as db:
+            try:
+                db.configure_shards(4)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError("Увеличение числа шардов должно быть отклонено")
+        assert not os.path.exists(sharding.shard_path(path, 3))
+
+        # Прежнее число шардов открывается с теми же пользователями
+        with opened(path, shards=3) as db:
+            for telegram_ids in by_shard:
+                assert db.get_user_role(telegram_ids[0]) == 'user'
+
+
+if __name__ == "__main__":
+    print("🔍 Проверка шардирования...")
+    print("=" * 60)
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    for test in tests:
+        test()
+        print(f"✅ {test.__doc__}")
+    print(f"✅ Все проверки пройдены: {len(tests)}")
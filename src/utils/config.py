@@ -6,6 +6,37 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     DATABASE_PATH = os.getenv('DATABASE_PATH', 'runners.db')
+
+    # Реплика для отчетов и резервные копии (snapshots.py)
+    REPLICA_PATH = os.getenv('REPLICA_PATH', 'runners_replica.db')
+    REPLICA_REFRESH_MINUTES = float(os.getenv('REPLICA_REFRESH_MINUTES', '5'))
+    REPLICA_MAX_STALENESS_MINUTES = float(os.getenv('REPLICA_MAX_STALENESS_MINUTES', '15'))
+    BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+    BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '6'))
+    BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+
+    # Обслуживание базы (maintenance.py)
+    MAINTENANCE_INTERVAL_MINUTES = float(os.getenv('MAINTENANCE_INTERVAL_MINUTES', '30'))
+    WAL_CHECKPOINT_THRESHOLD_MB = float(os.getenv('WAL_CHECKPOINT_THRESHOLD_MB', '64'))
+    MAINTENANCE_QUIET_HOURS = os.getenv('MAINTENANCE_QUIET_HOURS', '3-6')
+
+    # Архив user_data и verification (retention.py): отдельный файл архива
+    # (пусто - архивные таблицы в основной базе) и дата начала мероприятия
+    ARCHIVE_PATH = os.getenv('ARCHIVE_PATH', '')
+    EVENT_STARTED_AT = os.getenv('EVENT_STARTED_AT', '')
+
+    # Шардирование пользовательских таблиц по telegram_id (sharding.py), 1 - без шардов
+    DB_SHARD_COUNT = int(os.getenv('DB_SHARD_COUNT', '1'))
+
+    # Хранилище FSM в Redis для нескольких экземпляров бота (пусто - SQLite, fsm_storage.py)
+    REDIS_URL = os.getenv('REDIS_URL', '')
+    FSM_TTL_DAYS = float(os.getenv('FSM_TTL_DAYS', '30'))
+    # Сроки простоя отдельных состояний FSM в днях, 0 - не истекает (fsm_expiry.py)
+    FSM_STATE_TTL_DAYS = os.getenv('FSM_STATE_TTL_DAYS', 'waiting_for_image=7,waiting_for_moderator_decision=0')
+    FSM_MAX_TRACKED = int(os.getenv('FSM_MAX_TRACKED', '100000'))
+
+    # Журнал медленных запросов (query_stats.py)
+    SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
     
     @classmethod
     def validate(cls):
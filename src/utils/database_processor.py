@@ -5,90 +5,21 @@ import os
 from datetime import datetime
 
 def fix_table_structure(db_path: str = 'runners.db'):
-    """Исправляет структуру таблицы manual_upload"""
+    """Приводит структуру таблиц к актуальной версии схемы.
+
+    Раньше таблица manual_upload каждый раз пересоздавалась целиком;
+    теперь применяются только недостающие миграции (см. migrations.py).
+    """
     try:
+        from migrations import migrate
+
         conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Проверяем текущую структуру
-        cursor.execute("PRAGMA table_info(manual_upload)")
-        columns = cursor.fetchall()
-        
-        cursor.execute("PRAGMA index_list(manual_upload)")
-        indexes = cursor.fetchall()
-        
-        print("\n📋 Текущая структура таблицы manual_upload:")
-        for col in columns:
-            print(f"  {col[1]} ({col[2]}) - PK: {col[5]}")
-        
-        print("\n📊 Текущие индексы таблицы manual_upload:")
-        for idx in indexes:
-            print(f"  Индекс: {idx[1]}, Уникальный: {idx[2]}")
-        
-        # Удаляем проблемный уникальный индекс если он существует
-        for idx in indexes:
-            if idx[1] == 'sqlite_autoindex_manual_upload_1' and idx[2] == 1:
-                print(f"🗑️ Удаляем проблемный уникальный индекс: {idx[1]}")
-                # В SQLite нельзя удалить автоматически созданные индексы напрямую
-                # Нужно пересоздать таблицу
-                break
-        
-        # Пересоздаем таблицу с правильной структурой
-        print("🔄 Пересоздаем таблицу с правильной структурой...")
-        
-        # Создаем временную таблицу с данными
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS manual_upload_temp AS 
-            SELECT * FROM manual_upload
-        ''')
-        
-        # Удаляем старую таблицу
-        cursor.execute('DROP TABLE IF EXISTS manual_upload')
-        
-        # Создаем новую таблицу с правильной структурой
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS manual_upload (
-                participant_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                last_name TEXT NOT NULL,
-                first_name TEXT NOT NULL,
-                middle_name TEXT,
-                email TEXT NOT NULL,
-                phone INTEGER NOT NULL,
-                stage_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (stage_id) REFERENCES stages(stage_id)
-            )
-        ''')
-        
-        # Создаем правильные индексы (не уникальные)
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_manual_upload_stage 
-            ON manual_upload(stage_id)
-        ''')
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_manual_upload_email 
-            ON manual_upload(email)
-        ''')
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_manual_upload_name 
-            ON manual_upload(last_name, first_name)
-        ''')
-        
-        # Восстанавливаем данные из временной таблицы
-        cursor.execute('''
-            INSERT INTO manual_upload 
-            (last_name, first_name, middle_name, email, phone, stage_id)
-            SELECT last_name, first_name, middle_name, email, phone, stage_id 
-            FROM manual_upload_temp
-        ''')
-        
-        # Удаляем временную таблицу
-        cursor.execute('DROP TABLE IF EXISTS manual_upload_temp')
-        
-        conn.commit()
-        conn.close()
+        try:
+            version = migrate(conn)
+        finally:
+            conn.close()
         
-        print("✅ Структура таблицы успешно исправлена")
+        print(f"✅ Структура базы данных актуальна (версия схемы {version})")
         return True
         
     except Exception as e:
@@ -308,8 +239,8 @@ def process_excel_to_database(excel_file_path: str, db_path: str = 'runners.db')
                 # Вставляем новую запись
                 cursor.execute('''
                     INSERT INTO manual_upload 
-                    (last_name, first_name, middle_name, email, phone, stage_id)
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    (last_name, first_name, middle_name, email, phone, stage_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
                 ''', (last_name, first_name, middle_name, email, phone, stage_id))
                 
                 new_count += 1
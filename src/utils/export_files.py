@@ -0,0 +1,30 @@
+# src/utils/export_files.py
+"""
+Отправка потоковых выгрузок в Telegram без чтения файла в память целиком.
+
+    export_file, count = await adb.export_promo_codes_to_csv(status)
+    if export_file is not None:
+        with export_file:
+            await message.answer_document(SpooledInputFile(export_file, "promo_codes.csv"))
+"""
+from aiogram.types import InputFile
+
+
+class SpooledInputFile(InputFile):
+    """Файл выгрузки (в том числе tempfile.SpooledTemporaryFile), читается частями.
+
+    Текстовые файлы кодируются в UTF-8 по мере чтения. Закрывает файл
+    вызывающий код: при повторной отправке чтение начинается сначала.
+    """
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
@@ -41,5 +41,16 @@ def setup_logging():
     
     # Отключаем пропагацию к корневому логгеру
     logger.propagate = False
+
+    # Медленные запросы к БД (query_stats.py) дополнительно пишутся в отдельный файл
+    slow_handler = logging.FileHandler(
+        os.path.join(log_dir, 'slow_queries.log'),
+        encoding='utf-8',
+        mode='a'
+    )
+    slow_handler.setFormatter(formatter)
+    slow_logger = logging.getLogger('bot.slow_queries')
+    slow_logger.handlers.clear()
+    slow_logger.addHandler(slow_handler)
     
     return logger